@@ -14,6 +14,16 @@ class FileId(ABC):
     @abstractmethod
     async def index(self, path: str) -> str | None: ...
 
-    def watch(self, path: str): ...
+    def watch(self, path: str, recursive: bool = False):
+        """Watch a path for changes.
+
+        Args:
+            path: The path to watch.
+            recursive: Whether to also watch everything under the path, if it is a directory.
+
+        Returns:
+            An async iterator of changes.
+        """
+        ...
 
     def unwatch(self, path: str, watcher): ...
@@ -1,27 +1,10 @@
-from abc import ABC, abstractmethod
-from collections.abc import AsyncGenerator
-from enum import IntEnum
 from importlib.metadata import version
-from pathlib import Path
 
-from anyio import Event
+from .filters import DEFAULT_EXCLUDE as DEFAULT_EXCLUDE
+from .filters import PathFilter as PathFilter
+from .hub import FileWatcherHub as FileWatcherHub
+from .watcher import Change as Change
+from .watcher import FileChange as FileChange
+from .watcher import FileWatcher as FileWatcher
 
 __version__ = version(__package__)
-
-
-class Change(IntEnum):
-    added = 1
-    modified = 2
-    deleted = 3
-
-
-FileChange = tuple[Change, str]
-
-
-class FileWatcher(ABC):
-    @abstractmethod
-    async def watch(
-        self,
-        path: Path | str,
-        stop_event: Event | None = None,
-    ) -> AsyncGenerator[set[FileChange], None]: ...
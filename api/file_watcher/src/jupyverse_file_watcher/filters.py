@@ -0,0 +1,135 @@
+import os
+import re
+from collections.abc import Iterable
+
+# the patterns of the paths that are not indexed nor watched by default
+DEFAULT_EXCLUDE = [
+    ".git",
+    "node_modules",
+    "__pycache__",
+    ".ipynb_checkpoints",
+    ".venv",
+    ".jupyter_ystore.db*",
+]
+
+
+class PathFilter:
+    """Matches relative paths against gitignore-style patterns.
+
+    - A pattern without a slash (other than a trailing one) matches a file or directory
+      name at any depth, e.g. `node_modules` or `*.pyc`.
+    - A pattern with a slash is relative to the root, e.g. `docs/_build`. A leading slash
+      is ignored.
+    - `*` and `?` match within a path component, `**` matches any number of components.
+    - A pattern starting with `!` includes paths back, the last matching pattern wins.
+    - A trailing slash is ignored, patterns also match files.
+
+    Everything under a matching directory also matches.
+    """
+
+    def __init__(self, patterns: Iterable[str] = ()) -> None:
+        self._patterns = [pattern for pattern in patterns if pattern.strip()]
+        self._rules: list[tuple[re.Pattern, bool]] = []
+        for pattern in self._patterns:
+            negate = pattern.startswith("!")
+            if negate:
+                pattern = pattern[1:]
+            self._rules.append((re.compile(_translate(pattern.strip())), negate))
+        self._regex: re.Pattern | None = None
+        if not any(negate for _, negate in self._rules):
+            # all the patterns can be combined
+            self._regex = re.compile("|".join(f"(?:{rule.pattern})" for rule, _ in self._rules))
+
+    @property
+    def patterns(self) -> list[str]:
+        return self._patterns
+
+    def unanchored(self) -> "PathFilter":
+        """
+        Returns:
+            A filter with the patterns that don't depend on the root, i.e. that exclude
+            the same paths whatever the directory the paths are relative to. It doesn't
+            exclude anything if some patterns are anchored and some include paths back,
+            since an anchored pattern could then include back a path that it excludes.
+        """
+        anchored = [_is_anchored(pattern.lstrip("!")) for pattern in self._patterns]
+        if not any(anchored):
+            return self
+        if any(pattern.startswith("!") for pattern in self._patterns):
+            return PathFilter()
+        return PathFilter(
+            pattern
+            for pattern, is_anchored in zip(self._patterns, anchored, strict=True)
+            if not is_anchored
+        )
+
+    def __bool__(self) -> bool:
+        return bool(self._rules)
+
+    def __call__(self, path: str) -> bool:
+        """
+        Args:
+            path: The path to check, relative to the root.
+
+        Returns:
+            True if the path matches (i.e. is excluded), False otherwise.
+        """
+        if not self._rules:
+            return False
+        if os.sep != "/":
+            path = path.replace(os.sep, "/")
+        if path.startswith("./"):
+            path = path[2:]
+        if self._regex is not None:
+            return self._regex.fullmatch(path) is not None
+        excluded = False
+        for rule, negate in self._rules:
+            if rule.fullmatch(path) is not None:
+                excluded = not negate
+        return excluded
+
+
+def _is_anchored(pattern: str) -> bool:
+    return "/" in pattern.strip().rstrip("/")
+
+
+def _translate(pattern: str) -> str:
+    anchored = _is_anchored(pattern)
+    pattern = pattern.rstrip("/")
+    parts = pattern.lstrip("/").split("/")
+    regex = "" if anchored else "(?:.*/)?"
+    for i, part in enumerate(parts):
+        last = i == len(parts) - 1
+        if part == "**":
+            regex += ".*" if last else "(?:[^/]*/)*"
+            continue
+        regex += _translate_part(part)
+        if not last:
+            regex += "/"
+    # everything under a matching directory matches too
+    return regex + "(?:/.*)?"
+
+
+def _translate_part(part: str) -> str:
+    regex = ""
+    i = 0
+    while i < len(part):
+        c = part[i]
+        i += 1
+        if c == "*":
+            regex += "[^/]*"
+        elif c == "?":
+            regex += "[^/]"
+        elif c == "[":
+            j = part.find("]", i + 1)
+            if j == -1:
+                regex += re.escape(c)
+            else:
+                chars = part[i:j]
+                if chars.startswith("!"):
+                    chars = "^" + chars[1:]
+                regex += f"[{chars.replace(chr(92), chr(92) * 2)}]"
+                i = j + 1
+        else:
+            regex += re.escape(c)
+    return regex
@@ -0,0 +1,253 @@
+import os
+import sys
+from collections import deque
+from collections.abc import AsyncGenerator
+from contextlib import asynccontextmanager
+from pathlib import Path
+
+import structlog
+from anyio import AsyncContextManagerMixin, CancelScope, Event, create_task_group
+
+from .filters import PathFilter
+from .watcher import Change, FileChange, FileWatcher
+
+if sys.version_info >= (3, 11):
+    from typing import Self
+else:
+    from typing_extensions import Self
+
+logger = structlog.get_logger()
+
+
+class _Subscriber:
+    def __init__(self, path: str, max_pending: int, exclude: PathFilter) -> None:
+        self.path = path
+        self.cancel_scope = CancelScope()
+        self._prefix = path if path.endswith(os.sep) else path + os.sep
+        self._max_pending = max_pending
+        self._exclude = exclude
+        # the pending changes, the last ones being merged by path if there are too many
+        self._pending: deque[set[FileChange] | dict[str, Change]] = deque()
+        self._event = Event()
+        self._closed = False
+        self._exception: Exception | None = None
+
+    def publish(self, changes: set[FileChange]) -> None:
+        changes = {
+            change
+            for change in changes
+            if change[1] == self.path
+            or (
+                change[1].startswith(self._prefix)
+                # the exclude patterns are relative to the subscribed path
+                and not (self._exclude and self._exclude(change[1][len(self._prefix) :]))
+            )
+        }
+        if not changes:
+            return
+        if len(self._pending) < self._max_pending:
+            self._pending.append(changes)
+        else:
+            # the subscriber doesn't keep up, merge with the last pending changes
+            last_changes = self._pending[-1]
+            if isinstance(last_changes, set):
+                last_changes = self._pending[-1] = merge_changes({}, last_changes)
+            merge_changes(last_changes, changes)
+        self._event.set()
+
+    def close(self, exception: Exception | None = None) -> None:
+        self._closed = True
+        self._exception = exception
+        self._event.set()
+
+    async def get(self) -> set[FileChange] | None:
+        while True:
+            if self._exception is not None:
+                raise self._exception
+            if self._closed:
+                return None
+            if self._pending:
+                changes = self._pending.popleft()
+                if isinstance(changes, dict):
+                    return {(change, path) for path, change in changes.items()}
+                return changes
+            await self._event.wait()
+            self._event = Event()
+
+
+class _Root:
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.subscribers: set[_Subscriber] = set()
+        self.stop_event = Event()
+
+
+class FileWatcherHub(FileWatcher, AsyncContextManagerMixin):
+    """A file watcher that shares the watches of another file watcher between subscribers.
+
+    It owns one watch per root directory. Watching a path under a root that is already
+    watched reuses its watch, and watching a parent of watched roots replaces their
+    watches with a single one. The changes are filtered for every subscriber, with the
+    exclude patterns relative to the subscribed path, and queued in a bounded queue: the
+    pending changes of a subscriber that doesn't keep up are merged together, keeping
+    the last change of each path.
+
+    Since the root of a watch can be a parent of the subscribed path, the file watcher
+    must only apply the exclude patterns that don't depend on the root, i.e.
+    `exclude.unanchored()`.
+
+    The hub must be used with an async context manager, and stops when its stop event
+    is set:
+    ```py
+    async with FileWatcherHub(file_watcher, stop_event) as hub:
+        ...
+    ```
+    """
+
+    def __init__(
+        self,
+        file_watcher: FileWatcher,
+        stop_event: Event | None = None,
+        max_pending: int = 16,
+        exclude: PathFilter | None = None,
+    ) -> None:
+        """
+        Args:
+            file_watcher: The file watcher used to watch the roots.
+            stop_event: The event to set to stop the hub.
+            max_pending: The maximum number of pending change sets for each subscriber.
+            exclude: The paths to ignore, relative to the subscribed path.
+        """
+        self._file_watcher = file_watcher
+        self._stop_event = Event() if stop_event is None else stop_event
+        self._max_pending = max_pending
+        self._exclude = PathFilter() if exclude is None else exclude
+        self._root_exclude = self._exclude.unanchored()
+        self._roots: dict[str, _Root] = {}
+
+    @property
+    def file_watcher(self) -> FileWatcher:
+        """
+        Returns:
+            The file watcher used to watch the roots.
+        """
+        return self._file_watcher
+
+    @property
+    def roots(self) -> list[str]:
+        """
+        Returns:
+            The watched root directories.
+        """
+        return list(self._roots)
+
+    @asynccontextmanager
+    async def __asynccontextmanager__(self) -> AsyncGenerator[Self]:
+        async with create_task_group() as self._task_group:
+            self._task_group.start_soon(self._close_on_stop_all)
+            yield self
+            await self._stop_event.wait()
+            self._task_group.cancel_scope.cancel()
+
+    async def _close_on_stop_all(self) -> None:
+        await self._stop_event.wait()
+        for root in self._roots.values():
+            root.stop_event.set()
+            for subscriber in root.subscribers:
+                subscriber.close()
+
+    async def watch(  # type: ignore[override]
+        self,
+        path: Path | str,
+        stop_event: Event | None = None,
+    ) -> AsyncGenerator[set[FileChange], None]:
+        subscriber = _Subscriber(os.path.abspath(path), self._max_pending, self._exclude)
+        self._subscribe(subscriber)
+        if stop_event is not None:
+            self._task_group.start_soon(self._close_on_stop, subscriber, stop_event)
+        try:
+            while True:
+                changes = await subscriber.get()
+                if changes is None:
+                    return
+                yield changes
+        finally:
+            subscriber.cancel_scope.cancel()
+            self._unsubscribe(subscriber)
+
+    async def _close_on_stop(self, subscriber: _Subscriber, stop_event: Event) -> None:
+        with subscriber.cancel_scope:
+            await stop_event.wait()
+            subscriber.close()
+
+    def _subscribe(self, subscriber: _Subscriber) -> None:
+        for root in self._roots.values():
+            if self._shares_watch(subscriber.path, root.path):
+                root.subscribers.add(subscriber)
+                return
+
+        root = _Root(subscriber.path)
+        root.subscribers.add(subscriber)
+        for path in list(self._roots):
+            if self._shares_watch(path, root.path):
+                # the new root replaces the roots under it
+                logger.debug("Merging watched directory", path=path, into=root.path)
+                other_root = self._roots.pop(path)
+                other_root.stop_event.set()
+                root.subscribers |= other_root.subscribers
+        self._roots[root.path] = root
+        self._task_group.start_soon(self._watch_root, root)
+
+    def _unsubscribe(self, subscriber: _Subscriber) -> None:
+        for root in self._roots.values():
+            if subscriber in root.subscribers:
+                root.subscribers.remove(subscriber)
+                if not root.subscribers:
+                    del self._roots[root.path]
+                    root.stop_event.set()
+                return
+
+    def _shares_watch(self, path: str, root: str) -> bool:
+        # a path that the file watcher excludes under the root must have its own watch
+        return is_relative_to(path, root) and (
+            path == root or not self._root_exclude(os.path.relpath(path, root))
+        )
+
+    async def _watch_root(self, root: _Root) -> None:
+        logger.debug("Watching directory", path=root.path)
+        try:
+            async for changes in self._file_watcher.watch(  # type: ignore[attr-defined]
+                root.path, stop_event=root.stop_event
+            ):
+                for subscriber in root.subscribers:
+                    subscriber.publish(changes)
+        except Exception as exception:
+            logger.warning("Error watching directory", path=root.path, exc_info=exception)
+            if self._roots.get(root.path) is root:
+                del self._roots[root.path]
+            for subscriber in root.subscribers:
+                subscriber.close(exception)
+        logger.debug("Stopped watching directory", path=root.path)
+
+
+def merge_changes(merged: dict[str, Change], changes: set[FileChange]) -> dict[str, Change]:
+    """
+    Args:
+        merged: The merged changes, by path, in the order of their last change.
+        changes: The changes to merge into them.
+
+    Returns:
+        The merged changes.
+    """
+    for change, path in changes:
+        last_change = merged.pop(path, None)
+        if last_change == Change.added and change == Change.modified:
+            # the path is still new to the subscriber
+            change = Change.added
+        merged[path] = change
+    return merged
+
+
+def is_relative_to(path: str, root: str) -> bool:
+    prefix = root if root.endswith(os.sep) else root + os.sep
+    return path == root or path.startswith(prefix)
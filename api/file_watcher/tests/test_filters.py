@@ -0,0 +1,43 @@
+import pytest
+from jupyverse_file_watcher import PathFilter
+
+
+@pytest.mark.parametrize(
+    "patterns,path,excluded",
+    [
+        ([], "foo", False),
+        (["node_modules"], "node_modules", True),
+        (["node_modules"], "a/node_modules/b/c.js", True),
+        (["node_modules"], "node_modules_foo", False),
+        (["*.pyc"], "a/b.pyc", True),
+        (["*.pyc"], "a/b.py", False),
+        (["docs/_build"], "docs/_build/index.html", True),
+        (["docs/_build"], "a/docs/_build", False),
+        (["/build/"], "build/x", True),
+        (["/build/"], "a/build", False),
+        (["a/**/c"], "a/c", True),
+        (["a/**/c"], "a/b/b/c", True),
+        (["a/**"], "a/b", True),
+        (["file?.txt"], "file1.txt", True),
+        (["file[0-2].txt"], "file3.txt", False),
+        (["file[!0-2].txt"], "file3.txt", True),
+        ([".jupyter_ystore.db*"], ".jupyter_ystore.db-journal", True),
+        (["*.log", "!keep.log"], "keep.log", False),
+        (["*.log", "!keep.log"], "other.log", True),
+    ],
+)
+def test_path_filter(patterns, path, excluded):
+    assert PathFilter(patterns)(path) is excluded
+
+
+@pytest.mark.parametrize(
+    "patterns,unanchored_patterns",
+    [
+        (["node_modules", "*.pyc"], ["node_modules", "*.pyc"]),
+        (["node_modules", "/build", "docs/_build", "dist/"], ["node_modules", "dist/"]),
+        (["*.log", "!keep.log"], ["*.log", "!keep.log"]),
+        (["*.log", "!/logs/keep.log"], []),
+    ],
+)
+def test_path_filter_unanchored(patterns, unanchored_patterns):
+    assert PathFilter(patterns).unanchored().patterns == unanchored_patterns
@@ -0,0 +1,210 @@
+import os
+
+import pytest
+from anyio import (
+    Event,
+    create_memory_object_stream,
+    create_task_group,
+    fail_after,
+    wait_all_tasks_blocked,
+)
+from jupyverse_file_watcher import Change, FileWatcher, FileWatcherHub, PathFilter
+
+
+class FakeFileWatcher(FileWatcher):
+    def __init__(self):
+        self.watched = []
+        self.send_streams = {}
+
+    async def watch(self, path, stop_event=None):
+        self.watched.append(path)
+        send_stream, receive_stream = create_memory_object_stream(max_buffer_size=16)
+        self.send_streams[path] = send_stream
+        async with create_task_group() as tg:
+            tg.start_soon(self._close_on_stop, send_stream, stop_event)
+            async for changes in receive_stream:
+                yield changes
+
+    async def _close_on_stop(self, send_stream, stop_event):
+        await stop_event.wait()
+        await send_stream.aclose()
+
+    async def send(self, path, changes):
+        await self.send_streams[path].send(changes)
+
+
+@pytest.fixture
+def root(tmp_path):
+    return os.path.abspath(tmp_path)
+
+
+@pytest.mark.anyio
+async def test_hub(root):
+    file_watcher = FakeFileWatcher()
+    stop_event = Event()
+    sub_stop_event = Event()
+    received = {root: [], os.path.join(root, "sub"): []}
+
+    async def subscribe(path, stop_event=None):
+        async for changes in hub.watch(path, stop_event=stop_event):
+            received[path].append(changes)
+
+    with fail_after(5):
+        async with FileWatcherHub(file_watcher, stop_event) as hub:
+            async with create_task_group() as tg:
+                tg.start_soon(subscribe, os.path.join(root, "sub"), sub_stop_event)
+                await wait_all_tasks_blocked()
+                tg.start_soon(subscribe, root)
+                await wait_all_tasks_blocked()
+                # the parent directory watch replaces the subdirectory watch
+                assert hub.roots == [root]
+
+                # a subscriber only gets the changes under its path
+                await file_watcher.send(
+                    root,
+                    {
+                        (Change.added, os.path.join(root, "foo")),
+                        (Change.added, os.path.join(root, "sub", "bar")),
+                    },
+                )
+                await file_watcher.send(root, {(Change.deleted, os.path.join(root, "baz"))})
+                await wait_all_tasks_blocked()
+
+                # stopping a subscription doesn't stop the others
+                sub_stop_event.set()
+                await wait_all_tasks_blocked()
+                await file_watcher.send(root, {(Change.modified, os.path.join(root, "sub", "bar"))})
+                await wait_all_tasks_blocked()
+                stop_event.set()
+
+    assert file_watcher.watched == [os.path.join(root, "sub"), root]
+    assert received[root] == [
+        {
+            (Change.added, os.path.join(root, "foo")),
+            (Change.added, os.path.join(root, "sub", "bar")),
+        },
+        {(Change.deleted, os.path.join(root, "baz"))},
+        {(Change.modified, os.path.join(root, "sub", "bar"))},
+    ]
+    assert received[os.path.join(root, "sub")] == [
+        {(Change.added, os.path.join(root, "sub", "bar"))}
+    ]
+
+
+@pytest.mark.anyio
+async def test_hub_slow_subscriber(root):
+    file_watcher = FakeFileWatcher()
+    stop_event = Event()
+    received = []
+    next_changes = Event()
+
+    async def subscribe():
+        async for changes in hub.watch(root):
+            received.append(changes)
+            await next_changes.wait()
+
+    with fail_after(5):
+        async with FileWatcherHub(file_watcher, stop_event, max_pending=2) as hub:
+            async with create_task_group() as tg:
+                tg.start_soon(subscribe)
+                await wait_all_tasks_blocked()
+                for name in "abcd":
+                    await file_watcher.send(root, {(Change.added, os.path.join(root, name))})
+                    await wait_all_tasks_blocked()
+                next_changes.set()
+                await wait_all_tasks_blocked()
+                stop_event.set()
+
+    # the changes that didn't fit in the queue were merged
+    assert received == [
+        {(Change.added, os.path.join(root, "a"))},
+        {(Change.added, os.path.join(root, "b"))},
+        {(Change.added, os.path.join(root, "c")), (Change.added, os.path.join(root, "d"))},
+    ]
+
+
+@pytest.mark.anyio
+async def test_hub_slow_subscriber_order(root):
+    file_watcher = FakeFileWatcher()
+    stop_event = Event()
+    received = []
+    next_changes = Event()
+
+    async def subscribe():
+        async for changes in hub.watch(root):
+            received.append(changes)
+            await next_changes.wait()
+
+    with fail_after(5):
+        async with FileWatcherHub(file_watcher, stop_event, max_pending=1) as hub:
+            async with create_task_group() as tg:
+                tg.start_soon(subscribe)
+                await wait_all_tasks_blocked()
+                for changes in (
+                    {(Change.added, os.path.join(root, "a"))},
+                    {(Change.deleted, os.path.join(root, "b"))},
+                    {
+                        (Change.added, os.path.join(root, "b")),
+                        (Change.added, os.path.join(root, "c")),
+                    },
+                    {(Change.modified, os.path.join(root, "c"))},
+                    {(Change.modified, os.path.join(root, "d"))},
+                    {(Change.deleted, os.path.join(root, "d"))},
+                ):
+                    await file_watcher.send(root, changes)
+                    await wait_all_tasks_blocked()
+                next_changes.set()
+                await wait_all_tasks_blocked()
+                stop_event.set()
+
+    # the merged changes keep the last change of each path
+    assert received == [
+        {(Change.added, os.path.join(root, "a"))},
+        {
+            (Change.added, os.path.join(root, "b")),
+            (Change.added, os.path.join(root, "c")),
+            (Change.deleted, os.path.join(root, "d")),
+        },
+    ]
+
+
+@pytest.mark.anyio
+async def test_hub_exclude(root):
+    file_watcher = FakeFileWatcher()
+    stop_event = Event()
+    received = {root: [], os.path.join(root, "sub"): []}
+
+    async def subscribe(path):
+        async for changes in hub.watch(path):
+            received[path].append(changes)
+
+    exclude = PathFilter(["/build", "node_modules"])
+    with fail_after(5):
+        async with FileWatcherHub(file_watcher, stop_event, exclude=exclude) as hub:
+            async with create_task_group() as tg:
+                tg.start_soon(subscribe, os.path.join(root, "sub"))
+                await wait_all_tasks_blocked()
+                tg.start_soon(subscribe, root)
+                await wait_all_tasks_blocked()
+                assert hub.roots == [root]
+
+                await file_watcher.send(
+                    root,
+                    {
+                        (Change.added, os.path.join(root, "build", "a")),
+                        (Change.added, os.path.join(root, "sub", "build", "b")),
+                        (Change.added, os.path.join(root, "sub", "node_modules", "c")),
+                        (Change.added, os.path.join(root, "sub", "d")),
+                    },
+                )
+                await wait_all_tasks_blocked()
+                stop_event.set()
+
+    # the anchored patterns are relative to the subscribed path
+    assert received[root] == [
+        {
+            (Change.added, os.path.join(root, "sub", "build", "b")),
+            (Change.added, os.path.join(root, "sub", "d")),
+        },
+    ]
+    assert received[os.path.join(root, "sub")] == [{(Change.added, os.path.join(root, "sub", "d"))}]
@@ -33,6 +33,14 @@ class Yjs(Router, ABC):
         ):
             return await self.create_roomid(path, request, response, user)
 
+        @router.get("/api/collaboration/version/{room_id:path}")
+        async def get_version(
+            room_id: str,
+            timestamp: float,
+            user: User = Depends(auth.current_user(permissions={"yjs": ["read"]})),
+        ):
+            return await self.get_version(room_id, timestamp, user)
+
         self.include_router(router)
 
     @abstractmethod
@@ -51,6 +59,14 @@ class Yjs(Router, ABC):
         user: User,
     ): ...
 
+    @abstractmethod
+    async def get_version(
+        self,
+        room_id: str,
+        timestamp: float,
+        user: User,
+    ) -> Response: ...
+
     @abstractmethod
     async def get_room(
         self,
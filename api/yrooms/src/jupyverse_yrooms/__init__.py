@@ -1,10 +1,16 @@
 from importlib.metadata import version
 
+from .broker import Broker as Broker
+from .broker import BrokerChannel as BrokerChannel
+from .broker import UnixSocketBroker as UnixSocketBroker
 from .channel import AsyncChannel as AsyncChannel
 from .channel import AsyncWebSocket as AsyncWebSocket
 from .client import AsyncWebSocketClient as AsyncWebSocketClient
+from .server import EventStage as EventStage
+from .server import StageMetrics as StageMetrics
 from .server import YRoom as YRoom
 from .server import YRoomFactory as YRoomFactory
 from .server import YRooms as YRooms
+from .server import get_ystore_path as get_ystore_path
 
 __version__ = version(__package__)
@@ -0,0 +1,283 @@
+import struct
+import sys
+from abc import ABC, abstractmethod
+from collections import defaultdict
+from collections.abc import AsyncGenerator
+from contextlib import AbstractAsyncContextManager, asynccontextmanager
+from pathlib import Path
+
+from anyio import (
+    AsyncContextManagerMixin,
+    BrokenResourceError,
+    CancelScope,
+    ClosedResourceError,
+    EndOfStream,
+    IncompleteRead,
+    Lock,
+    connect_unix,
+    create_memory_object_stream,
+    create_task_group,
+    create_unix_listener,
+    fail_after,
+    sleep,
+)
+from anyio.abc import ByteStream, TaskStatus
+from anyio.streams.buffered import BufferedByteReceiveStream
+from anyio.streams.memory import MemoryObjectReceiveStream, MemoryObjectSendStream
+
+from .channel import AsyncChannel
+
+if sys.version_info >= (3, 11):
+    from typing import Self
+else:
+    from typing_extensions import Self
+
+# a frame is a header followed by the topic and the message
+# header: operation, topic length, message length
+HEADER = struct.Struct("<BHI")
+SUBSCRIBE = 0
+UNSUBSCRIBE = 1
+PUBLISH = 2
+
+
+class Broker(ABC):
+    """A publish/subscribe broker relaying messages between processes.
+
+    Messages published on a topic are received by all the subscriptions to this topic,
+    in any process connected to the broker, in the order they were published.
+    """
+
+    @abstractmethod
+    async def publish(self, topic: str, message: bytes) -> None:
+        """Publishes a message on a topic.
+
+        Args:
+            topic: The topic of the message.
+            message: The message to publish.
+        """
+        ...
+
+    @abstractmethod
+    def subscribe(
+        self, topic: str
+    ) -> AbstractAsyncContextManager[MemoryObjectReceiveStream[bytes]]:
+        """Subscribes to a topic. The messages published once the context manager is
+        entered are received from the stream it returns, until it exits.
+
+        Args:
+            topic: The topic to subscribe to.
+        """
+        ...
+
+
+class BrokerChannel(AsyncChannel):
+    """A channel to a peer through a broker. An empty message closes the channel."""
+
+    def __init__(
+        self,
+        id: str,
+        broker: Broker,
+        topic: str,
+        messages: MemoryObjectReceiveStream[bytes],
+    ) -> None:
+        """
+        Args:
+            id: The channel ID.
+            broker: The broker to send messages through.
+            topic: The topic on which messages are sent to the peer.
+            messages: The messages received from the peer.
+        """
+        self._id = id
+        self._broker = broker
+        self._topic = topic
+        self._messages = messages
+        self._first_message: bytes | None = None
+
+    async def __anext__(self) -> bytes:
+        try:
+            message = await self.receive()
+        except Exception:
+            raise StopAsyncIteration()
+
+        return message
+
+    @property
+    def id(self) -> str:
+        return self._id
+
+    async def send(self, message: bytes) -> None:
+        await self._broker.publish(self._topic, message)
+
+    async def wait(self) -> None:
+        """Waits for the first message from the peer, which is then received first."""
+        if self._first_message is None:
+            self._first_message = await self._messages.receive()
+
+    async def receive(self) -> bytes:
+        if self._first_message is not None:
+            message, self._first_message = self._first_message, None
+        else:
+            message = await self._messages.receive()
+        if not message:
+            raise EndOfStream
+        return message
+
+
+class _Connection:
+    def __init__(self, stream: ByteStream) -> None:
+        self.stream = stream
+        self.lock = Lock()
+
+    async def send(self, frame: bytes) -> None:
+        async with self.lock:
+            await self.stream.send(frame)
+
+
+class UnixSocketBroker(Broker, AsyncContextManagerMixin):
+    """A broker for the processes of a single machine, connected to a hub through a
+    Unix socket.
+
+    One of the processes hosts the hub, which forwards the messages published by a
+    process to the processes subscribed to their topic. The other processes wait for the
+    hub to be listening when they connect.
+
+    Unix sockets are not available on Windows, where the broker cannot be used.
+    """
+
+    def __init__(self, path: str, hub: bool = False, connect_timeout: float = 10) -> None:
+        """
+        Args:
+            path: The path of the Unix socket.
+            hub: Whether to host the hub in this process.
+            connect_timeout: The time (in seconds) to wait for the hub to be listening.
+        """
+        if sys.platform == "win32":
+            raise RuntimeError("UnixSocketBroker is not supported on Windows")
+        self._path = Path(path)
+        self._hub = hub
+        self._connect_timeout = connect_timeout
+        self._subscriptions: defaultdict[str, set[MemoryObjectSendStream[bytes]]] = defaultdict(set)
+        self._hub_subscriptions: defaultdict[str, set[_Connection]] = defaultdict(set)
+
+    @asynccontextmanager
+    async def __asynccontextmanager__(self) -> AsyncGenerator[Self]:
+        async with create_task_group() as tg:
+            if self._hub:
+                await tg.start(self._serve)
+            with fail_after(self._connect_timeout):
+                while True:
+                    try:
+                        stream = await connect_unix(self._path)
+                    except OSError:
+                        # the hub is not listening yet
+                        await sleep(0.1)
+                    else:
+                        break
+            async with stream:
+                self._connection = _Connection(stream)
+                tg.start_soon(self._receive, stream)
+                yield self
+                tg.cancel_scope.cancel()
+
+    async def publish(self, topic: str, message: bytes) -> None:
+        await self._connection.send(encode_frame(PUBLISH, topic, message))
+
+    @asynccontextmanager
+    async def subscribe(self, topic: str) -> AsyncGenerator[MemoryObjectReceiveStream[bytes]]:
+        send_stream, receive_stream = create_memory_object_stream[bytes](
+            max_buffer_size=float("inf")
+        )
+        async with self._connection.lock:
+            # the hub forwards the messages published after it receives the subscription
+            if not self._subscriptions[topic]:
+                await self._connection.stream.send(encode_frame(SUBSCRIBE, topic))
+            self._subscriptions[topic].add(send_stream)
+        try:
+            async with receive_stream:
+                yield receive_stream
+        finally:
+            send_stream.close()
+            with CancelScope(shield=True):
+                async with self._connection.lock:
+                    send_streams = self._subscriptions[topic]
+                    send_streams.discard(send_stream)
+                    if not send_streams:
+                        del self._subscriptions[topic]
+                        try:
+                            await self._connection.stream.send(encode_frame(UNSUBSCRIBE, topic))
+                        except (BrokenResourceError, ClosedResourceError):
+                            # the hub is gone
+                            pass
+
+    async def _receive(self, stream: ByteStream) -> None:
+        buffered_stream = BufferedByteReceiveStream(stream)
+        try:
+            while True:
+                _, topic, message = await read_frame(buffered_stream)
+                for send_stream in list(self._subscriptions.get(topic, ())):
+                    try:
+                        send_stream.send_nowait(message)
+                    except (BrokenResourceError, ClosedResourceError):
+                        pass
+        except (EndOfStream, IncompleteRead, BrokenResourceError, ClosedResourceError):
+            # the connection to the hub is closed
+            pass
+
+    async def _serve(self, *, task_status: TaskStatus[None]) -> None:
+        # a socket left by a previous hub is replaced
+        self._path.unlink(missing_ok=True)
+        listener = await create_unix_listener(self._path)
+        task_status.started()
+        try:
+            async with listener:
+                await listener.serve(self._handle)
+        finally:
+            self._path.unlink(missing_ok=True)
+
+    async def _handle(self, stream: ByteStream) -> None:
+        connection = _Connection(stream)
+        topics: set[str] = set()
+        buffered_stream = BufferedByteReceiveStream(stream)
+        try:
+            async with stream:
+                while True:
+                    operation, topic, message = await read_frame(buffered_stream)
+                    if operation == SUBSCRIBE:
+                        self._hub_subscriptions[topic].add(connection)
+                        topics.add(topic)
+                    elif operation == UNSUBSCRIBE:
+                        self._discard(topic, connection)
+                        topics.discard(topic)
+                    else:
+                        frame = encode_frame(PUBLISH, topic, message)
+                        for subscriber in list(self._hub_subscriptions.get(topic, ())):
+                            try:
+                                await subscriber.send(frame)
+                            except (BrokenResourceError, ClosedResourceError):
+                                pass
+        except (EndOfStream, IncompleteRead, BrokenResourceError, ClosedResourceError):
+            pass
+        finally:
+            for topic in topics:
+                self._discard(topic, connection)
+
+    def _discard(self, topic: str, connection: _Connection) -> None:
+        connections = self._hub_subscriptions.get(topic)
+        if connections is not None:
+            connections.discard(connection)
+            if not connections:
+                del self._hub_subscriptions[topic]
+
+
+def encode_frame(operation: int, topic: str, message: bytes = b"") -> bytes:
+    encoded_topic = topic.encode()
+    return HEADER.pack(operation, len(encoded_topic), len(message)) + encoded_topic + message
+
+
+async def read_frame(stream: BufferedByteReceiveStream) -> tuple[int, str, bytes]:
+    operation, topic_length, message_length = HEADER.unpack(
+        await stream.receive_exactly(HEADER.size)
+    )
+    topic = (await stream.receive_exactly(topic_length)).decode()
+    message = await stream.receive_exactly(message_length) if message_length else b""
+    return operation, topic, message
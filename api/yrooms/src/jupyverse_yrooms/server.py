@@ -1,50 +1,231 @@
+import json
 import sys
+import zlib
 from abc import ABC, abstractmethod
-from collections.abc import AsyncGenerator, Callable
-from contextlib import asynccontextmanager
+from collections import defaultdict
+from collections.abc import AsyncGenerator, Callable, Iterator
+from contextlib import AsyncExitStack, asynccontextmanager, contextmanager
 from functools import partial
 from typing import TYPE_CHECKING, Any
+from uuid import uuid4
 
 from anyio import (
     AsyncContextManagerMixin,
+    BrokenResourceError,
+    CancelScope,
     Event,
+    Lock,
+    WouldBlock,
+    create_memory_object_stream,
     create_task_group,
+    current_time,
+    fail_after,
+    sleep,
 )
 from anyio.abc import TaskGroup, TaskStatus
+from anyio.streams.memory import MemoryObjectReceiveStream, MemoryObjectSendStream
 from anyioutils import ResourceLock
 from pycrdt import (
+    Decoder,
     Doc,
+    Encoder,
+    TransactionEvent,
+    YMessageType,
+    YSyncMessageType,
+    create_awareness_message,
     create_sync_message,
     create_update_message,
+    handle_sync_message,
+    merge_updates,
+    read_message,
+    write_message,
 )
 
+from .broker import Broker, BrokerChannel
 from .channel import AsyncChannel
 
 if TYPE_CHECKING:
     from jupyter_ydoc.ybasedoc import YBaseDoc
+    from jupyverse_ystore import YStoreFactory
 
 if sys.version_info >= (3, 11):
     from typing import Self
 else:
     from typing_extensions import Self
 
+# the state of a client that has no content yet
+EMPTY_STATE = Doc().get_state()
+# the time (in seconds) to wait for the worker owning a room to serve a replica
+CONNECT_TIMEOUT = 10
+
+
+class _SendQueue:
+    def __init__(self, max_size: int) -> None:
+        # the messages are queued with the timestamps of the document updates they carry
+        self.send_stream: MemoryObjectSendStream[tuple[tuple[float, ...], bytes]]
+        self.receive_stream: MemoryObjectReceiveStream[tuple[tuple[float, ...], bytes]]
+        self.send_stream, self.receive_stream = create_memory_object_stream[
+            tuple[tuple[float, ...], bytes]
+        ](max_buffer_size=max_size)
+        self.overflow = False
+
+
+class StageMetrics:
+    """The metrics of a stage of a room's event pipeline."""
+
+    def __init__(self) -> None:
+        self.dispatched = 0
+        self.events = 0
+        self.lag = 0.0
+        self.max_lag = 0.0
+
+    def record(self, timestamp: float) -> None:
+        """
+        Records that an update was handled by the stage.
+
+        Args:
+            timestamp: The time at which the update was dispatched.
+        """
+        self.events += 1
+        self.lag = current_time() - timestamp
+        self.max_lag = max(self.max_lag, self.lag)
+
+
+class EventStage:
+    """A stage of a room's event pipeline, receiving the document updates in order."""
+
+    def __init__(self, name: str, metrics: StageMetrics) -> None:
+        self.name = name
+        self.metrics = metrics
+        self.send_stream: MemoryObjectSendStream[tuple[float, bytes]]
+        self.receive_stream: MemoryObjectReceiveStream[tuple[float, bytes]]
+        self.send_stream, self.receive_stream = create_memory_object_stream[tuple[float, bytes]](
+            max_buffer_size=float("inf")
+        )
+
+    @property
+    def pending(self) -> int:
+        """
+        Returns:
+            The number of updates waiting to be handled by the stage.
+        """
+        return self.receive_stream.statistics().current_buffer_used
+
+    def dispatch(self, timestamp: float, update: bytes) -> None:
+        """
+        Sends a document update to the stage.
+
+        Args:
+            timestamp: The time at which the update is dispatched.
+            update: The document update.
+        """
+        self.metrics.dispatched += 1
+        self.send_stream.send_nowait((timestamp, update))
+
+    async def receive(self) -> bytes:
+        """
+        Returns:
+            The next document update.
+        """
+        timestamp, update = await self.receive_stream.receive()
+        self.metrics.record(timestamp)
+        return update
+
+    def receive_pending(self) -> list[bytes]:
+        """
+        Returns:
+            The document updates waiting to be handled, without waiting for new ones.
+        """
+        updates = []
+        for _ in range(self.pending):
+            timestamp, update = self.receive_stream.receive_nowait()
+            self.metrics.record(timestamp)
+            updates.append(update)
+        return updates
+
+    def __aiter__(self) -> "EventStage":
+        return self
+
+    async def __anext__(self) -> bytes:
+        try:
+            return await self.receive()
+        except Exception:
+            raise StopAsyncIteration()
+
 
 class YRoom(ABC, AsyncContextManagerMixin):
     _jupyter_ydoc: "YBaseDoc"
 
-    def __init__(self, id: str, sync: bool = True, doc: Doc | None = None) -> None:
+    def __init__(
+        self,
+        id: str,
+        sync: bool = True,
+        doc: Doc | None = None,
+        send_queue_size: int = 256,
+        coalescing_window: float = 0,
+        hibernation_delay: float = 0,
+        upstream: AsyncChannel | None = None,
+        awareness_interval: float = 0,
+    ) -> None:
         """
         Creates a new room in which clients with the same ID will be connected.
 
+        Messages are sent to each client from a bounded queue, so that a slow client
+        doesn't delay the other clients. When the queue of a client overflows, the
+        messages that don't fit are dropped and the client is resynchronized with the
+        whole document once its queue is drained.
+
+        A room with an upstream channel is a replica of the room owning the document in
+        another process: its document and the awareness of its clients are synchronized
+        with it as a client. The replica is closed if the upstream channel is closed.
+
         Args:
             id: The room ID.
             sync: Whether to start synchronizing clients right away.
+            send_queue_size: The maximum number of messages queued for each client.
+            coalescing_window: The time (in seconds) during which document updates are
+                merged before being broadcast, or 0 to broadcast every update right away.
+            hibernation_delay: The time (in seconds) without sync messages from the
+                clients and without document changes after which the room hibernates, or 0
+                to never hibernate. A room created with a document never hibernates, and
+                the awareness messages are processed without waking the room up.
+            upstream: The channel to the room owning the document, if this room is a
+                replica. A replica never hibernates.
+            awareness_interval: The time (in seconds) during which the awareness updates
+                of the clients are merged before being sent, or 0 to send them right away.
         """
         self._id = id
         self._sync = sync
         self._doc: Doc = Doc() if doc is None else doc
         self._clients: set[AsyncChannel] = set()
+        self._send_queue_size = send_queue_size
+        self._send_queues: dict[AsyncChannel, _SendQueue] = {}
+        self._coalescing_window = coalescing_window
+        self._pending_updates: list[tuple[float, bytes]] = []
+        self._stages: dict[str, EventStage] = {}
+        self._metrics: defaultdict[str, StageMetrics] = defaultdict(StageMetrics)
+        # the sync messages encoding the whole document, until it changes
+        self._cached_messages: dict[YSyncMessageType, bytes] = {}
         self._close_event = Event()
+        self._upstream = upstream
+        self._hibernation_delay = (
+            0 if doc is not None or upstream is not None else hibernation_delay
+        )
+        self._hibernation_lock = Lock()
+        self._hibernated = False
+        self._hibernated_state = b""
+        self._woken = Event()
+        self._last_activity = current_time()
+        self._awareness_interval = awareness_interval
+        # the clocks and states of the awareness clients
+        self._awareness_clocks: dict[int, int] = {}
+        self._awareness_states: dict[int, str] = {}
+        # the awareness clients of each client
+        self._awareness_clients: dict[AsyncChannel, set[int]] = {}
+        # the awareness clients changed since the last awareness update was sent,
+        # and the client the change came from
+        self._pending_awareness: dict[int, AsyncChannel | None] = {}
+        self._awareness_update_scheduled = False
 
     @property
     def clients(self) -> set[AsyncChannel]:
@@ -54,6 +235,31 @@ class YRoom(ABC, AsyncContextManagerMixin):
     def synced(self) -> bool:
         return self._sync
 
+    @property
+    def hibernated(self) -> bool:
+        """
+        Returns:
+            Whether the room is hibernating, i.e. its document is released.
+        """
+        return self._hibernated
+
+    @property
+    def upstream(self) -> AsyncChannel | None:
+        """
+        Returns:
+            The channel to the room owning the document, if this room is a replica.
+        """
+        return self._upstream
+
+    @property
+    def metrics(self) -> dict[str, StageMetrics]:
+        """
+        Returns:
+            The metrics of the stages of the room's event pipeline, by stage name. The
+                "broadcast" metrics record the delivery of the updates to each client.
+        """
+        return dict(self._metrics)
+
     @property
     def id(self) -> str:
         """
@@ -89,8 +295,12 @@ class YRoom(ABC, AsyncContextManagerMixin):
     @asynccontextmanager
     async def __asynccontextmanager__(self) -> AsyncGenerator[Self]:
         async with create_task_group() as self._task_group:
+            if self._upstream is not None:
+                await self._task_group.start(self._sync_upstream)
             if self._sync:
-                await self._task_group.start(self.run)
+                await self._task_group.start(self._run)
+            if self._hibernation_delay:
+                self._task_group.start_soon(self._hibernate_when_idle)
             yield self
             await self._close_event.wait()
             self._task_group.cancel_scope.cancel()
@@ -98,12 +308,62 @@ class YRoom(ABC, AsyncContextManagerMixin):
     async def sync(self):
         if not self._sync:
             self._sync = True
-            await self._task_group.start(self.run)
+            await self._task_group.start(self._run)
+
+    async def _sync_upstream(self, *, task_status: TaskStatus[None]) -> None:
+        upstream = self._upstream
+        assert upstream is not None
+        send_queue = self._send_queues[upstream] = _SendQueue(self._send_queue_size)
+        # the updates that come from the upstream room are not sent back to it
+        from_upstream = False
+
+        def send_update(event: TransactionEvent) -> None:
+            if not from_upstream:
+                self.send(upstream, create_update_message(event.update))
+
+        subscription = self._doc.observe(send_update)
+        try:
+            async with create_task_group() as tg:
+                tg.start_soon(self._send_messages, upstream, send_queue)
+                async with self._doc.new_transaction():
+                    sync_message = create_sync_message(self._doc)
+                self.send(upstream, sync_message)
+                synced = False
+                async for message in upstream:
+                    if message[0] == YMessageType.SYNC:
+                        from_upstream = True
+                        try:
+                            reply = handle_sync_message(message[1:], self._doc)
+                        finally:
+                            from_upstream = False
+                        if reply is not None:
+                            self.send(upstream, reply)
+                        if message[1] == YSyncMessageType.SYNC_STEP2 and not synced:
+                            synced = True
+                            task_status.started()
+                    elif message[0] == YMessageType.AWARENESS:
+                        self.handle_awareness_message(message, upstream)
+                tg.cancel_scope.cancel()
+        finally:
+            self._doc.unobserve(subscription)
+            self._send_queues.pop(upstream, None)
+        # the upstream room is lost, the clients are disconnected so that they reconnect
+        # to a new replica
+        self._close_event.set()
+
+    async def _run(self, *, task_status: TaskStatus[None]) -> None:
+        self._run_stopped = Event()
+        try:
+            with CancelScope() as self._run_cancel_scope:
+                await self.run(task_status=task_status)
+        finally:
+            self._run_stopped.set()
 
     async def run(self, *, task_status: TaskStatus[None]) -> None:
         """
         The main background task which is responsible for forwarding every update
-        from a client to all other clients in the room.
+        from a client to all other clients in the room, and then to the other stages of
+        the room's event pipeline (see `event_stage()`).
 
         Args:
             task_status: The task status that is set when the task has started.
@@ -111,13 +371,292 @@ class YRoom(ABC, AsyncContextManagerMixin):
         async with self._doc.events() as events:
             task_status.started()
             async for event in events:
+                timestamp = current_time()
+                self._last_activity = timestamp
+                self._cached_messages.clear()
                 if self._clients:
-                    message = create_update_message(event.update)
-                    for client in set(self._clients):
-                        try:
-                            await client.send(message)
-                        except Exception:
-                            await self._remove_client(client)
+                    if not self._coalescing_window:
+                        self.broadcast(create_update_message(event.update), timestamps=(timestamp,))
+                    else:
+                        self._pending_updates.append((timestamp, event.update))
+                        if len(self._pending_updates) == 1:
+                            self._task_group.start_soon(self._broadcast_pending_updates)
+                for stage in self._stages.values():
+                    stage.dispatch(timestamp, event.update)
+
+    @contextmanager
+    def event_stage(self, name: str) -> Iterator[EventStage]:
+        """
+        Adds a stage to the room's event pipeline. The document updates are received
+        from a single subscription to the document events, and dispatched to the stages
+        in the order they were added, after being broadcast to the clients.
+
+        Args:
+            name: The name of the stage, under which its metrics are recorded.
+
+        Returns:
+            The stage, from which the updates are received while it is used.
+        """
+        stage = self._stages[name] = EventStage(name, self._metrics[name])
+        try:
+            yield stage
+        finally:
+            if self._stages.get(name) is stage:
+                del self._stages[name]
+            stage.send_stream.close()
+            stage.receive_stream.close()
+
+    async def hibernate(self) -> None:
+        """
+        Releases the room's document, after it is persisted with `flush()`. The clients
+        stay connected, and the document is restored when the room is woken up, e.g. by
+        a message from a client.
+
+        The room doesn't hibernate while messages are waiting to be sent, or if the
+        document could not be persisted.
+        """
+        async with self._hibernation_lock:
+            if self._hibernated or not self._sync or not self._is_idle():
+                return
+            # the messages of the clients now wait for the room to wake up
+            self._hibernated = True
+            state = self._doc.get_state()
+            if not await self.flush() or self._doc.get_state() != state:
+                # the document was not persisted, or it changed in the meantime
+                self._hibernated = False
+                return
+            self._hibernated_state = state
+            self._woken = Event()
+            self._run_cancel_scope.cancel()
+            await self._run_stopped.wait()
+            self._doc = Doc()
+            self._cached_messages.clear()
+            if hasattr(self, "_jupyter_ydoc"):
+                del self._jupyter_ydoc
+
+    async def wake(self) -> None:
+        """
+        Restores the room's document if the room is hibernating, and sends the clients
+        the changes to the document since it was released, if any.
+        """
+        async with self._hibernation_lock:
+            self._last_activity = current_time()
+            if not self._hibernated:
+                return
+            await self._task_group.start(self._run)
+            self._cached_messages.clear()
+            self._hibernated = False
+            self._woken.set()
+            async with self._doc.new_transaction():
+                update = self._doc.get_update(self._hibernated_state)
+            self.broadcast(create_update_message(update))
+
+    async def flush(self) -> bool:
+        """
+        Called before the room's document is released when the room hibernates.
+
+        Returns:
+            Whether the document was persisted, so that it can be restored when the room
+            is woken up. The room only hibernates if it was.
+        """
+        return False
+
+    def _is_idle(self) -> bool:
+        return not self._pending_updates and all(
+            not send_queue.overflow
+            and not send_queue.receive_stream.statistics().current_buffer_used
+            for send_queue in self._send_queues.values()
+        )
+
+    async def _hibernate_when_idle(self) -> None:
+        while True:
+            idle_time = current_time() - self._last_activity
+            if idle_time < self._hibernation_delay:
+                await sleep(self._hibernation_delay - idle_time)
+                continue
+            await self.hibernate()
+            if self._hibernated:
+                await self._woken.wait()
+            else:
+                # try again later
+                self._last_activity = current_time()
+
+    async def handle_sync_message(self, message: bytes) -> bytes | None:
+        """
+        Processes a synchronization message on the room's document, like
+        `pycrdt.handle_sync_message()`. The reply to a client that has no content yet
+        is shared with the other such clients, until the document changes.
+
+        Args:
+            message: The synchronization message, without its message type.
+
+        Returns:
+            The SYNC_STEP2 reply message, if the message was a SYNC_STEP1.
+        """
+        if message[0] == YSyncMessageType.SYNC_STEP1 and read_message(message[1:]) == EMPTY_STATE:
+            return await self.get_cached_message(YSyncMessageType.SYNC_STEP2)
+        return handle_sync_message(message, self._doc)
+
+    async def get_cached_message(self, message_type: YSyncMessageType) -> bytes:
+        """
+        Returns a sync message for the current state of the room's document. The
+        message is encoded once, and cached until the document changes.
+
+        Args:
+            message_type: The type of the message: SYNC_STEP1 for the state vector of the
+                document, SYNC_STEP2 or SYNC_UPDATE for the whole document.
+
+        Returns:
+            The sync message.
+        """
+        message = self._cached_messages.get(message_type)
+        if message is None:
+            async with self._doc.new_transaction():
+                if message_type == YSyncMessageType.SYNC_STEP1:
+                    message = create_sync_message(self._doc)
+                else:
+                    data = write_message(self._doc.get_update())
+                    message = bytes([YMessageType.SYNC, message_type]) + data
+            self._cached_messages[message_type] = message
+        return message
+
+    def handle_awareness_message(self, message: bytes, client: AsyncChannel) -> None:
+        """
+        Processes an awareness message from a client. The awareness states are tracked,
+        so that the changes that are already known are dropped. The changes are sent to
+        the other clients, merged with the changes received during the awareness
+        interval.
+
+        Args:
+            message: The awareness message.
+            client: The client that sent the message.
+        """
+        decoder = Decoder(read_message(message[1:]))
+        changed = False
+        for _ in range(decoder.read_var_uint()):
+            client_id = decoder.read_var_uint()
+            clock = decoder.read_var_uint()
+            state = decoder.read_var_string()
+            current_clock = self._awareness_clocks.get(client_id, 0)
+            removed = state in ("", "null")
+            if current_clock < clock or (
+                current_clock == clock and removed and client_id in self._awareness_states
+            ):
+                self._awareness_clocks[client_id] = clock
+                if removed:
+                    self._awareness_states.pop(client_id, None)
+                    self._awareness_clients.get(client, set()).discard(client_id)
+                else:
+                    self._awareness_states[client_id] = state
+                    self._awareness_clients.setdefault(client, set()).add(client_id)
+                self._pending_awareness[client_id] = client
+                changed = True
+        if changed:
+            self._schedule_awareness_update()
+
+    def _schedule_awareness_update(self) -> None:
+        if not self._awareness_interval:
+            self._send_awareness_update()
+        elif not self._awareness_update_scheduled:
+            self._awareness_update_scheduled = True
+            self._task_group.start_soon(self._send_awareness_update_later)
+
+    async def _send_awareness_update_later(self) -> None:
+        await sleep(self._awareness_interval)
+        self._awareness_update_scheduled = False
+        self._send_awareness_update()
+
+    def _send_awareness_update(self) -> None:
+        pending_awareness = self._pending_awareness
+        self._pending_awareness = {}
+        if not pending_awareness:
+            return
+        message = self._create_awareness_message(list(pending_awareness))
+        recipients = list(self._clients)
+        if self._upstream is not None:
+            # the changes are also relayed to the room owning the document
+            recipients.append(self._upstream)
+        for client in recipients:
+            # a client is not sent its own changes
+            client_ids = [
+                client_id for client_id, origin in pending_awareness.items() if origin is not client
+            ]
+            if len(client_ids) == len(pending_awareness):
+                self.send(client, message)
+            elif client_ids:
+                self.send(client, self._create_awareness_message(client_ids))
+        # the clock of a removed state is only kept until its removal is sent
+        for client_id in pending_awareness:
+            if client_id not in self._awareness_states:
+                del self._awareness_clocks[client_id]
+
+    def _create_awareness_message(self, client_ids: list[int]) -> bytes:
+        encoder = Encoder()
+        encoder.write_var_uint(len(client_ids))
+        for client_id in client_ids:
+            encoder.write_var_uint(client_id)
+            encoder.write_var_uint(self._awareness_clocks[client_id])
+            encoder.write_var_string(self._awareness_states.get(client_id, "null"))
+        return create_awareness_message(encoder.to_bytes())
+
+    async def _broadcast_pending_updates(self) -> None:
+        await sleep(self._coalescing_window)
+        update = merge_updates(*(update for _, update in self._pending_updates))
+        timestamps = tuple(timestamp for timestamp, _ in self._pending_updates)
+        self.broadcast(create_update_message(update), timestamps=timestamps)
+        self._pending_updates.clear()
+
+    def send(
+        self, client: AsyncChannel, message: bytes, timestamps: tuple[float, ...] = ()
+    ) -> None:
+        """
+        Queues a message to be sent to a client, without waiting for it to be sent.
+
+        Args:
+            client: The client to send the message to.
+            message: The message to send.
+            timestamps: The times at which the document updates carried by the message
+                were dispatched, if any. The lag of their delivery is recorded in the
+                "broadcast" metrics when the message is sent.
+        """
+        send_queue = self._send_queues.get(client)
+        if send_queue is None or send_queue.overflow:
+            return
+        try:
+            send_queue.send_stream.send_nowait((timestamps, message))
+        except WouldBlock:
+            send_queue.overflow = True
+            self.on_overflow(client)
+        except BrokenResourceError:
+            # the client is disconnecting
+            pass
+
+    def broadcast(
+        self,
+        message: bytes,
+        exclude: AsyncChannel | None = None,
+        timestamps: tuple[float, ...] = (),
+    ) -> None:
+        """
+        Queues a message to be sent to all the clients of the room.
+
+        Args:
+            message: The message to send.
+            exclude: An optional client not to send the message to.
+            timestamps: The times at which the document updates carried by the message
+                were dispatched, if any (see `send()`).
+        """
+        for client in self._clients:
+            if client is not exclude:
+                self.send(client, message, timestamps)
+
+    def on_overflow(self, client: AsyncChannel) -> None:
+        """
+        Called when the send queue of a client overflows.
+
+        Args:
+            client: The client that doesn't keep up.
+        """
 
     async def serve(self, client: AsyncChannel) -> None:
         """
@@ -127,20 +666,74 @@ class YRoom(ABC, AsyncContextManagerMixin):
         Args:
             client: The client making the connection.
         """
+        if self._hibernated:
+            await self.wake()
+        send_queue = self._send_queues[client] = _SendQueue(self._send_queue_size)
         self._clients.add(client)
         try:
-            async with self._doc.new_transaction():
-                sync_message = create_sync_message(self._doc)
-            await client.send(sync_message)
-            async for message in client:
-                await self.handle_message(message, client)
+            async with create_task_group() as tg:
+                tg.start_soon(self._send_messages, client, send_queue)
+                tg.start_soon(self._disconnect_on_close, tg.cancel_scope)
+                sync_message = await self.get_cached_message(YSyncMessageType.SYNC_STEP1)
+                self.send(client, sync_message)
+                if self._awareness_states:
+                    awareness_message = self._create_awareness_message(list(self._awareness_states))
+                    self.send(client, awareness_message)
+                async for message in client:
+                    # only the document messages keep the room awake, the awareness
+                    # doesn't need the document
+                    if message[0] == YMessageType.SYNC:
+                        self._last_activity = current_time()
+                        if self._hibernated:
+                            await self.wake()
+                    await self.handle_message(message, client)
+                tg.cancel_scope.cancel()
         except Exception:
             pass
         finally:
             await self._remove_client(client)
 
+    async def _disconnect_on_close(self, cancel_scope: CancelScope) -> None:
+        await self._close_event.wait()
+        cancel_scope.cancel()
+
+    async def _send_messages(self, client: AsyncChannel, send_queue: _SendQueue) -> None:
+        try:
+            async with send_queue.receive_stream:
+                async for timestamps, message in send_queue.receive_stream:
+                    await client.send(message)
+                    for timestamp in timestamps:
+                        self._metrics["broadcast"].record(timestamp)
+                    if (
+                        send_queue.overflow
+                        and not send_queue.receive_stream.statistics().current_buffer_used
+                    ):
+                        # the messages that were dropped are all in the current state
+                        message = await self.get_cached_message(YSyncMessageType.SYNC_UPDATE)
+                        send_queue.overflow = False
+                        send_queue.send_stream.send_nowait(((), message))
+        except Exception:
+            await self._remove_client(client)
+
     async def _remove_client(self, client: AsyncChannel) -> None:
+        if client not in self._clients:
+            return
         self._clients.discard(client)
+        send_queue = self._send_queues.pop(client, None)
+        if send_queue is not None:
+            send_queue.send_stream.close()
+        # the awareness states of a client are removed when it disconnects
+        removed = False
+        for client_id in self._awareness_clients.pop(client, set()):
+            if client_id in self._awareness_states:
+                del self._awareness_states[client_id]
+                self._awareness_clocks[client_id] += 1
+                self._pending_awareness[client_id] = None
+                removed = True
+        if self._close_event.is_set():
+            return
+        if removed:
+            self._schedule_awareness_update()
         if not self._clients:
             self.task_group.start_soon(self.close)
 
@@ -151,9 +744,44 @@ class YRoom(ABC, AsyncContextManagerMixin):
     async def handle_message(self, message: bytes, client: AsyncChannel) -> None: ...
 
 
+def get_ystore_path(room_id: str) -> str | None:
+    """
+    Args:
+        room_id: The room ID.
+
+    Returns:
+        The path of the room's document in a YStore, if the room is a stored document,
+        i.e. its ID is "format:type:file_id".
+    """
+    if room_id.count(":") < 2:
+        return None
+    _, file_type, file_id = room_id.split(":", 2)
+    return f".{file_type}:{file_id}.y"
+
+
 class YRoomFactory:
-    def __init__(self, yroom_factory: type[YRoom]) -> None:
+    def __init__(
+        self,
+        yroom_factory: type[YRoom],
+        broker: Broker | None = None,
+        worker: int = 0,
+        workers: int = 1,
+        ystore_factory: "YStoreFactory | None" = None,
+    ) -> None:
+        """
+        Args:
+            yroom_factory: The factory of the rooms.
+            broker: The broker connecting the workers, if there are several ones.
+            worker: The index of this worker.
+            workers: The number of workers.
+            ystore_factory: The factory of the YStores the rooms store their documents in,
+                if any (see `get_ystore_path()`).
+        """
         self._yroom_factory = yroom_factory
+        self.broker = broker
+        self.worker = worker
+        self.workers = workers
+        self.ystore_factory = ystore_factory
 
     def __call__(self, *args: Any, **kwargs: Any) -> YRoom:
         return self._yroom_factory(*args, **kwargs)
@@ -161,10 +789,35 @@ class YRoomFactory:
 
 class YRooms(AsyncContextManagerMixin):
     def __init__(
-        self, room_factory: Callable[[str], YRoom] = YRoom, stop_event: Event | None = None
+        self,
+        room_factory: Callable[[str], YRoom] = YRoom,
+        stop_event: Event | None = None,
+        broker: Broker | None = None,
+        worker: int = 0,
+        workers: int = 1,
     ) -> None:
+        """
+        Creates the rooms of a process.
+
+        The rooms can be distributed among several worker processes, each one owning the
+        rooms whose ID hash falls in its shard. A worker serves its clients from its own
+        rooms, and the rooms it doesn't own are replicas of the rooms of their owners,
+        with which they are synchronized through a broker.
+
+        Args:
+            room_factory: The factory of the rooms.
+            stop_event: An optional event to stop the rooms.
+            broker: The broker connecting the workers, if there are several ones.
+            worker: The index of this worker.
+            workers: The number of workers.
+        """
+        if workers > 1 and broker is None:
+            raise ValueError("Several workers need a broker")
         self._room_factory = room_factory
         self._stop_event = stop_event or Event()
+        self._broker = broker
+        self._worker = worker
+        self._workers = workers
         self._rooms: dict[str, YRoom] = {}
         self._lock = ResourceLock()
 
@@ -179,16 +832,70 @@ class YRooms(AsyncContextManagerMixin):
     @asynccontextmanager
     async def __asynccontextmanager__(self) -> AsyncGenerator[Self]:
         async with create_task_group() as self._task_group:
+            if self._workers > 1:
+                await self._task_group.start(self._serve_replicas)
             yield self
             await self._stop_event.wait()
             self._task_group.cancel_scope.cancel()
 
+    def get_worker(self, id: str) -> int:
+        """
+        Args:
+            id: The room ID.
+
+        Returns:
+            The index of the worker owning the room.
+        """
+        return zlib.crc32(id.encode()) % self._workers
+
     async def _create_room(self, id: str, *, task_status: TaskStatus[YRoom], **kwargs: Any):
-        async with self._room_factory(id, **kwargs) as room:
+        async with AsyncExitStack() as exit_stack:
+            worker = self.get_worker(id)
+            if worker != self._worker:
+                kwargs["upstream"] = await exit_stack.enter_async_context(self._connect(id, worker))
+            room = await exit_stack.enter_async_context(self._room_factory(id, **kwargs))
             task_status.started(room)
             await room._close_event.wait()
             del self._rooms[id]
 
+    @asynccontextmanager
+    async def _connect(self, id: str, worker: int) -> AsyncGenerator[BrokerChannel]:
+        assert self._broker is not None
+        replica_id = uuid4().hex
+        async with self._broker.subscribe(f"yrooms/replica/{replica_id}/down") as messages:
+            request = {"id": id, "replica_id": replica_id}
+            await self._broker.publish(f"yrooms/worker/{worker}", json.dumps(request).encode())
+            upstream = BrokerChannel(id, self._broker, f"yrooms/replica/{replica_id}/up", messages)
+            try:
+                # the owner subscribes to the messages of the replica before sending its
+                # first message
+                with fail_after(CONNECT_TIMEOUT):
+                    await upstream.wait()
+                yield upstream
+            finally:
+                with CancelScope(shield=True):
+                    await upstream.send(b"")
+
+    async def _serve_replicas(self, *, task_status: TaskStatus[None]) -> None:
+        assert self._broker is not None
+        async with self._broker.subscribe(f"yrooms/worker/{self._worker}") as requests:
+            task_status.started()
+            async for request in requests:
+                self._task_group.start_soon(self._serve_replica, json.loads(request))
+
+    async def _serve_replica(self, request: dict[str, str]) -> None:
+        assert self._broker is not None
+        replica_id = request["replica_id"]
+        async with self._broker.subscribe(f"yrooms/replica/{replica_id}/up") as messages:
+            replica = BrokerChannel(
+                request["id"], self._broker, f"yrooms/replica/{replica_id}/down", messages
+            )
+            try:
+                await self.serve(replica)
+            finally:
+                with CancelScope(shield=True):
+                    await replica.send(b"")
+
     async def get_room(self, id: str, **kwargs: Any) -> YRoom:
         async with self._lock(id):
             if id not in self._rooms:
@@ -196,6 +903,8 @@ class YRooms(AsyncContextManagerMixin):
                 self._rooms[id] = room
             else:
                 room = self._rooms[id]
+                if room.hibernated:
+                    await room.wake()
         return room
 
     async def serve(self, channel: AsyncChannel, **kwargs: Any) -> None:
@@ -0,0 +1,180 @@
+import gc
+import os
+import shutil
+import sys
+import tempfile
+
+import pytest
+from anyio import (
+    Event,
+    create_memory_object_stream,
+    create_task_group,
+    fail_after,
+    sleep,
+)
+from jupyverse_yrooms import AsyncChannel, UnixSocketBroker, YRoom, YRooms
+from pycrdt import (
+    Awareness,
+    Doc,
+    Text,
+    YMessageType,
+    YSyncMessageType,
+    create_awareness_message,
+    handle_sync_message,
+    read_message,
+)
+
+# the broker uses a Unix socket
+pytestmark = pytest.mark.skipif(sys.platform == "win32", reason="Unix sockets are not supported")
+
+
+@pytest.fixture
+def broker_path():
+    # a Unix socket path is limited to about 100 characters, tmp_path can be longer
+    directory = tempfile.mkdtemp()
+    yield os.path.join(directory, "broker.sock")
+    shutil.rmtree(directory)
+
+
+class Room(YRoom):
+    update_messages = 0
+
+    async def handle_message(self, message, client):
+        if message[0] == YMessageType.SYNC:
+            if message[1] == YSyncMessageType.SYNC_UPDATE:
+                self.update_messages += 1
+            reply = await self.handle_sync_message(message[1:])
+            if reply is not None:
+                self.send(client, reply)
+        elif message[0] == YMessageType.AWARENESS:
+            self.handle_awareness_message(message, client)
+
+
+class Channel(AsyncChannel):
+    def __init__(self, id):
+        self._id = id
+        self.doc = Doc()
+        self.text = self.doc.get("text", type=Text)
+        self.awareness = Awareness(self.doc)
+        self.send_stream, self.receive_stream = create_memory_object_stream[bytes]()
+
+    @property
+    def id(self):
+        return self._id
+
+    async def send(self, message):
+        if message[0] == YMessageType.SYNC:
+            handle_sync_message(message[1:], self.doc)
+        elif message[0] == YMessageType.AWARENESS:
+            self.awareness.apply_awareness_update(read_message(message[1:]), "server")
+
+    async def set_awareness(self, state):
+        self.awareness.set_local_state(state)
+        update = self.awareness.encode_awareness_update([self.awareness.client_id])
+        await self.send_stream.send(create_awareness_message(update))
+
+    async def receive(self):
+        return await self.receive_stream.receive()
+
+    async def __anext__(self):
+        try:
+            return await self.receive()
+        except Exception:
+            raise StopAsyncIteration()
+
+
+@pytest.mark.anyio
+async def test_unix_socket_broker(broker_path):
+    with fail_after(5):
+        async with (
+            UnixSocketBroker(broker_path, hub=True) as broker0,
+            UnixSocketBroker(broker_path) as broker1,
+        ):
+            async with broker1.subscribe("foo") as messages:
+                await broker0.publish("bar", b"0")
+                await broker0.publish("foo", b"1")
+                await broker1.publish("foo", b"2")
+                # messages are received in order, only on the subscribed topics
+                assert await messages.receive() == b"1"
+                assert await messages.receive() == b"2"
+
+
+@pytest.mark.anyio
+async def test_workers(broker_path):
+    stop_event = Event()
+
+    with fail_after(5):
+        async with (
+            UnixSocketBroker(broker_path, hub=True) as broker0,
+            UnixSocketBroker(broker_path) as broker1,
+            YRooms(Room, stop_event, broker=broker0, worker=0, workers=2) as yrooms0,
+            YRooms(Room, stop_event, broker=broker1, worker=1, workers=2) as yrooms1,
+        ):
+            # a room owned by worker 0
+            room_id = next(f"room{i}" for i in range(10) if yrooms0.get_worker(f"room{i}") == 0)
+            client0 = Channel(room_id)
+            client1 = Channel(room_id)
+            async with create_task_group() as tg:
+                tg.start_soon(yrooms0.serve, client0)
+                tg.start_soon(yrooms1.serve, client1)
+                await sleep(0.1)
+                # the room of worker 1 is a replica of the room of worker 0
+                room0 = await yrooms0.get_room(room_id)
+                room1 = await yrooms1.get_room(room_id)
+                assert room0.upstream is None
+                assert room1.upstream is not None
+
+                room0.doc.get("text", type=Text).insert(0, "foo")
+                await sleep(0.1)
+                assert str(client0.text) == "foo"
+                assert str(client1.text) == "foo"
+                # the updates from the owner are not sent back to it
+                assert room0.update_messages == 0
+
+                room1.doc.get("text", type=Text).insert(3, "bar")
+                await sleep(0.1)
+                assert str(room0.doc.get("text", type=Text)) == "foobar"
+                assert str(client0.text) == "foobar"
+                assert room0.update_messages == 1
+
+                # the awareness is relayed both ways
+                await client0.set_awareness({"cursor": 0})
+                await client1.set_awareness({"cursor": 1})
+                await sleep(0.1)
+                assert client1.awareness.states[client0.awareness.client_id] == {"cursor": 0}
+                assert client0.awareness.states[client1.awareness.client_id] == {"cursor": 1}
+
+                client0.send_stream.close()
+                client1.send_stream.close()
+                # the replica is closed with its last client, and then the owner room
+                await room1._close_event.wait()
+                await room0._close_event.wait()
+            stop_event.set()
+    gc.collect()
+
+
+@pytest.mark.anyio
+async def test_upstream_lost(broker_path):
+    stop_event = Event()
+
+    with fail_after(5):
+        async with (
+            UnixSocketBroker(broker_path, hub=True) as broker0,
+            UnixSocketBroker(broker_path) as broker1,
+            YRooms(Room, stop_event, broker=broker0, worker=0, workers=2) as yrooms0,
+            YRooms(Room, stop_event, broker=broker1, worker=1, workers=2) as yrooms1,
+        ):
+            room_id = next(f"room{i}" for i in range(10) if yrooms0.get_worker(f"room{i}") == 0)
+            client = Channel(room_id)
+            async with create_task_group() as tg:
+                tg.start_soon(yrooms1.serve, client)
+                await sleep(0.1)
+                room0 = await yrooms0.get_room(room_id)
+                room1 = await yrooms1.get_room(room_id)
+
+                # the replica is closed when the owner room goes away, and its client is
+                # disconnected
+                await room0.close()
+                await room1._close_event.wait()
+            stop_event.set()
+    gc.collect()
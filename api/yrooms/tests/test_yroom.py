@@ -0,0 +1,375 @@
+import gc
+
+import pytest
+from anyio import (
+    Event,
+    create_memory_object_stream,
+    create_task_group,
+    fail_after,
+    sleep,
+    wait_all_tasks_blocked,
+)
+from jupyverse_yrooms import AsyncChannel, YRoom, get_ystore_path
+from pycrdt import (
+    Awareness,
+    Doc,
+    Text,
+    YMessageType,
+    YSyncMessageType,
+    create_awareness_message,
+    create_sync_message,
+    create_update_message,
+    handle_sync_message,
+    read_message,
+)
+
+
+class Room(YRoom):
+    async def handle_message(self, message, client):
+        if message[0] == YMessageType.SYNC:
+            reply = await self.handle_sync_message(message[1:])
+            if reply is not None:
+                self.send(client, reply)
+        elif message[0] == YMessageType.AWARENESS:
+            self.handle_awareness_message(message, client)
+
+
+class HibernatingRoom(Room):
+    stored_update = None
+
+    async def run(self, *, task_status):
+        if self.stored_update is not None:
+            self.doc.apply_update(self.stored_update)
+        await super().run(task_status=task_status)
+
+    async def flush(self):
+        self.stored_update = self.doc.get_update()
+        return True
+
+
+class Channel(AsyncChannel):
+    def __init__(self, id):
+        self._id = id
+        self.doc = Doc()
+        self.text = self.doc.get("text", type=Text)
+        self.unblocked = Event()
+        self.unblocked.set()
+        self.update_messages = 0
+        self.awareness = Awareness(self.doc)
+        self.awareness_messages = 0
+        self.send_stream, self.receive_stream = create_memory_object_stream[bytes]()
+
+    @property
+    def id(self):
+        return self._id
+
+    async def send(self, message):
+        await self.unblocked.wait()
+        if message[0] == YMessageType.SYNC:
+            if message[1] == YSyncMessageType.SYNC_UPDATE:
+                self.update_messages += 1
+            handle_sync_message(message[1:], self.doc)
+        elif message[0] == YMessageType.AWARENESS:
+            self.awareness_messages += 1
+            self.awareness.apply_awareness_update(read_message(message[1:]), "server")
+
+    async def set_awareness(self, state):
+        self.awareness.set_local_state(state)
+        update = self.awareness.encode_awareness_update([self.awareness.client_id])
+        await self.send_stream.send(create_awareness_message(update))
+
+    async def receive(self):
+        return await self.receive_stream.receive()
+
+    async def __anext__(self):
+        try:
+            return await self.receive()
+        except Exception:
+            raise StopAsyncIteration()
+
+
+@pytest.mark.anyio
+async def test_slow_client():
+    room_doc = Doc()
+    room_text = room_doc.get("text", type=Text)
+    fast_client = Channel("room")
+    slow_client = Channel("room")
+
+    with fail_after(5):
+        async with Room("room", doc=room_doc, send_queue_size=2) as room:
+            async with create_task_group() as tg:
+                tg.start_soon(room.serve, fast_client)
+                tg.start_soon(room.serve, slow_client)
+                await wait_all_tasks_blocked()
+
+                slow_client.unblocked = Event()
+                for i in range(10):
+                    room_text += str(i)
+                    await wait_all_tasks_blocked()
+                # a slow client doesn't delay the other clients
+                assert str(fast_client.text) == "0123456789"
+                assert str(slow_client.text) == ""
+
+                # once it catches up, the slow client is resynchronized
+                slow_client.unblocked.set()
+                await wait_all_tasks_blocked()
+                assert str(slow_client.text) == "0123456789"
+
+                fast_client.send_stream.close()
+                slow_client.send_stream.close()
+            await room.close()
+    # document events must be dropped in the thread that created them
+    gc.collect()
+
+
+@pytest.mark.anyio
+async def test_coalescing_window():
+    room_doc = Doc()
+    room_text = room_doc.get("text", type=Text)
+    client = Channel("room")
+
+    with fail_after(5):
+        async with Room("room", doc=room_doc, coalescing_window=0.1) as room:
+            async with create_task_group() as tg:
+                tg.start_soon(room.serve, client)
+                await wait_all_tasks_blocked()
+
+                for i in range(10):
+                    room_text += str(i)
+                await sleep(0.3)
+                # the updates were merged in a single message
+                assert client.update_messages == 1
+                assert str(client.text) == "0123456789"
+
+                client.send_stream.close()
+            await room.close()
+    gc.collect()
+
+
+@pytest.mark.anyio
+async def test_hibernation():
+    client = Channel("room")
+    client_text = client.text
+
+    with fail_after(5):
+        async with HibernatingRoom("room", hibernation_delay=0.2) as room:
+            async with create_task_group() as tg:
+                tg.start_soon(room.serve, client)
+                await wait_all_tasks_blocked()
+                room.doc.get("text", type=Text).insert(0, "foo")
+                await sleep(0.1)
+                assert str(client_text) == "foo"
+                assert not room.hibernated
+
+                # the document is released when the room is idle
+                await sleep(0.3)
+                assert room.hibernated
+                assert room.doc.get_update() == Doc().get_update()
+
+                # and restored on the next message of a client
+                state = client.doc.get_state()
+                client_text += "bar"
+                update = client.doc.get_update(state)
+                await client.send_stream.send(create_update_message(update))
+                await sleep(0.1)
+                assert not room.hibernated
+                assert str(room.doc.get("text", type=Text)) == "foobar"
+
+                client.send_stream.close()
+            await room.close()
+    gc.collect()
+
+
+@pytest.mark.anyio
+async def test_hibernation_awareness():
+    clients = [Channel("room") for _ in range(2)]
+
+    with fail_after(5):
+        async with HibernatingRoom("room", hibernation_delay=0.2) as room:
+            async with create_task_group() as tg:
+                for client in clients:
+                    tg.start_soon(room.serve, client)
+                await wait_all_tasks_blocked()
+                await sleep(0.3)
+                assert room.hibernated
+
+                # the awareness is relayed without waking the room up
+                for i in range(3):
+                    await clients[0].set_awareness({"user": f"foo{i}"})
+                    await sleep(0.1)
+                    assert room.hibernated
+                states = clients[1].awareness.states
+                assert states[clients[0].awareness.client_id] == {"user": "foo2"}
+
+                for client in clients:
+                    client.send_stream.close()
+            await room.close()
+    gc.collect()
+
+
+@pytest.mark.anyio
+async def test_sync_cache():
+    room_doc = Doc()
+    room_text = room_doc.get("text", type=Text)
+    room_text += "foo"
+    clients = [Channel("room") for _ in range(2)]
+
+    with fail_after(5):
+        async with Room("room", doc=room_doc) as room:
+            async with create_task_group() as tg:
+                message = await room.get_cached_message(YSyncMessageType.SYNC_STEP2)
+                for client in clients:
+                    tg.start_soon(room.serve, client)
+                    await wait_all_tasks_blocked()
+                    # a new client asks for the whole document
+                    await client.send_stream.send(create_sync_message(client.doc))
+                    await wait_all_tasks_blocked()
+                    assert str(client.text) == "foo"
+                # the reply was encoded once for all the new clients
+                assert await room.get_cached_message(YSyncMessageType.SYNC_STEP2) is message
+
+                # and is encoded again when the document changes
+                room_text += "bar"
+                await wait_all_tasks_blocked()
+                assert await room.get_cached_message(YSyncMessageType.SYNC_STEP2) != message
+                assert all(str(client.text) == "foobar" for client in clients)
+
+                for client in clients:
+                    client.send_stream.close()
+            await room.close()
+    gc.collect()
+
+
+@pytest.mark.anyio
+async def test_event_stages():
+    room_doc = Doc()
+    room_text = room_doc.get("text", type=Text)
+    client = Channel("room")
+    received = {"persistence": [], "save": []}
+
+    async def run_stage(name, *, task_status):
+        with room.event_stage(name) as updates:
+            task_status.started()
+            async for update in updates:
+                received[name].append(update)
+                if name == "persistence":
+                    # the pending updates can also be received at once
+                    received[name].extend(updates.receive_pending())
+
+    with fail_after(5):
+        async with Room("room", doc=room_doc) as room:
+            async with create_task_group() as tg:
+                await tg.start(run_stage, "persistence")
+                await tg.start(run_stage, "save")
+                tg.start_soon(room.serve, client)
+                await wait_all_tasks_blocked()
+                for i in range(3):
+                    room_text += str(i)
+                await wait_all_tasks_blocked()
+                # every stage received all the updates, in order
+                assert str(client.text) == "012"
+                assert received["persistence"] == received["save"]
+                doc = Doc()
+                for update in received["save"]:
+                    doc.apply_update(update)
+                assert str(doc.get("text", type=Text)) == "012"
+                assert {name: metrics.events for name, metrics in room.metrics.items()} == {
+                    "broadcast": 3,
+                    "persistence": 3,
+                    "save": 3,
+                }
+
+                client.send_stream.close()
+                tg.cancel_scope.cancel()
+            await room.close()
+    gc.collect()
+
+
+@pytest.mark.anyio
+async def test_broadcast_lag():
+    room_doc = Doc()
+    room_text = room_doc.get("text", type=Text)
+    client = Channel("room")
+
+    with fail_after(5):
+        async with Room("room", doc=room_doc) as room:
+            async with create_task_group() as tg:
+                tg.start_soon(room.serve, client)
+                await wait_all_tasks_blocked()
+                client.unblocked = Event()
+                room_text += "foo"
+                await sleep(0.2)
+                # the lag is recorded when the update is delivered to the client
+                assert "broadcast" not in room.metrics
+                client.unblocked.set()
+                await wait_all_tasks_blocked()
+                metrics = room.metrics["broadcast"]
+                assert metrics.events == 1
+                assert metrics.lag >= 0.2
+
+                client.send_stream.close()
+            await room.close()
+    gc.collect()
+
+
+@pytest.mark.anyio
+async def test_awareness():
+    client0 = Channel("room")
+    client1 = Channel("room")
+    client2 = Channel("room")
+    client0_id = client0.awareness.client_id
+
+    with fail_after(5):
+        async with Room("room", awareness_interval=0.1) as room:
+            async with create_task_group() as tg:
+                tg.start_soon(room.serve, client0)
+                tg.start_soon(room.serve, client1)
+                await wait_all_tasks_blocked()
+
+                for i in range(3):
+                    await client0.set_awareness({"cursor": i})
+                # a duplicate update is dropped
+                update = client0.awareness.encode_awareness_update([client0_id])
+                await client0.send_stream.send(create_awareness_message(update))
+                await sleep(0.3)
+                # the updates were merged in a single message, not sent back to the sender
+                assert client1.awareness_messages == 1
+                assert client1.awareness.states[client0_id] == {"cursor": 2}
+                assert client0.awareness_messages == 0
+
+                # a new client is sent the current states
+                tg.start_soon(room.serve, client2)
+                await wait_all_tasks_blocked()
+                assert client2.awareness_messages == 1
+                assert client2.awareness.states[client0_id] == {"cursor": 2}
+
+                # the states of a client are removed when it disconnects
+                client0.send_stream.close()
+                await sleep(0.3)
+                assert client0_id not in client1.awareness.states
+                assert client0_id not in client2.awareness.states
+                # and their clocks are not kept
+                assert client0_id not in room._awareness_clocks
+
+                # or when the client removes them
+                client1_id = client1.awareness.client_id
+                await client1.set_awareness({"cursor": 0})
+                await sleep(0.3)
+                assert client2.awareness.states[client1_id] == {"cursor": 0}
+                await client1.set_awareness(None)
+                await sleep(0.3)
+                assert client1_id not in client2.awareness.states
+                assert client1_id not in room._awareness_clocks
+
+                client1.send_stream.close()
+                client2.send_stream.close()
+            await room.close()
+    gc.collect()
+
+
+def test_get_ystore_path():
+    assert get_ystore_path("json:notebook:1234") == ".notebook:1234.y"
+    # the file ID can contain colons
+    assert get_ystore_path("text:file:a:b") == ".file:a:b.y"
+    # a room that is not a stored document has no YStore path
+    assert get_ystore_path("room") is None
@@ -11,7 +11,7 @@ __version__ = version(__package__)
 
 class YStore(ABC):
     metadata_callback: Callable[[], Awaitable[bytes] | bytes] | None = None
-    version = 2
+    version = 5
 
     @abstractmethod
     def __init__(
@@ -25,7 +25,20 @@ class YStore(ABC):
     async def __aexit__(self, exc_type, exc_value, exc_tb) -> bool | None: ...
 
     @abstractmethod
-    async def write(self, data: bytes) -> None: ...
+    async def write(self, data: bytes, metadata: bytes = b"") -> None: ...
+
+    async def write_updates(self, updates: list[bytes], metadata: bytes = b"") -> None:
+        """Store several updates, in order.
+
+        A store that can write several updates at once (e.g. in a single transaction)
+        should override this method, which writes them one by one.
+
+        Arguments:
+            updates: The updates to store.
+            metadata: The metadata of the updates.
+        """
+        for update in updates:
+            await self.write(update, metadata)
 
     @abstractmethod
     async def read(self) -> AsyncIterator[tuple[bytes, bytes]]: ...
@@ -44,23 +57,49 @@ class YStore(ABC):
         metadata = cast(bytes, metadata)
         return metadata
 
-    async def encode_state_as_update(self, ydoc: Doc) -> None:
+    async def encode_state_as_update(self, ydoc: Doc, metadata: bytes = b"") -> None:
         """Store a YDoc state.
 
         Arguments:
             ydoc: The YDoc from which to store the state.
+            metadata: The metadata of the state.
         """
         update = ydoc.get_update()
-        await self.write(update)
+        await self.write(update, metadata)
 
-    async def apply_updates(self, ydoc: Doc) -> None:
+    async def apply_updates(self, ydoc: Doc) -> bytes:
         """Apply all stored updates to the YDoc.
 
         Arguments:
             ydoc: The YDoc on which to apply the updates.
+
+        Returns:
+            The metadata of the last update.
+        """
+        metadata = b""
+        async for update, metadata, *rest in self.read():  # type: ignore
+            ydoc.apply_update(update)
+        return metadata
+
+    async def apply_version(self, ydoc: Doc, timestamp: float) -> None:
+        """Apply the updates stored up to a timestamp to the YDoc, i.e. restore the
+        document as it was at that time.
+
+        This replays the stored updates, a store with a version index should replay them
+        from the nearest checkpoint instead.
+
+        Arguments:
+            ydoc: The YDoc on which to apply the updates.
+            timestamp: The time of the version.
         """
-        async for update, *rest in self.read():  # type: ignore
+        found = False
+        async for update, _, update_timestamp in self.read():  # type: ignore
+            if update_timestamp > timestamp:
+                break
             ydoc.apply_update(update)
+            found = True
+        if not found:
+            raise YDocNotFound
 
 
 class YDocNotFound(Exception):
@@ -150,11 +150,8 @@ class _Contents(Contents):
             content: str | dict | list[dict] | None = None
             if get_content:
                 if await path.is_dir():
-                    content = [
-                        (await self.read_content(subpath, get_content=False)).model_dump()
-                        async for subpath in path.iterdir()
-                        if not subpath.name.startswith(".")
-                    ]
+                    children = await to_thread.run_sync(scan_directory, path)
+                    content = [child.model_dump() for child in children]
                 elif await path.is_file() or await path.is_symlink():
                     try:
                         content_bytes = await path.read_bytes()
@@ -276,22 +273,78 @@ async def get_available_path(path: Path, sep: str = "") -> Path:
             return available_path
 
 
+def scan_directory(path: Path) -> list[Content]:
+    """List the (non-hidden) children of a directory in a single pass.
+
+    This runs in a worker thread and reuses the stat results cached by `os.scandir`,
+    instead of calling `read_content` (and hopping to a thread several times) for
+    every child. The models are the same as the ones returned by
+    `read_content(child_path, False)`.
+    """
+    children = []
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.name.startswith("."):
+                continue
+            child_path = path / entry.name
+            try:
+                stat = entry.stat()
+                is_dir = entry.is_dir()
+                is_file = entry.is_file() or entry.is_symlink()
+            except OSError:
+                # the entry was removed in the meantime, or is a broken symlink
+                continue
+            size: int | None = None
+            format: str | None = None
+            mimetype: str | None = None
+            if is_dir:
+                type = "directory"
+                format = "json"
+                writable = True
+            elif is_file:
+                size = stat.st_size
+                if child_path.suffix == ".ipynb":
+                    type = "notebook"
+                elif child_path.suffix == ".json":
+                    type = "json"
+                    format = "text"
+                    mimetype = "application/json"
+                else:
+                    type = "file"
+                    mimetype = "text/plain"
+                writable = os.access(entry.path, os.W_OK)
+            else:
+                # not a regular file nor a directory (e.g. a socket)
+                continue
+            children.append(
+                Content(
+                    name=entry.name,
+                    path=child_path.as_posix(),
+                    last_modified=format_timestamp(stat.st_mtime),
+                    created=format_timestamp(stat.st_ctime),
+                    content=None,
+                    format=format,
+                    mimetype=mimetype,
+                    size=size,
+                    writable=writable,
+                    type=type,
+                )
+            )
+    return children
+
+
+def format_timestamp(timestamp: float) -> str:
+    return datetime.fromtimestamp(timestamp, tz=timezone.utc).isoformat().replace("+00:00", "Z")
+
+
 async def get_file_modification_time(path: Path):
     if await path.exists():
-        return (
-            datetime.fromtimestamp((await path.stat()).st_mtime, tz=timezone.utc)
-            .isoformat()
-            .replace("+00:00", "Z")
-        )
+        return format_timestamp((await path.stat()).st_mtime)
 
 
 async def get_file_creation_time(path: Path):
     if await path.exists():
-        return (
-            datetime.fromtimestamp((await path.stat()).st_ctime, tz=timezone.utc)
-            .isoformat()
-            .replace("+00:00", "Z")
-        )
+        return format_timestamp((await path.stat()).st_ctime)
 
 
 async def get_file_size(path: Path) -> int | None:
@@ -1,13 +1,18 @@
+import json
+import os
+import stat
 import sys
+from collections.abc import Callable, Iterable
 from contextlib import AsyncExitStack
+from pathlib import PurePath
 from types import TracebackType
 from uuid import uuid4
 
 import structlog
-from anyio import Event, Path, create_task_group
+from anyio import Event, Path, create_task_group, to_thread
 from jupyverse_file_id import FileId
-from jupyverse_file_watcher import Change, FileWatcher
-from sqlite_anyio import connect
+from jupyverse_file_watcher import Change, FileChange, FileWatcher, PathFilter
+from sqlite_anyio import Cursor, connect
 
 if sys.version_info >= (3, 11):
     from typing import Self
@@ -16,39 +21,109 @@ else:
 
 logger = structlog.get_logger()
 
+# a row of the "fileids" table: (id, path, mtime, size, dev, ino, is_dir)
+FileRow = tuple[str, str, float, int, int, int, bool]
+
 
 class Watcher:
-    def __init__(self, path: str) -> None:
+    def __init__(self, path: str, recursive: bool = False) -> None:
         self.path = path
+        self.recursive = recursive
         self._event = Event()
+        # pending changes, in order and without duplicates
+        self._changes: dict[FileChange, None] = {}
 
     def __aiter__(self):
         return self
 
     async def __anext__(self):
-        await self._event.wait()
-        self._event = Event()
-        return self._change
+        while not self._changes:
+            await self._event.wait()
+            self._event = Event()
+        change = next(iter(self._changes))
+        del self._changes[change]
+        return change
 
     def notify(self, change):
-        self._change = change
+        self._changes[change] = None
         self._event.set()
 
 
+class WatcherNode:
+    """A node in the tree of watched paths, where each node is a path component."""
+
+    def __init__(self) -> None:
+        self.children: dict[str, WatcherNode] = {}
+        # watchers of this exact path
+        self.watchers: list[Watcher] = []
+        # watchers of this path and everything under it
+        self.recursive_watchers: list[Watcher] = []
+
+    def add(self, parts: list[str], watcher: Watcher) -> None:
+        node = self
+        for part in parts:
+            node = node.children.setdefault(part, WatcherNode())
+        if watcher.recursive:
+            node.recursive_watchers.append(watcher)
+        else:
+            node.watchers.append(watcher)
+
+    def remove(self, parts: list[str], watcher: Watcher) -> None:
+        nodes = [self]
+        for part in parts:
+            nodes.append(nodes[-1].children[part])
+        node = nodes[-1]
+        if watcher.recursive:
+            node.recursive_watchers.remove(watcher)
+        else:
+            node.watchers.remove(watcher)
+        # prune the nodes that are not needed anymore
+        for part, parent in zip(reversed(parts), reversed(nodes[:-1])):
+            child = parent.children[part]
+            if child.children or child.watchers or child.recursive_watchers:
+                break
+            del parent.children[part]
+
+    def notify(self, parts: list[str], change: FileChange) -> None:
+        node = self
+        for part in parts:
+            for watcher in node.recursive_watchers:
+                watcher.notify(change)
+            child = node.children.get(part)
+            if child is None:
+                return
+            node = child
+        for watcher in node.recursive_watchers:
+            watcher.notify(change)
+        for watcher in node.watchers:
+            watcher.notify(change)
+
+
 class _FileId(FileId):
-    watchers: dict[str, list[Watcher]]
+    version = 3
 
-    def __init__(self, file_watcher: FileWatcher, db_path: str, stop_event: Event):
+    def __init__(
+        self,
+        file_watcher: FileWatcher,
+        db_path: str,
+        stop_event: Event,
+        exclude: PathFilter | None = None,
+    ):
         self.file_watcher = file_watcher
         self.db_path = db_path
-        self.watchers = {}
+        self.watchers = WatcherNode()
         self.stop_event = stop_event
+        self.exclude = PathFilter() if exclude is None else exclude
 
     async def __aenter__(self) -> Self:
         self._exit_stack = None
         async with AsyncExitStack() as exit_stack:
             self.task_group = await exit_stack.enter_async_context(create_task_group())
             self.task_group.start_soon(self._cancel_on_stop)
+            self._root = str(await Path.cwd())
+            # the database itself, and its journal files, are always excluded
+            db_path = self._relative_path(self.db_path)
+            self._db_paths = {db_path + suffix for suffix in ("", "-journal", "-wal", "-shm")}
             self._db = await exit_stack.enter_async_context(await connect(self.db_path))
             await self.init_db()
             self.task_group.start_soon(self.watch_files)
@@ -69,7 +144,20 @@ class _FileId(FileId):
         await self.stop_event.wait()
         self.task_group.cancel_scope.cancel()
 
+    def _relative_path(self, path: str) -> str:
+        # paths are indexed relative to the current working directory
+        if os.path.isabs(path):
+            try:
+                return str(PurePath(path).relative_to(self._root))
+            except ValueError:
+                return path
+        return str(PurePath(path))
+
+    def _is_excluded(self, path: str) -> bool:
+        return path in self._db_paths or self.exclude(path)
+
     async def get_id(self, path: str) -> str | None:
+        path = self._relative_path(path)
         async with await self._db.cursor() as cursor:
             await cursor.execute("SELECT id FROM fileids WHERE path = ?", (path,))
             for (idx,) in await cursor.fetchall():
@@ -84,153 +172,351 @@ class _FileId(FileId):
             return None
 
     async def index(self, path: str) -> str | None:
-        apath = Path(path)
-        if not await apath.exists():
+        path = self._relative_path(path)
+        try:
+            st = await Path(path).lstat()
+        except FileNotFoundError:
             return None
 
-        idx = uuid4().hex
-        mtime = (await apath.stat()).st_mtime
         async with await self._db.cursor() as cursor:
-            await cursor.execute("INSERT INTO fileids VALUES (?, ?, ?)", (idx, path, mtime))
+            await cursor.execute(
+                "INSERT OR IGNORE INTO fileids VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (uuid4().hex, path, *file_attributes(st)),
+            )
             await self._db.commit()
-            return idx
+        return await self.get_id(path)
 
     async def init_db(self):
-        cwd = await Path.cwd()
-        logger.info("Indexing files", cwd=str(cwd))
         async with await self._db.cursor() as cursor:
-            await cursor.execute("DROP TABLE IF EXISTS fileids")
+            # the index is written in batches, it doesn't need a sync on every commit
+            await cursor.execute("PRAGMA journal_mode = WAL")
+            await cursor.execute("PRAGMA synchronous = NORMAL")
+            # where added paths are looked up in bulk
             await cursor.execute(
-                "CREATE TABLE fileids "
-                "(id TEXT PRIMARY KEY, path TEXT NOT NULL UNIQUE, mtime REAL NOT NULL)"
+                "CREATE TEMP TABLE added (path TEXT NOT NULL, dev INTEGER, ino INTEGER)"
+            )
+            await cursor.execute("PRAGMA user_version")
+            (version,) = await cursor.fetchone()
+            if version != self.version:
+                # the index is kept across restarts, unless its schema changed
+                await cursor.execute("DROP TABLE IF EXISTS fileids")
+                await cursor.execute(
+                    "CREATE TABLE fileids "
+                    "(id TEXT PRIMARY KEY, path TEXT NOT NULL UNIQUE, mtime REAL NOT NULL, "
+                    "size INTEGER NOT NULL, dev INTEGER NOT NULL, ino INTEGER NOT NULL, "
+                    "is_dir INTEGER NOT NULL)"
+                )
+                await cursor.execute("CREATE INDEX idx_fileids_dev_ino ON fileids (dev, ino)")
+                await cursor.execute("DROP TABLE IF EXISTS settings")
+                await cursor.execute(
+                    "CREATE TABLE settings (name TEXT PRIMARY KEY, value TEXT NOT NULL)"
+                )
+                await cursor.execute(f"PRAGMA user_version = {self.version}")
+                await self._db.commit()
+
+            # if the exclude patterns changed, all the directories must be scanned again
+            exclude = json.dumps(self.exclude.patterns)
+            await cursor.execute("SELECT value FROM settings WHERE name = 'exclude'")
+            rescan = await cursor.fetchone() != (exclude,)
+            await cursor.execute(
+                "INSERT OR REPLACE INTO settings VALUES ('exclude', ?)", (exclude,)
             )
-            await self._db.commit()
 
-            # index files
-            async for path in cwd.rglob("*"):
-                idx = uuid4().hex
-                try:
-                    mtime = (await path.stat()).st_mtime
-                except FileNotFoundError:
-                    pass
-                else:
-                    await cursor.execute(
-                        "INSERT INTO fileids VALUES (?, ?, ?)", (idx, str(path), mtime)
-                    )
+            logger.info("Indexing files", cwd=self._root)
+            await cursor.execute("SELECT id, path, mtime, size, dev, ino, is_dir FROM fileids")
+            rows = await cursor.fetchall()
+            new_rows, updated_rows, deleted_ids = await to_thread.run_sync(
+                reconcile, self._root, rows, self._is_excluded, rescan
+            )
+            await cursor.executemany(
+                "DELETE FROM fileids WHERE id = ?", [(idx,) for idx in deleted_ids]
+            )
+            await cursor.executemany(
+                "UPDATE fileids SET mtime = ?, size = ?, dev = ?, ino = ? WHERE id = ?",
+                updated_rows,
+            )
+            await cursor.executemany("INSERT INTO fileids VALUES (?, ?, ?, ?, ?, ?, ?)", new_rows)
             await self._db.commit()
-            logger.info("Done indexing files", cwd=str(cwd))
+            logger.info(
+                "Done indexing files",
+                cwd=self._root,
+                added=len(new_rows),
+                updated=len(updated_rows),
+                deleted=len(deleted_ids),
+            )
 
     async def watch_files(self):
         here = await Path().absolute()
         async for changes in self.file_watcher.watch(here, stop_event=self.stop_event):
+            deleted_paths = set()
+            added_paths = set()
+            modified_paths = set()
+            relative_changes = []
+            for change, changed_path in changes:
+                # get relative path
+                changed_path_str = str(Path(changed_path).relative_to(here))
+                relative_changes.append((change, changed_path_str))
+                if self._is_excluded(changed_path_str):
+                    continue
+
+                if change == Change.deleted:
+                    logger.debug("File was deleted", path=changed_path_str)
+                    deleted_paths.add(changed_path_str)
+                elif change == Change.added:
+                    logger.debug("File was added", path=changed_path_str)
+                    added_paths.add(changed_path_str)
+                elif change == Change.modified:
+                    logger.debug("File was modified", path=changed_path_str)
+                    modified_paths.add(changed_path_str)
+
             async with await self._db.cursor() as cursor:
-                deleted_paths = set()
-                added_paths = set()
-                for change, changed_path in changes:
-                    # get relative path
-                    changed_path = Path(changed_path).relative_to(here)
-                    changed_path_str = str(changed_path)
-
-                    if change == Change.deleted:
-                        logger.debug("File was deleted", path=changed_path_str)
-                        await cursor.execute(
-                            "SELECT COUNT(*) FROM fileids WHERE path = ?", (changed_path_str,)
-                        )
-                        if not (await cursor.fetchone())[0]:
-                            # path is not indexed, ignore
-                            logger.debug(
-                                "File is not indexed, ignoring",
-                                path=changed_path_str,
-                            )
-                            continue
-                        # path is indexed
-                        await maybe_rename(
-                            self._db, changed_path_str, deleted_paths, added_paths, False
-                        )
-                    elif change == Change.added:
-                        logger.debug("File was added", path=changed_path_str)
-                        await maybe_rename(
-                            self._db, changed_path_str, added_paths, deleted_paths, True
-                        )
-                    elif change == Change.modified:
-                        logger.debug("File was modified", path=changed_path_str)
-                        if changed_path_str == self.db_path:
-                            continue
-                        await cursor.execute(
-                            "SELECT COUNT(*) FROM fileids WHERE path = ?", (changed_path_str,)
-                        )
-                        if not (await cursor.fetchone())[0]:
-                            # path is not indexed, ignore
-                            logger.debug(
-                                "File is not indexed, ignoring",
-                                path=changed_path_str,
-                            )
-                            continue
-                        mtime = (await changed_path.stat()).st_mtime
-                        await cursor.execute(
-                            "UPDATE fileids SET mtime = ? WHERE path = ?",
-                            (mtime, changed_path_str),
-                        )
-
-                for path in deleted_paths - added_paths:
-                    logger.debug("Unindexing file", path=path)
-                    await cursor.execute("DELETE FROM fileids WHERE path = ?", (path,))
+                await self._apply_changes(cursor, added_paths, deleted_paths, modified_paths)
                 await self._db.commit()
 
-                for change in changes:
-                    changed_path = change[1]
-                    # get relative path
-                    relative_changed_path = str(
-                        Path(changed_path).relative_to(await Path().absolute())
-                    )
-                    relative_change = (change[0], relative_changed_path)
-                    for watcher in self.watchers.get(relative_changed_path, []):
-                        watcher.notify(relative_change)
-
-    def watch(self, path: str) -> Watcher:
-        watcher = Watcher(path)
-        self.watchers.setdefault(path, []).append(watcher)
+            for relative_change in relative_changes:
+                self.watchers.notify(path_parts(relative_change[1]), relative_change)
+
+    async def _apply_changes(
+        self,
+        cursor: Cursor,
+        added_paths: set[str],
+        deleted_paths: set[str],
+        modified_paths: set[str],
+    ) -> None:
+        # a batch of changes is applied with a few set-based statements
+        stats = await to_thread.run_sync(lstat_paths, added_paths | modified_paths)
+
+        # directory mtimes are only updated when reconciling the index,
+        # since they tell which directories must be scanned again
+        await cursor.executemany(
+            "UPDATE fileids SET mtime = ?, size = ?, dev = ?, ino = ? "
+            "WHERE path = ? AND NOT is_dir",
+            [
+                (st.st_mtime, st.st_size, st.st_dev, st.st_ino, path)
+                for path in modified_paths
+                if (st := stats[path]) is not None
+            ],
+        )
+
+        # look up the added paths, by path and by inode
+        added_stats = {path: st for path in added_paths if (st := stats[path]) is not None}
+        path_rows = {}
+        inode_rows = {}
+        if added_stats:
+            await cursor.executemany(
+                "INSERT INTO added VALUES (?, ?, ?)",
+                [(path, st.st_dev, st.st_ino) for path, st in added_stats.items()],
+            )
+            await cursor.execute("SELECT added.path, id FROM added JOIN fileids USING (path)")
+            path_rows = dict(await cursor.fetchall())
+            await cursor.execute(
+                "SELECT added.path, id, fileids.path FROM added JOIN fileids USING (dev, ino) "
+                "WHERE added.path != fileids.path"
+            )
+            inode_rows = {path: (idx, old_path) for path, idx, old_path in await cursor.fetchall()}
+            await cursor.execute("DELETE FROM added")
+        # an indexed path that still exists is not the source of a rename (e.g. a hard link)
+        existing = await to_thread.run_sync(
+            existing_paths, {old_path for _, old_path in inode_rows.values()} | deleted_paths
+        )
+
+        updated_rows = []
+        renamed_rows = []
+        renamed_directories = []
+        unindexed_paths = [path for path in deleted_paths if path not in existing]
+        new_rows: list[FileRow] = []
+        new_directories = []
+        renamed_ids = set()
+        # parent directories are processed before their content
+        for path, st in sorted(added_stats.items()):
+            attributes = file_attributes(st)
+            inode_row = inode_rows.get(path)
+            if inode_row is not None and (inode_row[1] in existing or inode_row[0] in renamed_ids):
+                inode_row = None
+            if path in path_rows:
+                # the path keeps its ID, even if it was replaced (e.g. by an atomic save)
+                updated_rows.append((*attributes, path_rows[path]))
+                if inode_row is not None:
+                    unindexed_paths.append(inode_row[1])
+            elif inode_row is not None:
+                idx, old_path = inode_row
+                logger.debug("File was renamed", from_path=old_path, to_path=path)
+                renamed_ids.add(idx)
+                renamed_rows.append((path, *attributes, idx))
+                if attributes[-1]:
+                    renamed_directories.append((old_path, path))
+            else:
+                logger.debug("Indexing file", path=path)
+                new_rows.append((uuid4().hex, path, *attributes))
+                if attributes[-1]:
+                    new_directories.append(path)
+
+        await cursor.executemany(
+            "UPDATE fileids SET mtime = ?, size = ?, dev = ?, ino = ?, is_dir = ? WHERE id = ?",
+            updated_rows,
+        )
+        await cursor.executemany(
+            "UPDATE OR REPLACE fileids SET path = ?, mtime = ?, size = ?, dev = ?, ino = ?, "
+            "is_dir = ? WHERE id = ?",
+            renamed_rows,
+        )
+        for old_path, path in renamed_directories:
+            # move the content of the directory
+            await cursor.execute(
+                "UPDATE OR REPLACE fileids SET path = ? || substr(path, ?) "
+                "WHERE path > ? AND path < ?",
+                (path, len(old_path) + 1, *subtree_bounds(old_path)),
+            )
+        for path in unindexed_paths:
+            logger.debug("Unindexing file", path=path)
+        await cursor.executemany(
+            "DELETE FROM fileids WHERE path = ?", [(path,) for path in unindexed_paths]
+        )
+        await cursor.executemany(
+            "DELETE FROM fileids WHERE path > ? AND path < ?",
+            [subtree_bounds(path) for path in unindexed_paths],
+        )
+        for path in new_directories:
+            # the directory might have been moved from outside, with its content
+            new_rows += (
+                await to_thread.run_sync(reconcile, self._root, [], self._is_excluded, True, path)
+            )[0]
+        await cursor.executemany(
+            "INSERT OR IGNORE INTO fileids VALUES (?, ?, ?, ?, ?, ?, ?)", new_rows
+        )
+
+    def watch(self, path: str, recursive: bool = False) -> Watcher:
+        watcher = Watcher(path, recursive)
+        self.watchers.add(path_parts(self._relative_path(path)), watcher)
         return watcher
 
     def unwatch(self, path: str, watcher: Watcher):
-        self.watchers[path].remove(watcher)
+        self.watchers.remove(path_parts(self._relative_path(path)), watcher)
 
 
-async def get_mtime(path, db) -> float | None:
-    if db:
-        async with await db.cursor() as cursor:
-            await cursor.execute("SELECT mtime FROM fileids WHERE path = ?", (path,))
-            for (mtime,) in await cursor.fetchall():
-                return mtime
-            # deleted file is not in database, shouldn't happen
-            return None
-    try:
-        mtime = (await Path(path).stat()).st_mtime
-    except FileNotFoundError:
-        return None
-    return mtime
-
-
-async def maybe_rename(
-    db, changed_path: str, changed_paths: set[str], other_paths: set[str], is_added_path: bool
-) -> None:
-    # check if the same file was added/deleted, this would be a rename
-    db_or_fs1, db_or_fs2 = db, None
-    if is_added_path:
-        db_or_fs1, db_or_fs2 = db_or_fs2, db_or_fs1
-    mtime1 = await get_mtime(changed_path, db_or_fs1)
-    if mtime1 is None:
-        return
-    for other_path in other_paths:
-        mtime2 = await get_mtime(other_path, db_or_fs2)
-        if mtime1 == mtime2:
-            # same files, according to modification times
-            path1, path2 = changed_path, other_path
-            if is_added_path:
-                path1, path2 = path2, path1
-            logger.debug("File was renamed", from_path=path1, to_path=path2)
-            async with await db.cursor() as cursor:
-                await cursor.execute("UPDATE fileids SET path = ? WHERE path = ?", (path2, path1))
-                other_paths.remove(other_path)
-                return
-    changed_paths.add(changed_path)
+def path_parts(path: str) -> list[str]:
+    if path in ("", "."):
+        return []
+    return path.split(os.sep)
+
+
+def file_attributes(st: os.stat_result) -> tuple[float, int, int, int, bool]:
+    return st.st_mtime, st.st_size, st.st_dev, st.st_ino, stat.S_ISDIR(st.st_mode)
+
+
+def lstat_paths(paths: Iterable[str]) -> dict[str, os.stat_result | None]:
+    stats: dict[str, os.stat_result | None] = {}
+    for path in paths:
+        try:
+            stats[path] = os.lstat(path)
+        except OSError:
+            stats[path] = None
+    return stats
+
+
+def existing_paths(paths: Iterable[str]) -> set[str]:
+    return {path for path in paths if os.path.lexists(path)}
+
+
+def subtree_bounds(path: str) -> tuple[str, str]:
+    # all the paths inside a directory are between these bounds
+    return path + os.sep, path + chr(ord(os.sep) + 1)
+
+
+def reconcile(
+    root: str,
+    rows: list[FileRow],
+    exclude: Callable[[str], bool],
+    rescan: bool = False,
+    directory: str = "",
+) -> tuple[list[FileRow], list[tuple], list[str]]:
+    """Reconcile the indexed files with the file system under a root directory.
+
+    Only the directories whose modification time changed since they were indexed are
+    listed again (unless a rescan is forced), the other ones just have their
+    sub-directories checked. Excluded paths are not indexed, nor walked into. Files that
+    disappeared from the index but reappeared elsewhere with the same device and inode
+    are considered renamed, and keep their ID.
+
+    Args:
+        root: The root directory.
+        rows: The rows of the index.
+        exclude: A function telling if a path (relative to the root) is excluded.
+        rescan: Whether to list all the directories again.
+        directory: The directory to start from, relative to the root.
+
+    Returns:
+        The rows to insert, the (mtime, size, dev, ino, id) rows to update and the IDs
+        to delete.
+    """
+    known = {row[1]: row for row in rows}
+    children: dict[str, list[str]] = {}
+    for path in known:
+        children.setdefault(os.path.dirname(path), []).append(path)
+    seen: set[str] = set()
+    updated_rows: list[tuple] = []
+    added: list[tuple[str, os.stat_result]] = []
+    # directories to visit, and whether they must be listed again
+    directories: list[tuple[str, bool]] = [(directory, True)]
+
+    def visit(path: str, st: os.stat_result) -> None:
+        if exclude(path):
+            return
+        is_dir = stat.S_ISDIR(st.st_mode)
+        row = known.get(path)
+        if row is None or bool(row[6]) != is_dir:
+            added.append((path, st))
+            if is_dir:
+                directories.append((path, True))
+            return
+        seen.add(path)
+        if row[2:6] != (st.st_mtime, st.st_size, st.st_dev, st.st_ino):
+            updated_rows.append((st.st_mtime, st.st_size, st.st_dev, st.st_ino, row[0]))
+        if is_dir:
+            directories.append((path, rescan or row[2] != st.st_mtime))
+
+    while directories:
+        directory, changed = directories.pop()
+        if changed:
+            try:
+                with os.scandir(os.path.join(root, directory)) as entries:
+                    for entry in entries:
+                        try:
+                            st = entry.stat(follow_symlinks=False)
+                        except OSError:
+                            continue
+                        visit(os.path.join(directory, entry.name), st)
+            except OSError:
+                continue
+        else:
+            # the directory entries didn't change, but sub-directories might have
+            for path in children.get(directory, []):
+                if known[path][6]:
+                    try:
+                        st = os.lstat(os.path.join(root, path))
+                    except OSError:
+                        continue
+                    visit(path, st)
+                elif not exclude(path):
+                    seen.add(path)
+
+    deleted_ids: list[str] = []
+    vanished: dict[tuple[int, int, bool], list[FileRow]] = {}
+    for path, row in known.items():
+        if path not in seen:
+            deleted_ids.append(row[0])
+            vanished.setdefault((row[4], row[5], bool(row[6])), []).append(row)
+    new_rows: list[FileRow] = []
+    for path, st in added:
+        attributes = file_attributes(st)
+        idx = uuid4().hex
+        candidates = vanished.get((st.st_dev, st.st_ino, attributes[4]), [])
+        for row in candidates:
+            # a renamed file keeps its inode, size and modification time
+            if attributes[4] or row[2:4] == attributes[:2]:
+                logger.debug("File was renamed", from_path=row[1], to_path=path)
+                idx = row[0]
+                candidates.remove(row)
+                break
+        new_rows.append((idx, path, *attributes))
+    return new_rows, updated_rows, deleted_ids
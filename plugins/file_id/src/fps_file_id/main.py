@@ -2,7 +2,7 @@ from anyio import Event
 from fps import Module
 from jupyverse_api import Config
 from jupyverse_file_id import FileId
-from jupyverse_file_watcher import FileWatcher
+from jupyverse_file_watcher import DEFAULT_EXCLUDE, FileWatcher, PathFilter
 from pydantic import Field
 
 from .file_id import _FileId
@@ -18,7 +18,12 @@ class FileIdModule(Module):
         self._stop_event0 = Event()
         self._stop_event1 = Event()
 
-        async with _FileId(file_watcher, self.config.db_path, self._stop_event0) as file_id:
+        async with _FileId(
+            file_watcher,
+            self.config.db_path,
+            self._stop_event0,
+            PathFilter(self.config.exclude),
+        ) as file_id:
             self.put(file_id, FileId)
             self.done()
 
@@ -34,3 +39,10 @@ class FileIdConfig(Config):
         description="The path to the SQLite database.",
         default=".fileid.db",
     )
+    exclude: list[str] = Field(
+        description=(
+            "The gitignore-style patterns of the paths not to index, "
+            "relative to the current directory."
+        ),
+        default=DEFAULT_EXCLUDE,
+    )
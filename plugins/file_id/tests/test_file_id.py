@@ -0,0 +1,216 @@
+import os
+
+import pytest
+from anyio import Event, create_memory_object_stream, fail_after, move_on_after, sleep
+from fps_file_id.file_id import _FileId
+from fps_file_watcher.file_watcher import _FileWatcher
+from jupyverse_file_watcher import Change, FileWatcher, PathFilter
+
+
+class FakeFileWatcher(FileWatcher):
+    def __init__(self):
+        self.send_stream, self.receive_stream = create_memory_object_stream[set]()
+
+    async def watch(self, path, stop_event=None):
+        async for changes in self.receive_stream:
+            yield changes
+
+
+async def apply_changes(file_watcher, file_id, changes):
+    # the watchers are notified once the changes are applied to the index
+    watcher = file_id.watch("", recursive=True)
+    await file_watcher.send_stream.send(
+        {(change, os.path.abspath(path)) for change, path in changes}
+    )
+    with fail_after(5):
+        for _ in changes:
+            await anext(watcher)
+    file_id.unwatch("", watcher)
+
+
+async def wait_for_watcher(file_id, tmp_path):
+    # the file watcher is ready once it reports the changes to a file
+    watcher = file_id.watch("ready.txt")
+    with fail_after(10):
+        while True:
+            (tmp_path / "ready.txt").write_text("")
+            with move_on_after(0.1):
+                await anext(watcher)
+                break
+    file_id.unwatch("ready.txt", watcher)
+
+
+@pytest.mark.anyio
+async def test_index_persistence(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "file0.txt").write_text("0")
+    (tmp_path / "dir").mkdir()
+    (tmp_path / "dir" / "file1.txt").write_text("1")
+    db_path = str(tmp_path / ".fileid.db")
+
+    stop_event = Event()
+    async with _FileId(_FileWatcher(), db_path, stop_event) as file_id:
+        id0 = await file_id.get_id("file0.txt")
+        id1 = await file_id.get_id(str(tmp_path / "dir" / "file1.txt"))
+        id_dir = await file_id.get_id("dir")
+        assert None not in (id0, id1, id_dir)
+        stop_event.set()
+
+    # change the file system while the index is not watched
+    (tmp_path / "file0.txt").rename(tmp_path / "file2.txt")
+    (tmp_path / "dir" / "file1.txt").rename(tmp_path / "dir" / "file3.txt")
+    (tmp_path / "file4.txt").write_text("4")
+
+    stop_event = Event()
+    async with _FileId(_FileWatcher(), db_path, stop_event) as file_id:
+        assert await file_id.get_id("file0.txt") is None
+        assert await file_id.get_id("file2.txt") == id0
+        assert await file_id.get_id(os.path.join("dir", "file3.txt")) == id1
+        assert await file_id.get_id("dir") == id_dir
+        assert await file_id.get_id("file4.txt") is not None
+        assert await file_id.get_path(id0) == "file2.txt"
+        stop_event.set()
+
+
+@pytest.mark.anyio
+async def test_rename(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "file0.txt").write_text("0")
+    (tmp_path / "dir0").mkdir()
+    (tmp_path / "dir0" / "file1.txt").write_text("1")
+    db_path = str(tmp_path / ".fileid.db")
+
+    async def wait_for_path(idx, path):
+        with fail_after(10):
+            while await file_id.get_path(idx) != path:
+                await sleep(0.1)
+
+    stop_event = Event()
+    async with _FileId(_FileWatcher(), db_path, stop_event) as file_id:
+        id0 = await file_id.get_id("file0.txt")
+        id1 = await file_id.get_id(os.path.join("dir0", "file1.txt"))
+        await wait_for_watcher(file_id, tmp_path)
+        # rename a file
+        (tmp_path / "file0.txt").rename(tmp_path / "file2.txt")
+        await wait_for_path(id0, "file2.txt")
+        # rename a directory
+        (tmp_path / "dir0").rename(tmp_path / "dir1")
+        await wait_for_path(id1, os.path.join("dir1", "file1.txt"))
+        # replace a file, it must keep its ID
+        (tmp_path / "file3.txt").write_text("3")
+        (tmp_path / "file3.txt").replace(tmp_path / "file2.txt")
+        await wait_for_path(id0, "file2.txt")
+        with fail_after(10):
+            while await file_id.get_id("file3.txt") is not None:
+                await sleep(0.1)
+        assert await file_id.get_id("file2.txt") == id0
+        stop_event.set()
+
+
+@pytest.mark.anyio
+async def test_exclude(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "node_modules" / "foo").mkdir(parents=True)
+    (tmp_path / "node_modules" / "foo" / "index.js").write_text("")
+    (tmp_path / "file.pyc").write_text("")
+    (tmp_path / "file.py").write_text("")
+    db_path = str(tmp_path / ".fileid.db")
+
+    stop_event = Event()
+    exclude = PathFilter(["node_modules", "*.pyc"])
+    async with _FileId(_FileWatcher(), db_path, stop_event, exclude) as file_id:
+        assert await file_id.get_id("node_modules") is None
+        assert await file_id.get_id(os.path.join("node_modules", "foo", "index.js")) is None
+        assert await file_id.get_id("file.pyc") is None
+        assert await file_id.get_id("file.py") is not None
+        stop_event.set()
+
+    # the directories must be scanned again if the patterns change
+    stop_event = Event()
+    async with _FileId(_FileWatcher(), db_path, stop_event) as file_id:
+        assert await file_id.get_id(os.path.join("node_modules", "foo", "index.js")) is not None
+        assert await file_id.get_id("file.pyc") is not None
+        stop_event.set()
+
+
+@pytest.mark.anyio
+async def test_watch_subtree(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "dir" / "sub").mkdir(parents=True)
+    db_path = str(tmp_path / ".fileid.db")
+
+    stop_event = Event()
+    async with _FileId(_FileWatcher(), db_path, stop_event) as file_id:
+        dir_watcher = file_id.watch("dir", recursive=True)
+        file_path = os.path.join("dir", "sub", "file.txt")
+        file_watcher = file_id.watch(file_path)
+        # let the file watcher start
+        await sleep(0.5)
+        (tmp_path / "other.txt").write_text("")
+        (tmp_path / "dir" / "sub" / "file.txt").write_text("")
+        with fail_after(10):
+            change, path = await anext(dir_watcher)
+            assert path == file_path
+            change, path = await anext(file_watcher)
+            assert path == file_path
+        file_id.unwatch("dir", dir_watcher)
+        file_id.unwatch(file_path, file_watcher)
+        assert not file_id.watchers.children
+        stop_event.set()
+
+
+@pytest.mark.anyio
+async def test_apply_changes(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "file0.txt").write_text("0")
+    (tmp_path / "dir0").mkdir()
+    (tmp_path / "dir0" / "file1.txt").write_text("1")
+    db_path = str(tmp_path / ".fileid.db")
+    file1_path = os.path.join("dir0", "file1.txt")
+
+    stop_event = Event()
+    file_watcher = FakeFileWatcher()
+    async with _FileId(file_watcher, db_path, stop_event) as file_id:
+        id0 = await file_id.get_id("file0.txt")
+        id1 = await file_id.get_id(file1_path)
+
+        # a batch with a rename, a modification and a directory moved from outside
+        (tmp_path / "file0.txt").rename(tmp_path / "file2.txt")
+        (tmp_path / "dir0" / "file1.txt").write_text("11")
+        (tmp_path / "dir1").mkdir()
+        (tmp_path / "dir1" / "file3.txt").write_text("3")
+        await apply_changes(
+            file_watcher,
+            file_id,
+            [
+                (Change.deleted, "file0.txt"),
+                (Change.added, "file2.txt"),
+                (Change.modified, file1_path),
+                (Change.added, "dir1"),
+            ],
+        )
+        assert await file_id.get_id("file0.txt") is None
+        assert await file_id.get_id("file2.txt") == id0
+        assert await file_id.get_id(file1_path) == id1
+        assert await file_id.get_id(os.path.join("dir1", "file3.txt")) is not None
+
+        # a deleted directory is unindexed with its content
+        (tmp_path / "dir0" / "file1.txt").unlink()
+        (tmp_path / "dir0").rmdir()
+        await apply_changes(file_watcher, file_id, [(Change.deleted, "dir0")])
+        assert await file_id.get_id("dir0") is None
+        assert await file_id.get_id(file1_path) is None
+        assert await file_id.get_path(id1) is None
+
+        # only the database and its journal files are excluded, not their siblings
+        (tmp_path / ".fileid.db-backup").mkdir()
+        (tmp_path / ".fileid.db-backup" / "file.txt").write_text("")
+        backup_path = os.path.join(".fileid.db-backup", "file.txt")
+        await apply_changes(
+            file_watcher,
+            file_id,
+            [(Change.modified, ".fileid.db-wal"), (Change.added, ".fileid.db-backup")],
+        )
+        assert await file_id.get_id(".fileid.db-wal") is None
+        assert await file_id.get_id(backup_path) is not None
+        stop_event.set()
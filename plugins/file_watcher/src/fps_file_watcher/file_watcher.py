@@ -1,11 +1,12 @@
 import logging
+import os
 from collections.abc import AsyncGenerator
 from pathlib import Path
 
 import structlog
 from anyio import Event
-from jupyverse_file_watcher import FileChange, FileWatcher
-from watchfiles import awatch
+from jupyverse_file_watcher import FileChange, FileWatcher, PathFilter
+from watchfiles import Change, DefaultFilter, awatch
 
 logger = structlog.get_logger()
 watchfiles_logger = logging.getLogger("watchfiles")
@@ -13,10 +14,21 @@ watchfiles_logger.setLevel(logging.WARNING)
 
 
 class _FileWatcher(FileWatcher):
+    def __init__(self, exclude: PathFilter | None = None) -> None:
+        self.exclude = PathFilter() if exclude is None else exclude
+
     async def watch(  # type: ignore[override]
         self,
         path: Path | str,
         stop_event: Event | None = None,
     ) -> AsyncGenerator[set[FileChange], None]:
-        async for changes in awatch(path, stop_event=stop_event):
+        root = os.path.abspath(path)
+        default_filter = DefaultFilter()
+
+        def watch_filter(change: Change, changed_path: str) -> bool:
+            if not default_filter(change, changed_path):
+                return False
+            return not self.exclude(os.path.relpath(changed_path, root))
+
+        async for changes in awatch(path, watch_filter=watch_filter, stop_event=stop_event):
             yield changes  # type: ignore[misc]
@@ -1,10 +1,42 @@
+from anyio import Event
 from fps import Module
-from jupyverse_file_watcher import FileWatcher
+from jupyverse_api import Config
+from jupyverse_file_watcher import DEFAULT_EXCLUDE, FileWatcher, FileWatcherHub, PathFilter
+from pydantic import Field
 
 from .file_watcher import _FileWatcher
 
 
 class FileWatcherModule(Module):
+    def __init__(self, name: str, **kwargs):
+        super().__init__(name)
+        self.config = FileWatcherConfig(**kwargs)
+
     async def prepare(self) -> None:
-        file_watcher = _FileWatcher()
-        self.put(file_watcher, FileWatcher)
+        self._stop_event0 = Event()
+        self._stop_event1 = Event()
+
+        # all the users of the file watcher share its watches
+        exclude = PathFilter(self.config.exclude)
+        file_watcher = _FileWatcher(exclude.unanchored())
+        async with FileWatcherHub(
+            file_watcher, self._stop_event0, exclude=exclude
+        ) as file_watcher_hub:
+            self.put(file_watcher_hub, FileWatcher)
+            self.done()
+
+        self._stop_event1.set()
+
+    async def stop(self) -> None:
+        self._stop_event0.set()
+        await self._stop_event1.wait()
+
+
+class FileWatcherConfig(Config):
+    exclude: list[str] = Field(
+        description=(
+            "The gitignore-style patterns of the paths to ignore, "
+            "relative to the watched directory."
+        ),
+        default=DEFAULT_EXCLUDE,
+    )
@@ -1,16 +1,70 @@
+import os
 from collections.abc import AsyncGenerator
 from pathlib import Path
 
-from anychange import awatch
+from anychange import DefaultWatcher, awatch
 from anyio import Event
-from jupyverse_file_watcher import FileChange, FileWatcher
+from jupyverse_file_watcher import FileChange, FileWatcher, PathFilter
+
+from .stat_cache import ScanCost, poll
 
 
 class _FileWatcher(FileWatcher):
+    def __init__(
+        self,
+        exclude: PathFilter | None = None,
+        mode: str = "walk",
+        min_interval: float = 0.4,
+        max_interval: float = 5,
+        full_scan_interval: float = 30,
+        max_load: float = 0.1,
+    ) -> None:
+        self.exclude = PathFilter() if exclude is None else exclude
+        self.mode = mode
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.full_scan_interval = full_scan_interval
+        self.max_load = max_load
+        # the cost of the last scan of each watched directory, in "stat_cache" mode,
+        # also available through the published hub as `file_watcher.scan_costs`
+        self.scan_costs: dict[str, ScanCost] = {}
+
     async def watch(  # type: ignore[override]
         self,
         path: Path | str,
         stop_event: Event | None = None,
     ) -> AsyncGenerator[set[FileChange], None]:
-        async for changes in awatch(path, stop_event=stop_event):
+        if self.mode == "stat_cache":
+            path = str(path)
+            try:
+                async for file_changes in poll(
+                    path,
+                    stop_event=stop_event,
+                    exclude=self.exclude,
+                    min_interval=self.min_interval,
+                    max_interval=self.max_interval,
+                    full_scan_interval=self.full_scan_interval,
+                    max_load=self.max_load,
+                    scan_costs=self.scan_costs,
+                ):
+                    yield file_changes
+            finally:
+                self.scan_costs.pop(path, None)
+            return
+
+        exclude = self.exclude
+
+        class Watcher(DefaultWatcher):
+            # excluded directories are not walked
+            def should_watch_dir(self, entry: os.DirEntry) -> bool:
+                return super().should_watch_dir(entry) and not exclude(
+                    os.path.relpath(entry.path, self.root_path)
+                )
+
+            def should_watch_file(self, entry: os.DirEntry) -> bool:
+                return super().should_watch_file(entry) and not exclude(
+                    os.path.relpath(entry.path, self.root_path)
+                )
+
+        async for changes in awatch(path, watcher_cls=Watcher, stop_event=stop_event):
             yield changes  # type: ignore[misc]
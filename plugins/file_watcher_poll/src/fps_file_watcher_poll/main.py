@@ -1,10 +1,84 @@
+from typing import Literal
+
+from anyio import Event
 from fps import Module
-from jupyverse_file_watcher import FileWatcher
+from jupyverse_api import Config
+from jupyverse_file_watcher import DEFAULT_EXCLUDE, FileWatcher, FileWatcherHub, PathFilter
+from pydantic import Field
 
 from .file_watcher import _FileWatcher
 
 
 class FileWatcherPollModule(Module):
+    def __init__(self, name: str, **kwargs):
+        super().__init__(name)
+        self.config = FileWatcherPollConfig(**kwargs)
+
     async def prepare(self) -> None:
-        file_watcher = _FileWatcher()
-        self.put(file_watcher, FileWatcher)
+        self._stop_event0 = Event()
+        self._stop_event1 = Event()
+
+        # all the users of the file watcher share its watches
+        exclude = PathFilter(self.config.exclude)
+        file_watcher = _FileWatcher(
+            exclude.unanchored(),
+            mode=self.config.mode,
+            min_interval=self.config.min_interval,
+            max_interval=self.config.max_interval,
+            full_scan_interval=self.config.full_scan_interval,
+            max_load=self.config.max_load,
+        )
+        async with FileWatcherHub(
+            file_watcher, self._stop_event0, exclude=exclude
+        ) as file_watcher_hub:
+            self.put(file_watcher_hub, FileWatcher)
+            self.done()
+
+        self._stop_event1.set()
+
+    async def stop(self) -> None:
+        self._stop_event0.set()
+        await self._stop_event1.wait()
+
+
+class FileWatcherPollConfig(Config):
+    exclude: list[str] = Field(
+        description=(
+            "The gitignore-style patterns of the paths to ignore, "
+            "relative to the watched directory."
+        ),
+        default=DEFAULT_EXCLUDE,
+    )
+    mode: Literal["walk", "stat_cache"] = Field(
+        description=(
+            'The polling mode: "walk" walks the whole tree at every poll, "stat_cache" '
+            "keeps a stat cache and only lists the directories whose mtime changed."
+        ),
+        default="walk",
+    )
+    min_interval: float = Field(
+        description='The minimum poll interval in "stat_cache" mode, in seconds.',
+        default=0.4,
+    )
+    max_interval: float = Field(
+        description=(
+            'The maximum poll interval in "stat_cache" mode, in seconds. '
+            "The interval grows up to this value while nothing changes."
+        ),
+        default=5,
+    )
+    full_scan_interval: float = Field(
+        description=(
+            'The interval between full scans in "stat_cache" mode, in seconds. '
+            "Files modified in place are only detected by full scans."
+        ),
+        default=30,
+    )
+    max_load: float = Field(
+        description=(
+            'The maximum fraction of time spent scanning in "stat_cache" mode. '
+            "The poll interval is increased for the scans to stay under it."
+        ),
+        default=0.1,
+        gt=0,
+    )
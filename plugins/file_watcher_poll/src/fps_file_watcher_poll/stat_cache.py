@@ -0,0 +1,236 @@
+import os
+from collections.abc import AsyncGenerator
+from dataclasses import dataclass
+from stat import S_ISDIR
+from time import monotonic, time
+
+import structlog
+from anyio import Event, move_on_after, to_thread
+from jupyverse_file_watcher import Change, FileChange, PathFilter
+
+logger = structlog.get_logger()
+
+# a directory modified more recently than this (in seconds) may still be modified
+# within the resolution of its mtime, so it is listed again at the next scan
+RACY_DELAY = 2
+
+
+@dataclass
+class ScanCost:
+    """The cost of a scan of a watched directory."""
+
+    duration: float = 0
+    full: bool = False
+    dirs_stat: int = 0
+    dirs_listed: int = 0
+    files_stat: int = 0
+
+
+class _Directory:
+    __slots__ = ("mtime", "files", "dirs")
+
+    def __init__(self, mtime: int) -> None:
+        self.mtime = mtime
+        # file name -> (mtime, size)
+        self.files: dict[str, tuple[int, int]] = {}
+        self.dirs: set[str] = set()
+
+
+class StatCache:
+    """A stat cache of the directories under a root directory.
+
+    A directory is listed again only if its mtime changed, i.e. if entries were added,
+    deleted or renamed in it, which also catches the atomic saves of editors. Files
+    modified in place don't change the mtime of their directory, so a full scan also
+    stats the known files.
+    """
+
+    def __init__(self, root: str, exclude: PathFilter | None = None) -> None:
+        self.root = root
+        self.exclude = PathFilter() if exclude is None else exclude
+        self._dirs: dict[str, _Directory] = {}
+        self._initialized = False
+
+    def scan(self, full: bool = False) -> tuple[set[FileChange], ScanCost]:
+        """
+        Args:
+            full: Whether to also stat the files in the directories that didn't change.
+
+        Returns:
+            The changes since the last scan, and the cost of the scan.
+            The first scan only fills the cache and returns no changes.
+        """
+        start = monotonic()
+        changes: set[FileChange] = set()
+        cost = ScanCost(full=full)
+        self._scan_dir(self.root, changes, cost, full, report=self._initialized, now=time())
+        self._initialized = True
+        cost.duration = monotonic() - start
+        return changes, cost
+
+    def _scan_dir(
+        self,
+        path: str,
+        changes: set[FileChange],
+        cost: ScanCost,
+        full: bool,
+        report: bool,
+        now: float,
+    ) -> None:
+        directory = self._dirs.get(path)
+        cost.dirs_stat += 1
+        try:
+            st = os.stat(path)
+        except OSError:
+            self._forget(path, changes, report)
+            return
+        if not S_ISDIR(st.st_mode):
+            self._forget(path, changes, report)
+            return
+
+        if directory is not None and directory.mtime == st.st_mtime_ns:
+            # the entries didn't change
+            if full:
+                self._stat_files(path, directory, changes, cost, report)
+            for name in directory.dirs:
+                self._scan_dir(os.path.join(path, name), changes, cost, full, report, now)
+            return
+
+        cost.dirs_listed += 1
+        mtime = -1 if now - st.st_mtime < RACY_DELAY else st.st_mtime_ns
+        new_directory = _Directory(mtime)
+        try:
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    if self.exclude and self.exclude(os.path.relpath(entry.path, self.root)):
+                        continue
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            new_directory.dirs.add(entry.name)
+                        else:
+                            cost.files_stat += 1
+                            entry_st = entry.stat()
+                            new_directory.files[entry.name] = (
+                                entry_st.st_mtime_ns,
+                                entry_st.st_size,
+                            )
+                    except OSError:
+                        # the entry was deleted since it was listed, or is a broken symlink
+                        pass
+        except OSError:
+            self._forget(path, changes, report)
+            return
+        self._dirs[path] = new_directory
+
+        old_files = {} if directory is None else directory.files
+        old_dirs = set() if directory is None else directory.dirs
+        if report:
+            for name, signature in new_directory.files.items():
+                old_signature = old_files.get(name)
+                if old_signature is None:
+                    changes.add((Change.added, os.path.join(path, name)))
+                elif old_signature != signature:
+                    changes.add((Change.modified, os.path.join(path, name)))
+            for name in old_files.keys() - new_directory.files.keys():
+                changes.add((Change.deleted, os.path.join(path, name)))
+        for name in old_dirs - new_directory.dirs:
+            self._forget(os.path.join(path, name), changes, report)
+        for name in new_directory.dirs:
+            self._scan_dir(os.path.join(path, name), changes, cost, full, report, now)
+
+    def _stat_files(
+        self,
+        path: str,
+        directory: _Directory,
+        changes: set[FileChange],
+        cost: ScanCost,
+        report: bool,
+    ) -> None:
+        for name, signature in list(directory.files.items()):
+            file_path = os.path.join(path, name)
+            cost.files_stat += 1
+            try:
+                st = os.stat(file_path)
+            except OSError:
+                # the directory will be listed again at the next scan
+                del directory.files[name]
+                directory.mtime = -1
+                if report:
+                    changes.add((Change.deleted, file_path))
+                continue
+            new_signature = (st.st_mtime_ns, st.st_size)
+            if new_signature != signature:
+                directory.files[name] = new_signature
+                if report:
+                    changes.add((Change.modified, file_path))
+
+    def _forget(self, path: str, changes: set[FileChange], report: bool) -> None:
+        directory = self._dirs.pop(path, None)
+        if directory is None:
+            return
+        if report:
+            for name in directory.files:
+                changes.add((Change.deleted, os.path.join(path, name)))
+        for name in directory.dirs:
+            self._forget(os.path.join(path, name), changes, report)
+
+
+async def poll(
+    path: str,
+    stop_event: Event | None = None,
+    exclude: PathFilter | None = None,
+    min_interval: float = 0.4,
+    max_interval: float = 5,
+    full_scan_interval: float = 30,
+    max_load: float = 0.1,
+    scan_costs: dict[str, ScanCost] | None = None,
+) -> AsyncGenerator[set[FileChange], None]:
+    """Poll a directory using a stat cache.
+
+    The poll interval starts at `min_interval` and doubles after every scan without
+    changes, up to `max_interval`. It is also kept long enough for the scans to take at
+    most `max_load` of the time, so that a large tree doesn't keep a core busy.
+
+    Args:
+        path: The directory to watch.
+        stop_event: The event to set to stop polling.
+        exclude: The paths to ignore, relative to the watched directory.
+        min_interval: The minimum poll interval, in seconds.
+        max_interval: The maximum poll interval, in seconds.
+        full_scan_interval: The interval between full scans, in seconds.
+        max_load: The maximum fraction of time spent scanning.
+        scan_costs: A dictionary where to store the cost of the last scan of the directory.
+    """
+    stop_event = Event() if stop_event is None else stop_event
+    stat_cache = StatCache(path, exclude)
+    _, cost = await to_thread.run_sync(stat_cache.scan)
+    if scan_costs is not None:
+        scan_costs[path] = cost
+    last_full_scan = monotonic()
+    interval = min_interval
+    while True:
+        with move_on_after(max(interval, cost.duration / max_load)):
+            await stop_event.wait()
+        if stop_event.is_set():
+            return
+        full = monotonic() - last_full_scan >= full_scan_interval
+        if full:
+            last_full_scan = monotonic()
+        changes, cost = await to_thread.run_sync(stat_cache.scan, full)
+        if scan_costs is not None:
+            scan_costs[path] = cost
+        logger.debug(
+            "Scanned directory",
+            path=path,
+            changes=len(changes),
+            duration=cost.duration,
+            full=cost.full,
+            dirs_stat=cost.dirs_stat,
+            dirs_listed=cost.dirs_listed,
+            files_stat=cost.files_stat,
+        )
+        if changes:
+            interval = min_interval
+            yield changes
+        else:
+            interval = min(interval * 2, max_interval)
@@ -0,0 +1,108 @@
+import os
+import shutil
+from time import time
+
+import pytest
+from anyio import Event, create_task_group, fail_after, move_on_after, sleep
+from fps_file_watcher_poll.file_watcher import _FileWatcher
+from fps_file_watcher_poll.stat_cache import StatCache, poll
+from jupyverse_file_watcher import Change, FileWatcherHub, PathFilter
+
+
+def set_old_mtime(*paths):
+    # so that the directories are not listed again because they were just modified
+    mtime = time() - 60
+    for path in paths:
+        os.utime(path, (mtime, mtime))
+
+
+def test_stat_cache(tmp_path):
+    a = tmp_path / "a"
+    a.mkdir()
+    (a / "b.txt").write_text("b")
+    (tmp_path / "c.txt").write_text("c")
+    (tmp_path / "node_modules").mkdir()
+    set_old_mtime(tmp_path, a)
+
+    stat_cache = StatCache(str(tmp_path), PathFilter(["node_modules"]))
+    changes, cost = stat_cache.scan()
+    assert changes == set()
+    assert cost.dirs_listed == 2
+
+    # nothing changed, the directories are not listed
+    changes, cost = stat_cache.scan()
+    assert changes == set()
+    assert (cost.dirs_stat, cost.dirs_listed, cost.files_stat) == (2, 0, 0)
+
+    (a / "d.txt").write_text("d")
+    (tmp_path / "node_modules" / "e.js").write_text("e")
+    changes, cost = stat_cache.scan()
+    assert changes == {(Change.added, str(a / "d.txt"))}
+    assert cost.dirs_listed == 1
+    set_old_mtime(a)
+
+    # a file modified in place is only seen by a full scan
+    (tmp_path / "c.txt").write_text("cc")
+    changes, _ = stat_cache.scan()
+    assert changes == set()
+    changes, cost = stat_cache.scan(full=True)
+    assert changes == {(Change.modified, str(tmp_path / "c.txt"))}
+    assert cost.files_stat == 3
+
+    shutil.rmtree(a)
+    changes, _ = stat_cache.scan()
+    assert changes == {
+        (Change.deleted, str(a / "b.txt")),
+        (Change.deleted, str(a / "d.txt")),
+    }
+
+
+@pytest.mark.anyio
+async def test_poll_interval(tmp_path, monkeypatch):
+    delays = []
+
+    def record_delay(delay):
+        delays.append(delay)
+        if len(delays) == 5:
+            (tmp_path / "a.txt").write_text("a")
+        # don't actually wait
+        return move_on_after(0)
+
+    monkeypatch.setattr("fps_file_watcher_poll.stat_cache.move_on_after", record_delay)
+    stop_event = Event()
+    with fail_after(5):
+        async for changes in poll(
+            str(tmp_path), stop_event, min_interval=1, max_interval=4, max_load=1
+        ):
+            assert changes == {(Change.added, str(tmp_path / "a.txt"))}
+            stop_event.set()
+    # the interval doubles while nothing changes, and is reset by a change
+    assert delays == [1, 2, 4, 4, 4, 1]
+
+
+@pytest.mark.anyio
+async def test_scan_costs(tmp_path):
+    (tmp_path / "a.txt").write_text("a")
+    path = str(tmp_path)
+    stop_event = Event()
+    received = []
+
+    async def subscribe():
+        async for changes in hub.watch(path):
+            received.append(changes)
+            stop_event.set()
+
+    file_watcher = _FileWatcher(mode="stat_cache", min_interval=0.01)
+    with fail_after(5):
+        async with FileWatcherHub(file_watcher, stop_event) as hub:
+            async with create_task_group() as tg:
+                tg.start_soon(subscribe)
+                # the cost of the scans is available through the hub
+                scan_costs = hub.file_watcher.scan_costs
+                while path not in scan_costs:
+                    await sleep(0.01)
+                (tmp_path / "b.txt").write_text("b")
+                await stop_event.wait()
+                assert scan_costs[path].dirs_stat == 1
+                assert scan_costs[path].files_stat == 2
+    assert received == [{(Change.added, str(tmp_path / "b.txt"))}]
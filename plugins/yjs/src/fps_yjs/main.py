@@ -17,7 +17,13 @@ class YjsModule(Module):
         yroom_factory = await self.get(YRoomFactory)
         lifespan = await self.get(Lifespan)
 
-        async with YRooms(yroom_factory, lifespan.shutdown_request) as yrooms:
-            yjs = _Yjs(app, auth, file_id, yrooms)
+        async with YRooms(
+            yroom_factory,
+            lifespan.shutdown_request,
+            broker=yroom_factory.broker,
+            worker=yroom_factory.worker,
+            workers=yroom_factory.workers,
+        ) as yrooms:
+            yjs = _Yjs(app, auth, file_id, yrooms, yroom_factory.ystore_factory)
             self.put(yjs, Yjs)
             self.done()
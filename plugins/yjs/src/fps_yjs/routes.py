@@ -11,7 +11,8 @@ from jupyverse_auth import Auth, User
 from jupyverse_file_id import FileId
 from jupyverse_yjs import Yjs
 from jupyverse_yjs.models import CreateDocumentSession
-from jupyverse_yrooms import AsyncWebSocket, YRoom, YRooms
+from jupyverse_yrooms import AsyncWebSocket, YRoom, YRooms, get_ystore_path
+from jupyverse_ystore import YDocNotFound, YStoreFactory
 from pycrdt import Doc
 
 from .widgets import Widgets
@@ -26,10 +27,12 @@ class _Yjs(Yjs):
         auth: Auth,
         file_id: FileId,
         yrooms: YRooms,
+        ystore_factory: YStoreFactory | None = None,
     ) -> None:
         super().__init__(app=app, auth=auth)
         self.file_id = file_id
         self.yrooms = yrooms
+        self.ystore_factory = ystore_factory
         if Widgets is None:
             self.widgets = None
         else:
@@ -75,5 +78,24 @@ class _Yjs(Yjs):
         res["fileId"] = idx
         return res
 
+    async def get_version(
+        self,
+        room_id: str,
+        timestamp: float,
+        user: User,
+    ) -> Response:
+        updates_file_path = get_ystore_path(room_id)
+        if self.ystore_factory is None or updates_file_path is None:
+            raise HTTPException(status_code=404, detail=f"Room {room_id} is not stored")
+        doc: Doc = Doc()
+        async with self.ystore_factory(path=updates_file_path) as ystore:
+            try:
+                await ystore.apply_version(doc, timestamp)
+            except YDocNotFound:
+                raise HTTPException(
+                    status_code=404, detail=f"No version of room {room_id} at {timestamp}"
+                )
+        return Response(content=doc.get_update(), media_type="application/octet-stream")
+
     async def get_room(self, id: str, doc: Doc | None = None) -> YRoom:
         return await self.yrooms.get_room(id, doc=doc)
@@ -1,18 +1,21 @@
 import os
+from contextlib import asynccontextmanager
+from time import time
 
 import pytest
-from anyio import create_task_group
+from anyio import create_task_group, fail_after, sleep
 from fps import get_root_module
 from httpx2 import AsyncClient
 from httpx2.websockets import ASGIWebSocketTransport
 from jupyverse_yjs.models import CreateDocumentSession
+from jupyverse_yrooms import AsyncWebSocket
+from jupyverse_yrooms.client import AsyncClient as YClient
+from pycrdt import Doc, Text
 from structlog.testing import capture_logs
 
 
-@pytest.mark.anyio
-async def test_concurrent_disconnect(tmp_path, anyio_backend_name):
-    os.chdir(tmp_path)
-    config = {
+def get_config(**yrooms_config):
+    return {
         "jupyverse": {
             "type": "jupyverse",
             "config": {
@@ -29,6 +32,7 @@ async def test_concurrent_disconnect(tmp_path, anyio_backend_name):
                     "type": "yrooms",
                     "config": {
                         "document_cleanup_delay": 0,
+                        **yrooms_config,
                     },
                 },
                 "ystore_sqlite": {
@@ -53,6 +57,12 @@ async def test_concurrent_disconnect(tmp_path, anyio_backend_name):
         }
     }
 
+
+@pytest.mark.anyio
+async def test_concurrent_disconnect(tmp_path, anyio_backend_name):
+    os.chdir(tmp_path)
+    config = get_config()
+
     with capture_logs() as cap_logs:
         root_module = get_root_module(config)
         root_module._global_start_timeout = 10
@@ -84,3 +94,133 @@ async def test_concurrent_disconnect(tmp_path, anyio_backend_name):
         "event": "Application failed",
         "log_level": "critical",
     } not in cap_logs
+
+
+@pytest.mark.anyio
+async def test_get_version(tmp_path):
+    os.chdir(tmp_path)
+    config = get_config()
+    root_module = get_root_module(config)
+    root_module._global_start_timeout = 10
+    async with root_module as root_module:
+        app = root_module.app
+        transport = ASGIWebSocketTransport(app=app)
+        async with AsyncClient(transport=transport, base_url="http://testserver") as client:
+            data = CreateDocumentSession(format="text", type="file")
+            p = tmp_path / "hello.txt"
+            p.write_text("hello")
+            t0 = time()
+            response = await client.put(
+                f"http://testserver/api/collaboration/session/{p}",
+                json=dict(data),
+            )
+            file_id = response.json()["fileId"]
+            room_id = f"text:file:{file_id}"
+            # opening the room stores the document
+            async with client.websocket(f"http://testserver/api/collaboration/room/{room_id}"):
+                await sleep(0.5)
+
+            response = await client.get(
+                f"http://testserver/api/collaboration/version/{room_id}",
+                params={"timestamp": time()},
+            )
+            assert response.status_code == 200
+            doc = Doc()
+            doc.apply_update(response.content)
+            assert str(doc.get("source", type=Text)) == "hello"
+
+            response = await client.get(
+                f"http://testserver/api/collaboration/version/{room_id}",
+                params={"timestamp": t0 - 1},
+            )
+            assert response.status_code == 404
+
+
+@asynccontextmanager
+async def open_document(client, path):
+    # connect a client document to the room of a text file
+    data = CreateDocumentSession(format="text", type="file")
+    response = await client.put(
+        f"http://testserver/api/collaboration/session/{path}",
+        json=dict(data),
+    )
+    room_id = f"text:file:{response.json()['fileId']}"
+    doc = Doc()
+    async with (
+        client.websocket(f"http://testserver/api/collaboration/room/{room_id}") as ws,
+        YClient(AsyncWebSocket(ws, room_id), doc),
+    ):
+        yield doc.get("source", type=Text)
+
+
+def get_saves(cap_logs):
+    return [log for log in cap_logs if log["event"] == "Saving document"]
+
+
+@pytest.mark.anyio
+async def test_save(tmp_path):
+    os.chdir(tmp_path)
+    config = get_config(document_save_delay=0.1)
+    p = tmp_path / "hello.txt"
+    p.write_text("hello")
+
+    with capture_logs() as cap_logs:
+        root_module = get_root_module(config)
+        root_module._global_start_timeout = 10
+        async with root_module as root_module:
+            transport = ASGIWebSocketTransport(app=root_module.app)
+            async with AsyncClient(transport=transport, base_url="http://testserver") as client:
+                async with open_document(client, p) as text:
+                    with fail_after(5):
+                        while str(text) != "hello":
+                            await sleep(0.1)
+                        text += " world"
+                        while p.read_text() != "hello world":
+                            await sleep(0.1)
+                    assert len(get_saves(cap_logs)) == 1
+
+                    # an unchanged document is not written again
+                    mtime = p.stat().st_mtime_ns
+                    text += "!"
+                    del text[len(text) - 1]
+                    await sleep(0.5)
+                    assert len(get_saves(cap_logs)) == 1
+                    assert p.stat().st_mtime_ns == mtime
+
+                    # an external change is read in the document
+                    p.write_text("bye")
+                    new_mtime = time() + 10
+                    os.utime(p, (new_mtime, new_mtime))
+                    with fail_after(5):
+                        while str(text) != "bye":
+                            await sleep(0.1)
+                    assert len(get_saves(cap_logs)) == 1
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("document_save_max_delay", (0.5, 0))
+async def test_save_max_delay(tmp_path, document_save_max_delay):
+    os.chdir(tmp_path)
+    config = get_config(document_save_delay=0.3, document_save_max_delay=document_save_max_delay)
+    p = tmp_path / "hello.txt"
+    p.write_text("")
+
+    root_module = get_root_module(config)
+    root_module._global_start_timeout = 10
+    async with root_module as root_module:
+        transport = ASGIWebSocketTransport(app=root_module.app)
+        async with AsyncClient(transport=transport, base_url="http://testserver") as client:
+            async with open_document(client, p) as text:
+                await sleep(0.5)
+                # the document keeps changing faster than the save delay
+                saved_while_editing = False
+                for _ in range(15):
+                    text += "a"
+                    await sleep(0.1)
+                    saved_while_editing = saved_while_editing or bool(p.read_text())
+                # the document is saved once it stops changing
+                with fail_after(5):
+                    while p.read_text() != "a" * 15:
+                        await sleep(0.1)
+    # without a maximum delay the save waits for the changes to stop
+    assert saved_while_editing == bool(document_save_max_delay)
@@ -16,3 +16,64 @@ class YRoomsConfig(Config):
         ),
         default=1,
     )
+    document_save_max_delay: float = Field(
+        description=(
+            "The maximum time (in seconds) a change waits before the document is saved to "
+            "disk, even if the document keeps changing, or 0 to wait until the document "
+            "stops changing."
+        ),
+        default=10,
+    )
+    send_queue_size: int = Field(
+        description=(
+            "The maximum number of messages queued for a client. A client whose queue "
+            "overflows is resynchronized with the whole document."
+        ),
+        default=256,
+    )
+    coalescing_window: float = Field(
+        description=(
+            "The time to wait (in seconds) after a document change before broadcasting it "
+            "to the clients, merged with the changes made in the meantime. "
+            "0 broadcasts every change right away."
+        ),
+        default=0,
+    )
+    awareness_interval: float = Field(
+        description=(
+            "The time to wait (in seconds) after an awareness change (e.g. a cursor move) "
+            "before sending it to the other clients, merged with the awareness changes "
+            "made in the meantime. 0 sends every change right away."
+        ),
+        default=0.1,
+    )
+    workers: int = Field(
+        description=(
+            "The number of jupyverse worker processes sharing the collaboration rooms. "
+            "Each worker owns the rooms whose ID hash falls in its shard, and stores their "
+            "documents. The other workers serve replicas of these rooms, which are "
+            "synchronized with them through a broker. The workers are launched separately, "
+            "from the same directory. Several workers are not supported on Windows."
+        ),
+        default=1,
+    )
+    worker: int = Field(
+        description=(
+            "The index of this worker, between 0 and the number of workers. "
+            "Worker 0 hosts the broker."
+        ),
+        default=0,
+    )
+    broker_path: str = Field(
+        description="The path of the Unix socket of the broker connecting the workers.",
+        default=".jupyter_yrooms.sock",
+    )
+    hibernation_delay: float = Field(
+        description=(
+            "The time (in seconds) without activity after which a room hibernates, "
+            "or 0 to never hibernate. A hibernating room releases its document from memory "
+            "after storing it in the YStore, while its clients stay connected. The document "
+            "is restored on the next message from a client."
+        ),
+        default=0,
+    )
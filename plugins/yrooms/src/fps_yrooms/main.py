@@ -1,10 +1,12 @@
+from contextlib import AsyncExitStack
 from functools import partial
 from typing import Any
 
+from anyio import sleep_forever
 from fps import Module
 from jupyverse_contents import Contents
 from jupyverse_file_id import FileId
-from jupyverse_yrooms import YRoomFactory
+from jupyverse_yrooms import UnixSocketBroker, YRoomFactory
 from jupyverse_ystore import YStoreFactory
 
 from .config import YRoomsConfig
@@ -20,7 +22,20 @@ class YRoomsModule(Module):
         contents = await self.get(Contents)  # type: ignore[type-abstract]
         file_id = await self.get(FileId)  # type: ignore[type-abstract]
         ystore_factory = await self.get(YStoreFactory)
-        yroom_factory = YRoomFactory(
-            partial(YRoom, contents, file_id, ystore_factory, self.config)  # type: ignore[arg-type]
-        )
-        self.put(yroom_factory)
+        async with AsyncExitStack() as exit_stack:
+            broker = None
+            if self.config.workers > 1:
+                broker = await exit_stack.enter_async_context(
+                    UnixSocketBroker(self.config.broker_path, hub=self.config.worker == 0)
+                )
+            yroom_factory = YRoomFactory(
+                partial(YRoom, contents, file_id, ystore_factory, self.config),  # type: ignore[arg-type]
+                broker=broker,
+                worker=self.config.worker,
+                workers=self.config.workers,
+                ystore_factory=ystore_factory,
+            )
+            self.put(yroom_factory)
+            if broker is not None:
+                self.done()
+                await sleep_forever()
@@ -1,28 +1,36 @@
+import json
 from datetime import datetime
+from hashlib import sha256
+from typing import Any
 
 import structlog
 from anyio import (
     CancelScope,
+    Event,
+    create_task_group,
+    current_time,
+    move_on_after,
     sleep,
 )
 from anyio.abc import TaskStatus
 from jupyter_ydoc import ydocs as YDOCS
 from jupyverse_contents import Contents
+from jupyverse_contents.models import Content
 from jupyverse_file_id import FileId
-from jupyverse_yrooms import AsyncChannel
+from jupyverse_yrooms import AsyncChannel, get_ystore_path
 from jupyverse_yrooms import YRoom as _YRoom
 from jupyverse_ystore import YDocNotFound, YStoreFactory
 from pycrdt import (
     Doc,
     YMessageType,
     YSyncMessageType,
-    handle_sync_message,
 )
 
 from .config import YRoomsConfig
 
 logger = structlog.get_logger()
 YFILE = YDOCS["file"]
+EMPTY_UPDATE = Doc().get_update()
 
 
 class YRoom(_YRoom):
@@ -36,15 +44,33 @@ class YRoom(_YRoom):
         sync: bool = True,
         doc: Doc | None = None,
         permissions: dict[str, list[str]] | None = None,
+        upstream: AsyncChannel | None = None,
     ) -> None:
-        super().__init__(id, sync, doc=doc)
+        super().__init__(
+            id,
+            sync,
+            doc=doc,
+            send_queue_size=config.send_queue_size,
+            coalescing_window=config.coalescing_window,
+            hibernation_delay=config.hibernation_delay,
+            upstream=upstream,
+            awareness_interval=config.awareness_interval,
+        )
         self._contents = contents
         self._file_id = file_id
         self._ystore_factory = ystore_factory
         self._config = config
         self._close_room_cancel_scope: CancelScope | None = None
-        self._write_to_file_cancel_scope: CancelScope | None = None
+        self._unsaved_changes = False
         self._id_of_file: str | None = None
+        # the hash of the document content that is in the file, if known
+        self._content_hash: str | None = None
+        # the source of the stored document, i.e. the file it is in sync with,
+        # as long as no update was dispatched since then
+        self._source: tuple[bytes, int] | None = None
+        # the number of dispatched updates that are stored in the YStore
+        self._persisted_updates = 0
+        self._persisted = Event()
         self._can_write = permissions is None or "write" in permissions.get("yjs", [])
 
     async def serve(self, client: AsyncChannel) -> None:
@@ -67,19 +93,30 @@ class YRoom(_YRoom):
             # it is a stored document (e.g. a notebook)
             self._file_format, self._file_type, self._id_of_file = self.id.split(":", 2)
             self._jupyter_ydoc = YDOCS.get(self._file_type, YFILE)(self.doc)
-            self._jupyter_ydoc.ystate["file_id"] = self._id_of_file
             file_path = await self._get_file_path(self._id_of_file)
             assert file_path is not None
             kwargs["file_path"] = file_path
+            if self.upstream is not None:
+                # the document is stored by the worker owning the room
+                logger.info("Opening collaboration room replica", **kwargs)
+                await super().run(task_status=task_status)
+                return
+            self._jupyter_ydoc.ystate["file_id"] = self._id_of_file
             logger.info("Opening collaboration room", **kwargs)
-            model = await self._contents.read_content(file_path, True, self._file_format)
+            model = await self._contents.read_content(file_path, False)
             assert model.last_modified is not None
             self._last_modified = to_datetime(model.last_modified)
-            updates_file_path = f".{self._file_type}:{self._id_of_file}.y"
-            async with self._ystore_factory(path=updates_file_path) as self._ystore:
+            self._content_hash = None
+            self._source = None
+            updates_file_path = get_ystore_path(self.id)
+            assert updates_file_path is not None
+            async with (
+                self._ystore_factory(path=updates_file_path) as self._ystore,
+                create_task_group() as self._document_task_group,
+            ):
                 # try to apply Y updates from the YStore for this document
                 try:
-                    await self._ystore.apply_updates(self.doc)
+                    source = await self._ystore.apply_updates(self.doc)
                     read_from_source = False
                 except YDocNotFound:
                     # YDoc not found in the YStore, create the document from
@@ -87,73 +124,171 @@ class YRoom(_YRoom):
                     read_from_source = True
                     logger.info("Document not found in YStore", file_path=file_path, id=self.id)
                 if not read_from_source:
-                    # if YStore updates and source file are out-of-sync, resync updates
-                    # with source
-                    if await self._jupyter_ydoc.aget() != model.content:
-                        read_from_source = True
-                        logger.info(
-                            "Document in YStore differs from file content",
-                            file_path=file_path,
-                            id=self.id,
+                    stored_source = read_source(source, model)
+                    if stored_source is not None:
+                        # the file didn't change since the stored document was in sync
+                        # with it, no need to compare them
+                        self._content_hash = stored_source["hash"]
+                        self._source = source, self._get_dispatched_updates()
+                    else:
+                        model = await self._contents.read_content(
+                            file_path, True, self._file_format
                         )
-                await self.task_group.start(self._write_to_ystore)
-                await self.task_group.start(self._write_to_file)
-                await self.task_group.start(self._watch_file)
+                        # if YStore updates and source file are out-of-sync, resync updates
+                        # with source
+                        if await self._jupyter_ydoc.aget() != model.content:
+                            read_from_source = True
+                            logger.info(
+                                "Document in YStore differs from file content",
+                                file_path=file_path,
+                                id=self.id,
+                            )
+                        else:
+                            self._set_source(model, None, self._get_dispatched_updates())
+                            await self._ystore.write(EMPTY_UPDATE, self._get_source())
                 if read_from_source:
+                    if model.content is None:
+                        model = await self._contents.read_content(
+                            file_path, True, self._file_format
+                        )
+                    assert model.last_modified is not None
+                    self._last_modified = to_datetime(model.last_modified)
                     await self._jupyter_ydoc.aset(model.content)
-                    await self._ystore.encode_state_as_update(self.doc)
+                    self._set_source(model, None, self._get_dispatched_updates())
+                    await self._ystore.encode_state_as_update(self.doc, self._get_source())
                     logger.info("Document read from file", file_path=file_path, id=self.id)
                 else:
                     logger.info("Document read from YStore", file_path=file_path, id=self.id)
 
                 self._jupyter_ydoc.dirty = False
+                # the tasks bound to the document stop when the room hibernates,
+                # the document updates are persisted and then saved to the file
+                await self._document_task_group.start(self._write_to_ystore)
+                await self._document_task_group.start(self._write_to_file)
+                await self._document_task_group.start(self._watch_file)
                 await super().run(task_status=task_status)
         else:
             logger.info("Opening collaboration room", **kwargs)
             await super().run(task_status=task_status)
 
     async def _write_to_ystore(self, *, task_status: TaskStatus[None]) -> None:
-        async with self.doc.events() as events:
+        with self.event_stage("persistence") as updates:
             task_status.started()
-            async for event in events:
-                await self._ystore.write(event.update)
+            async for update in updates:
+                # the updates that arrived while the previous ones were written are
+                # written together
+                pending_updates = [update, *updates.receive_pending()]
+                dispatched_updates = updates.metrics.dispatched
+                await self._ystore.write_updates(pending_updates)
+                self._persisted_updates = dispatched_updates
+                self._persisted.set()
+                self._persisted = Event()
 
     async def _write_to_file(self, *, task_status: TaskStatus[None]) -> None:
-        async with self.doc.events() as events:
+        # save the document when it has not changed for document_save_delay seconds,
+        # or document_save_max_delay seconds after its first unsaved change
+        with self.event_stage("save") as updates:
             task_status.started()
-            async for event in events:
-                if self._write_to_file_cancel_scope is not None:
-                    self._write_to_file_cancel_scope.cancel()
-                    self._write_to_file_cancel_scope = None
-                self.task_group.start_soon(self._write_to_file_later)
-
-    async def _write_to_file_later(self) -> None:
-        with CancelScope() as self._write_to_file_cancel_scope:
-            await sleep(self._config.document_save_delay)
-            assert self._id_of_file is not None
-            file_path = await self._get_file_path(self._id_of_file)
-            assert file_path is not None
+            async for _ in updates:
+                self._unsaved_changes = True
+                deadline = current_time() + (self._config.document_save_max_delay or float("inf"))
+                while True:
+                    delay = min(self._config.document_save_delay, deadline - current_time())
+                    with move_on_after(delay) as scope:
+                        await updates.receive()
+                    if scope.cancelled_caught:
+                        break
+                self._unsaved_changes = False
+                await self._save()
+
+    async def _save(self) -> None:
+        assert self._id_of_file is not None
+        file_path = await self._get_file_path(self._id_of_file)
+        assert file_path is not None
+        dispatched_updates = self._get_dispatched_updates()
+        jupyter_ydoc_source = await self._jupyter_ydoc.aget()
+        # the content is serialized once, to be hashed and written
+        serialized_content = serialize_content(jupyter_ydoc_source, self._file_type)
+        content_hash = get_content_hash(serialized_content)
+        model = await self._contents.read_content(file_path, False)
+        assert model.last_modified is not None
+        if (
+            self._content_hash is not None
+            and to_datetime(model.last_modified) <= self._last_modified
+        ):
+            # the file didn't change since we read or wrote it,
+            # compare the hashes instead of the contents
+            changed = content_hash != self._content_hash
+        else:
             model = await self._contents.read_content(
                 file_path, True, self._file_format, untrust=False
             )
-            jupyter_ydoc_source = await self._jupyter_ydoc.aget()
-            if model.content != jupyter_ydoc_source:
-                # don't save if not needed
-                # this also prevents the dirty flag from bouncing between windows of
-                # the same document opened as different types (e.g. notebook/text editor)
-                content = {
-                    "content": jupyter_ydoc_source,
-                    "format": self._file_format,
-                    "path": file_path,
-                    "type": self._file_type,
-                }
-                with CancelScope(shield=True):
-                    logger.info("Saving document", file_path=file_path, id=self.id)
-                    await self._contents.write_content(content)
-                    model = await self._contents.read_content(file_path, False)
-                    assert model.last_modified is not None
-                    self._last_modified = to_datetime(model.last_modified)
-                self._jupyter_ydoc.dirty = False
+            assert model.last_modified is not None
+            changed = model.content != jupyter_ydoc_source
+            if not changed:
+                self._last_modified = to_datetime(model.last_modified)
+                self._content_hash = content_hash
+        if changed:
+            # don't save if not needed
+            # this also prevents the dirty flag from bouncing between windows of
+            # the same document opened as different types (e.g. notebook/text editor)
+            content = {
+                "content": serialized_content,
+                "format": "text" if self._file_format == "json" else self._file_format,
+                "path": file_path,
+                "type": self._file_type,
+            }
+            with CancelScope(shield=True):
+                logger.info("Saving document", file_path=file_path, id=self.id)
+                await self._contents.write_content(content)
+                model = await self._contents.read_content(file_path, False)
+                assert model.last_modified is not None
+                self._last_modified = to_datetime(model.last_modified)
+                self._content_hash = content_hash
+            self._jupyter_ydoc.dirty = False
+        self._set_source(model, content_hash, dispatched_updates)
+        if self._get_source():
+            # the stored document is in sync with the file once the updates dispatched
+            # before the save are stored, if no update was dispatched in the meantime
+            while self._persisted_updates < dispatched_updates:
+                await self._persisted.wait()
+            source = self._get_source()
+            if source:
+                await self._ystore.write(EMPTY_UPDATE, source)
+
+    def _get_dispatched_updates(self) -> int:
+        metrics = self.metrics.get("save")
+        return 0 if metrics is None else metrics.dispatched
+
+    def _set_source(
+        self, model: Content, content_hash: str | None, dispatched_updates: int
+    ) -> None:
+        source = {"last_modified": model.last_modified, "size": model.size, "hash": content_hash}
+        self._source = json.dumps(source).encode(), dispatched_updates
+
+    def _get_source(self) -> bytes:
+        if self._source is None:
+            return b""
+        source, dispatched_updates = self._source
+        if dispatched_updates != self._get_dispatched_updates():
+            # the document changed since it was in sync with the file
+            return b""
+        return source
+
+    async def flush(self) -> bool:
+        if self._id_of_file is None:
+            # the document is not stored
+            return False
+        if self._unsaved_changes:
+            # save now instead of later
+            self._unsaved_changes = False
+            await self._save()
+        # the whole document is stored, with the updates that were not persisted yet
+        dispatched_updates = self._get_dispatched_updates()
+        await self._ystore.encode_state_as_update(self.doc, self._get_source())
+        self._persisted_updates = max(self._persisted_updates, dispatched_updates)
+        logger.info("Hibernating collaboration room", id=self.id)
+        return True
 
     async def _watch_file(self, *, task_status: TaskStatus[None]) -> None:
         assert self._id_of_file is not None
@@ -161,18 +296,24 @@ class YRoom(_YRoom):
         assert file_path is not None
         logger.info("Watching file", path=file_path)
         watcher = self._file_id.watch(file_path)
+        watched_path: str | None = file_path
         task_status.started()
-        async for changes in watcher:
-            new_file_path = await self._get_file_path(self._id_of_file)
-            assert new_file_path is not None
-            if new_file_path is None:
-                continue
-            if new_file_path != file_path:
-                # file was renamed
-                self._file_id.unwatch(file_path, watcher)
-                file_path = new_file_path
-                # break
-            await self._read_file(new_file_path)
+        try:
+            async for changes in watcher:
+                new_file_path = await self._get_file_path(self._id_of_file)
+                assert new_file_path is not None
+                if new_file_path is None:
+                    continue
+                if new_file_path != file_path:
+                    # file was renamed
+                    self._file_id.unwatch(file_path, watcher)
+                    watched_path = None
+                    file_path = new_file_path
+                    # break
+                await self._read_file(new_file_path)
+        finally:
+            if watched_path is not None:
+                self._file_id.unwatch(watched_path, watcher)
 
     async def _read_file(self, file_path: str) -> None:
         model = await self._contents.read_content(file_path, False)
@@ -187,13 +328,17 @@ class YRoom(_YRoom):
             logger.info("Document read from file", file_path=file_path, id=self.id)
             await self._ystore.encode_state_as_update(self._doc)
             self._last_modified = to_datetime(model.last_modified)
+            self._content_hash = None
+            self._source = None
 
     async def _get_file_path(self, id_of_file: str) -> str | None:
         file_path = await self._file_id.get_path(id_of_file)
         if file_path is None:
             return None
-        if file_path != self._jupyter_ydoc.path:
-            self._jupyter_ydoc.path = file_path
+        # the Jupyter YDoc is released when the room hibernates
+        jupyter_ydoc = getattr(self, "_jupyter_ydoc", None)
+        if jupyter_ydoc is not None and file_path != jupyter_ydoc.path:
+            jupyter_ydoc.path = file_path
         return file_path
 
     async def handle_message(self, message: bytes, client: AsyncChannel) -> None:
@@ -204,12 +349,14 @@ class YRoom(_YRoom):
                     YSyncMessageType.SYNC_UPDATE,
                     YSyncMessageType.SYNC_STEP2,
                 }:
-                    reply = handle_sync_message(_message, self._doc)
+                    reply = await self.handle_sync_message(_message)
                     if reply is not None:
-                        await client.send(reply)
+                        self.send(client, reply)
             case YMessageType.AWARENESS:
-                for client in self.clients:
-                    await client.send(message)
+                self.handle_awareness_message(message, client)
+
+    def on_overflow(self, client: AsyncChannel) -> None:
+        logger.warning("Client doesn't keep up, it will be resynchronized", id=self.id)
 
     async def close(self) -> None:
         with CancelScope() as self._close_room_cancel_scope:
@@ -220,8 +367,55 @@ class YRoom(_YRoom):
                 kwargs["file_path"] = file_path
                 await sleep(self._config.document_cleanup_delay)
             await super().close()
-            logger.info("Closed collaboration room", **kwargs)
+            max_lags = {name: metrics.max_lag for name, metrics in self.metrics.items()}
+            logger.info("Closed collaboration room", max_lags=max_lags, **kwargs)
 
 
 def to_datetime(iso_date: str) -> datetime:
     return datetime.fromisoformat(iso_date.rstrip("Z"))
+
+
+def read_source(source: bytes, model: Content) -> dict[str, Any] | None:
+    """
+    Args:
+        source: The source stored with a document, if any.
+        model: The model of the file of the document, without its content.
+
+    Returns:
+        The stored source, if it is the current version of the file.
+    """
+    try:
+        stored_source = json.loads(source)
+    except ValueError:
+        return None
+    if (
+        not isinstance(stored_source, dict)
+        or stored_source.get("last_modified") != model.last_modified
+        or stored_source.get("size") != model.size
+    ):
+        return None
+    return stored_source
+
+
+def serialize_content(content: Any, file_type: str) -> str:
+    """
+    Args:
+        content: The content of a document, as returned by the Jupyter YDoc.
+        file_type: The type of the document file.
+
+    Returns:
+        The content of the document file.
+    """
+    if isinstance(content, str):
+        return content
+    if file_type == "notebook" and "orig_nbformat" in content.get("metadata", {}):
+        # see https://github.com/jupyterlab/jupyterlab/issues/11005
+        metadata = dict(content["metadata"])
+        del metadata["orig_nbformat"]
+        content = {**content, "metadata": metadata}
+    # serialized like Contents.write_content() does
+    return json.dumps(content, indent=2)
+
+
+def get_content_hash(serialized_content: str) -> str:
+    return sha256(serialized_content.encode()).hexdigest()
@@ -0,0 +1,65 @@
+from functools import partial
+from pathlib import Path
+
+import anyio
+from fps import Module
+from jupyverse_api import Config
+from jupyverse_ystore import YStoreFactory
+from pydantic import Field
+
+from .ystore import FileYStore, compact_directory
+
+
+class YStoreFileModule(Module):
+    def __init__(self, name: str, **kwargs):
+        super().__init__(name)
+        self.config = YStoreFileConfig(**kwargs)
+
+    async def prepare(self) -> None:
+        file_ystore_factory = YStoreFactory(
+            partial(
+                FileYStore,  # type: ignore[arg-type]
+                directory=self.config.directory,
+                segment_size=self.config.segment_size,
+                fsync=self.config.fsync,
+            )
+        )
+        self.put(file_ystore_factory)
+        self.done()
+        if not self.config.compaction_interval:
+            await anyio.sleep_forever()
+        while True:
+            await anyio.sleep(self.config.compaction_interval)
+            await anyio.to_thread.run_sync(
+                compact_directory, Path(self.config.directory), self.config.fsync
+            )
+
+
+class YStoreFileConfig(Config):
+    directory: str = Field(
+        description="The directory of the segment files.",
+        default=".jupyter_ystore.db.d",
+    )
+    segment_size: int = Field(
+        description=(
+            "The size (in bytes) above which the updates of a document are appended to a "
+            "new segment file."
+        ),
+        default=4 * 1024 * 1024,
+    )
+    fsync: bool = Field(
+        description=(
+            "Whether to flush every update to disk before the write returns. "
+            "Disabling it is faster, but the last updates can be lost on a system crash."
+        ),
+        default=True,
+    )
+    compaction_interval: float = Field(
+        description=(
+            "The time (in seconds) between compactions of the segment files, "
+            "or 0 to disable compaction. "
+            "A compaction merges all the segments of a document but the last one into a "
+            "snapshot."
+        ),
+        default=60,
+    )
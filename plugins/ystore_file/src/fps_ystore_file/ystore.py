@@ -0,0 +1,349 @@
+import mmap
+import os
+import struct
+import sys
+import zlib
+from collections.abc import AsyncIterator, Iterator
+from contextlib import ExitStack, contextmanager
+from hashlib import sha256
+from pathlib import Path
+from threading import Lock
+from time import time
+from typing import BinaryIO
+from weakref import WeakValueDictionary
+
+from anyio import to_thread
+from jupyverse_ystore import YDocNotFound, YStore
+from pycrdt import Doc, merge_updates
+
+if sys.version_info >= (3, 11):
+    from typing import Self
+else:
+    from typing_extensions import Self
+
+# a record is a header followed by the update and the metadata
+# header: update length, metadata length, CRC32 of the update and metadata, timestamp, flags
+HEADER = struct.Struct("<IIIdB")
+SNAPSHOT = 1
+SEGMENT_SUFFIX = ".seg"
+
+# the offsets of the update, of the metadata and of the end of a record,
+# its timestamp and whether it is a snapshot
+Record = tuple[int, int, int, float, bool]
+
+# segments are not replaced by a compaction while they are being opened,
+# the lock of a document is dropped when it is not used
+_locks: WeakValueDictionary[Path, Lock] = WeakValueDictionary()
+_locks_lock = Lock()
+
+
+def get_lock(directory: Path) -> Lock:
+    with _locks_lock:
+        lock = _locks.get(directory)
+        if lock is None:
+            lock = _locks[directory] = Lock()
+        return lock
+
+
+class FileYStore(YStore):
+    """A YStore where the updates of a document are appended to segment files.
+
+    The updates of a document are appended to the last of its segment files, in a
+    directory named after the hash of the document path. A new segment is started when
+    the last one is larger than `segment_size`. A compaction merges all the segments
+    but the last one into a snapshot, which replaces them.
+
+    Segments are read through memory maps: a read starts from the newest segment
+    beginning with a snapshot, and an incomplete record at the end of a segment (after a
+    crash) is ignored.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        directory: str,
+        segment_size: int = 4 * 1024 * 1024,
+        fsync: bool = True,
+    ) -> None:
+        """
+        Args:
+            path: The document path.
+            directory: The directory of the store.
+            segment_size: The size (in bytes) above which a new segment is started.
+            fsync: Whether to flush every write to disk before returning.
+        """
+        self._path = path
+        self._directory = Path(directory) / sha256(path.encode()).hexdigest()
+        self._segment_size = segment_size
+        self._fsync = fsync
+
+    async def __aenter__(self) -> Self:
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, exc_tb) -> bool | None:
+        return None
+
+    async def read(self) -> AsyncIterator[tuple[bytes, bytes, float]]:  # type: ignore
+        files = await to_thread.run_sync(open_segments, self._directory)
+        found = False
+        try:
+            for file in files:
+                records = await to_thread.run_sync(read_segment, file)
+                for update, metadata, timestamp in records:
+                    found = True
+                    yield update, metadata, timestamp
+        finally:
+            for file in files:
+                file.close()
+        if not found:
+            raise YDocNotFound
+
+    async def apply_updates(self, ydoc: Doc) -> bytes:
+        """Apply all stored updates to the YDoc.
+
+        The updates are merged from the memory-mapped segments without being copied,
+        and applied at once.
+
+        Arguments:
+            ydoc: The YDoc on which to apply the updates.
+
+        Returns:
+            The metadata of the last update.
+        """
+        merged = await to_thread.run_sync(self._merge)
+        if merged is None:
+            raise YDocNotFound
+        update, metadata, _ = merged
+        ydoc.apply_update(update)
+        return metadata
+
+    async def write(self, data: bytes, metadata: bytes = b"") -> None:
+        await to_thread.run_sync(self._append, encode_record(data, metadata, time(), False))
+
+    async def write_updates(self, updates: list[bytes], metadata: bytes = b"") -> None:
+        timestamp = time()
+        records = b"".join(encode_record(update, metadata, timestamp, False) for update in updates)
+        await to_thread.run_sync(self._append, records)
+
+    async def compact(self) -> None:
+        """Merges all the segments of the document but the last one into a snapshot."""
+        await to_thread.run_sync(compact_segments, self._directory, self._fsync)
+
+    @property
+    def segments(self) -> list[Path]:
+        """
+        Returns:
+            The segment files of the document, in order.
+        """
+        return get_segments(self._directory)
+
+    def _merge(self) -> tuple[bytes, bytes, float] | None:
+        files = open_segments(self._directory)
+        try:
+            return merge_segments(files)
+        finally:
+            for file in files:
+                file.close()
+
+    def _append(self, records: bytes) -> None:
+        self._directory.mkdir(parents=True, exist_ok=True)
+        # concurrent writers must append to the same segment
+        with get_lock(self._directory):
+            segments = self.segments
+            if not segments:
+                segment = self._directory / f"{0:012d}{SEGMENT_SUFFIX}"
+            else:
+                segment = segments[-1]
+                if segment.stat().st_size >= self._segment_size:
+                    index = int(segment.stem) + 1
+                    segment = self._directory / f"{index:012d}{SEGMENT_SUFFIX}"
+            with open(segment, "ab") as f:
+                f.write(records)
+                f.flush()
+                if self._fsync:
+                    os.fsync(f.fileno())
+
+
+def get_segments(directory: Path) -> list[Path]:
+    if not directory.exists():
+        return []
+    return sorted(directory.glob(f"*{SEGMENT_SUFFIX}"))
+
+
+def open_segments(directory: Path) -> list[BinaryIO]:
+    """Opens the segments of a document to read, from the newest one beginning with a
+    snapshot: the previous segments are in the snapshot.
+
+    Args:
+        directory: The directory of the document.
+
+    Returns:
+        The open segment files, which stay readable if a compaction replaces them. On
+        Windows, the segments can't be replaced while they are open, and the
+        compaction is retried later.
+    """
+    with get_lock(directory):
+        segments = get_segments(directory)
+        for i in range(len(segments) - 1, 0, -1):
+            with open(segments[i], "rb") as f:
+                header = f.read(HEADER.size)
+            if len(header) == HEADER.size and HEADER.unpack(header)[-1] & SNAPSHOT:
+                segments = segments[i:]
+                break
+        return [open(segment, "rb") for segment in segments]
+
+
+def read_segment(file: BinaryIO) -> list[tuple[bytes, bytes, float]]:
+    records = []
+    with map_segment(file) as buffer:
+        for start, metadata_start, end, timestamp, _ in iter_records(buffer):
+            records.append(
+                (
+                    copy(buffer, start, metadata_start),
+                    copy(buffer, metadata_start, end),
+                    timestamp,
+                )
+            )
+    return records
+
+
+def merge_segments(files: list[BinaryIO]) -> tuple[bytes, bytes, float] | None:
+    """Merges the updates of segments.
+
+    Args:
+        files: The open segment files.
+
+    Returns:
+        The merged update, and the metadata and timestamp of the last update, if any.
+    """
+    with ExitStack() as exit_stack:
+        updates = []
+        metadata, timestamp = b"", 0.0
+        for file in files:
+            buffer = exit_stack.enter_context(map_segment(file))
+            for start, metadata_start, end, timestamp, _ in iter_records(buffer):
+                # the views are released before the memory maps are closed
+                updates.append(exit_stack.enter_context(buffer[start:metadata_start]))
+                metadata = copy(buffer, metadata_start, end)
+        if not updates:
+            return None
+        return merge_updates(*updates), metadata, timestamp  # type: ignore[arg-type]
+
+
+def compact_segments(directory: Path, fsync: bool) -> None:
+    """Merges all the segments of a document but the last one into a snapshot.
+
+    Updates are only appended to the last segment, so the compacted segments don't
+    change during the compaction. If the segments can't be replaced because they are
+    being read (on Windows), they are kept and merged again by the next compaction.
+
+    Args:
+        directory: The directory of the document.
+        fsync: Whether to flush the snapshot to disk before replacing the segments.
+    """
+    segments = get_segments(directory)[:-1]
+    if not segments or (len(segments) == 1 and is_snapshot(segments[0])):
+        # nothing to merge
+        return
+    with ExitStack() as exit_stack:
+        files: list[BinaryIO] = [
+            exit_stack.enter_context(open(segment, "rb")) for segment in segments
+        ]
+        merged = merge_segments(files)
+        if merged is None:
+            return
+        snapshot, metadata, timestamp = merged
+    # the snapshot replaces the last compacted segment, the previous ones can then be
+    # deleted: at any time, the segments contain the whole document
+    tmp_path = segments[-1].with_suffix(".tmp")
+    with open(tmp_path, "wb") as f:
+        f.write(encode_record(snapshot, metadata, timestamp, True))
+        f.flush()
+        if fsync:
+            os.fsync(f.fileno())
+    with get_lock(directory):
+        try:
+            os.replace(tmp_path, segments[-1])
+        except PermissionError:
+            tmp_path.unlink()
+            return
+        for segment in segments[:-1]:
+            try:
+                segment.unlink()
+            except PermissionError:
+                # the segment is before the snapshot, so it is not read anymore
+                pass
+
+
+def is_snapshot(segment: Path) -> bool:
+    """
+    Args:
+        segment: The path of a segment.
+
+    Returns:
+        Whether the segment only contains a snapshot.
+    """
+    with open(segment, "rb") as f:
+        header = f.read(HEADER.size)
+        size = os.fstat(f.fileno()).st_size
+    if len(header) < HEADER.size:
+        return False
+    update_length, metadata_length, _, _, flags = HEADER.unpack(header)
+    return bool(flags & SNAPSHOT) and size == HEADER.size + update_length + metadata_length
+
+
+def compact_directory(directory: Path, fsync: bool) -> None:
+    """Compacts the segments of all the documents of a store.
+
+    Args:
+        directory: The directory of the store.
+        fsync: Whether to flush the snapshots to disk before replacing the segments.
+    """
+    if not directory.exists():
+        return
+    for document_directory in directory.iterdir():
+        if document_directory.is_dir():
+            compact_segments(document_directory, fsync)
+
+
+def encode_record(data: bytes, metadata: bytes, timestamp: float, snapshot: bool) -> bytes:
+    checksum = zlib.crc32(metadata, zlib.crc32(data))
+    flags = SNAPSHOT if snapshot else 0
+    header = HEADER.pack(len(data), len(metadata), checksum, timestamp, flags)
+    return header + data + metadata
+
+
+def iter_records(buffer: memoryview) -> Iterator[Record]:
+    offset = 0
+    size = len(buffer)
+    while offset + HEADER.size <= size:
+        update_length, metadata_length, checksum, timestamp, flags = HEADER.unpack_from(
+            buffer, offset
+        )
+        start = offset + HEADER.size
+        metadata_start = start + update_length
+        end = metadata_start + metadata_length
+        if end > size:
+            # incomplete record
+            return
+        with buffer[start:end] as record:
+            if zlib.crc32(record) != checksum:
+                # corrupted record
+                return
+        yield start, metadata_start, end, timestamp, bool(flags & SNAPSHOT)
+        offset = end
+
+
+def copy(buffer: memoryview, start: int, end: int) -> bytes:
+    with buffer[start:end] as view:
+        return bytes(view)
+
+
+@contextmanager
+def map_segment(file: BinaryIO) -> Iterator[memoryview]:
+    if os.fstat(file.fileno()).st_size == 0:
+        yield memoryview(b"")
+        return
+    with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as m:
+        with memoryview(m) as buffer:
+            yield buffer
@@ -0,0 +1,163 @@
+import pytest
+from fps_ystore_file.main import YStoreFileModule
+from fps_ystore_file.ystore import FileYStore
+from jupyverse_ystore import YDocNotFound, YStoreFactory
+from pycrdt import Doc, Text
+
+
+def make_updates(n):
+    doc = Doc()
+    text = doc.get("text", type=Text)
+    updates = []
+    doc.observe(lambda event: updates.append(event.update))
+    for i in range(n):
+        text += str(i)
+    return updates
+
+
+@pytest.mark.anyio
+async def test_write_read(tmp_path):
+    directory = tmp_path / "ystore"
+    async with YStoreFileModule("ystore_file", directory=str(directory)) as ystore_file:
+        ystore_factory = await ystore_file.get(YStoreFactory)
+        ystore = ystore_factory("path")
+        with pytest.raises(YDocNotFound):
+            async for _ in ystore.read():
+                pass
+
+        await ystore.write(b"foo")
+        await ystore.write(b"bar")
+        updates = [update async for update in ystore.read()]
+        assert [update[:2] for update in updates] == [(b"foo", b""), (b"bar", b"")]
+
+        # several updates can be written at once
+        await ystore.write_updates([b"baz", b"qux"])
+        updates = [update async for update in ystore.read()]
+        assert [update[0] for update in updates] == [b"foo", b"bar", b"baz", b"qux"]
+
+        # the updates of other documents are not read
+        with pytest.raises(YDocNotFound):
+            async for _ in ystore_factory("other_path").read():
+                pass
+
+
+@pytest.mark.anyio
+async def test_segments(tmp_path):
+    ystore = FileYStore("path", str(tmp_path), segment_size=1, fsync=False)
+    updates = make_updates(11)
+    for update in updates[:10]:
+        await ystore.write(update)
+    # every update is in its own segment
+    assert len(ystore.segments) == 10
+    assert [update async for update, *_ in ystore.read()] == updates[:10]
+
+    await ystore.compact()
+    # all the segments but the last one were merged into a snapshot
+    assert len(ystore.segments) == 2
+    assert len([update async for update in ystore.read()]) == 2
+    await ystore.write(updates[10])
+    await ystore.compact()
+    assert len(ystore.segments) == 2
+
+    doc = Doc()
+    await ystore.apply_updates(doc)
+    assert str(doc.get("text", type=Text)) == "012345678910"
+
+
+@pytest.mark.anyio
+async def test_compact_single_segment(tmp_path):
+    ystore = FileYStore("path", str(tmp_path), segment_size=1, fsync=False)
+    updates = make_updates(10)
+    await ystore.write_updates(updates[:9])
+    await ystore.compact()
+    # the updates are not merged while they are appended to their segment
+    assert len([update async for update in ystore.read()]) == 9
+
+    # once a new segment is started, the sealed segment is merged into a snapshot
+    await ystore.write(updates[9])
+    assert len(ystore.segments) == 2
+    await ystore.compact()
+    assert len(ystore.segments) == 2
+    assert len([update async for update in ystore.read()]) == 2
+    snapshot = ystore.segments[0].read_bytes()
+    await ystore.compact()
+    assert ystore.segments[0].read_bytes() == snapshot
+
+    doc = Doc()
+    await ystore.apply_updates(doc)
+    assert str(doc.get("text", type=Text)) == "0123456789"
+
+
+@pytest.mark.anyio
+async def test_compact_while_reading(tmp_path, monkeypatch):
+    ystore = FileYStore("path", str(tmp_path), segment_size=1, fsync=False)
+    updates = make_updates(5)
+    for update in updates[:4]:
+        await ystore.write(update)
+    reader = ystore.read()
+    assert (await anext(reader))[0] == updates[0]
+    # the segments being read are compacted
+    await ystore.compact()
+    assert [update async for update, *_ in reader] == updates[1:4]
+
+    # on Windows, the segments that are open can't be replaced nor deleted
+    def locked(*args):
+        raise PermissionError
+
+    await ystore.write(updates[4])
+    segments = ystore.segments
+    with monkeypatch.context() as m:
+        m.setattr("fps_ystore_file.ystore.os.replace", locked)
+        await ystore.compact()
+    # the compaction is retried later
+    assert ystore.segments == segments
+    assert list(tmp_path.rglob("*.tmp")) == []
+
+    with monkeypatch.context() as m:
+        m.setattr("pathlib.Path.unlink", locked)
+        await ystore.compact()
+    # the segments that could not be deleted are before the snapshot, they are not read
+    assert ystore.segments == segments
+    assert len([update async for update in ystore.read()]) == 2
+    await ystore.compact()
+    assert len(ystore.segments) == 2
+
+    doc = Doc()
+    await ystore.apply_updates(doc)
+    assert str(doc.get("text", type=Text)) == "01234"
+
+
+@pytest.mark.anyio
+async def test_torn_write(tmp_path):
+    ystore = FileYStore("path", str(tmp_path), fsync=False)
+    updates = make_updates(3)
+    for update in updates:
+        await ystore.write(update)
+    segment = ystore.segments[-1]
+    # simulate a crash in the middle of a write
+    data = segment.read_bytes()
+    segment.write_bytes(data[:-1])
+
+    assert [update async for update, *_ in ystore.read()] == updates[:2]
+    doc = Doc()
+    await ystore.apply_updates(doc)
+    assert str(doc.get("text", type=Text)) == "01"
+
+
+@pytest.mark.anyio
+async def test_metadata(tmp_path):
+    ystore = FileYStore("path", str(tmp_path), segment_size=1, fsync=False)
+    updates = make_updates(3)
+    await ystore.write(updates[0], b"foo")
+    await ystore.write(updates[1], b"bar")
+    await ystore.write(updates[2])
+    # the metadata of the last update is returned
+    assert await ystore.apply_updates(Doc()) == b""
+
+    await ystore.write(Doc().get_update(), b"baz")
+    await ystore.compact()
+    # the metadata of the last merged update is kept by a compaction
+    assert [metadata async for _, metadata, _ in ystore.read()] == [b"", b"baz"]
+    doc = Doc()
+    assert await ystore.apply_updates(doc) == b"baz"
+    assert str(doc.get("text", type=Text)) == "012"
@@ -0,0 +1,82 @@
+import zlib
+from collections.abc import Callable
+from types import ModuleType
+
+from anyio import to_thread
+
+zstd: ModuleType | None
+try:
+    # Python >= 3.14
+    from compression import zstd  # type: ignore[import-not-found,no-redef]
+except ImportError:
+    try:
+        import zstandard as zstd  # type: ignore[import-not-found,no-redef]
+    except ImportError:
+        zstd = None
+
+# smaller blobs are not compressed
+MIN_SIZE = 64
+# larger blobs are (de)compressed in a thread
+THREAD_SIZE = 64 * 1024
+
+
+def check_compression(compression: str | None) -> None:
+    if compression not in (None, "zlib", "zstd"):
+        raise ValueError(f"Unknown compression: {compression}")
+    if compression == "zstd" and zstd is None:
+        raise RuntimeError("zstd compression requires the zstandard package")
+
+
+def _compressor(compression: str) -> Callable[[bytes], bytes]:
+    if compression == "zlib":
+        return zlib.compress
+    if compression == "zstd" and zstd is not None:
+        return zstd.compress
+    raise RuntimeError(f"Cannot compress with {compression}")
+
+
+def _decompressor(compression: str) -> Callable[[bytes], bytes]:
+    if compression == "zlib":
+        return zlib.decompress
+    if compression == "zstd" and zstd is not None:
+        return zstd.decompress
+    raise RuntimeError(f"Cannot decompress {compression} data")
+
+
+async def compress(data: bytes, compression: str | None) -> tuple[bytes, str]:
+    """
+    Args:
+        data: The data to compress.
+        compression: The compression to use ("zlib" or "zstd"), if any.
+
+    Returns:
+        The compressed data, and the compression that was used ("" if the data was not
+        compressed).
+    """
+    if compression is None or len(data) < MIN_SIZE:
+        return data, ""
+    compressor = _compressor(compression)
+    if len(data) < THREAD_SIZE:
+        compressed = compressor(data)
+    else:
+        compressed = await to_thread.run_sync(compressor, data)
+    if len(compressed) >= len(data):
+        return data, ""
+    return compressed, compression
+
+
+async def decompress(data: bytes, compression: str) -> bytes:
+    """
+    Args:
+        data: The data to decompress.
+        compression: The compression of the data ("" if it is not compressed).
+
+    Returns:
+        The decompressed data.
+    """
+    if not compression:
+        return data
+    decompressor = _decompressor(compression)
+    if len(data) < THREAD_SIZE:
+        return decompressor(data)
+    return await to_thread.run_sync(decompressor, data)
@@ -0,0 +1,156 @@
+import anyio
+from sqlite_anyio import Connection, connect
+
+from .ystore import SQLiteYStore, WriteQueue
+
+
+async def init_db(db_path: str, version: int) -> Connection:
+    db = await connect(db_path)
+
+    create_db = False
+    move_db = False
+    if not await anyio.Path(db_path).exists():
+        create_db = True
+    else:
+        cursor = await db.cursor()
+        await cursor.execute(
+            "SELECT count(name) FROM sqlite_master WHERE type='table' and name='yupdates'"
+        )
+        res = await cursor.fetchone()
+        assert res is not None
+        table_exists = res[0]
+        if table_exists:
+            await cursor.execute("pragma user_version")
+            res = await cursor.fetchone()
+            assert res is not None
+            db_version = res[0]
+            if db_version != version:
+                if can_migrate(db_version, version):
+                    for statement in migration_statements(db_version, version):
+                        await cursor.execute(statement)
+                    await cursor.execute(f"PRAGMA user_version = {version}")
+                    await db.commit()
+                else:
+                    move_db = True
+                    create_db = True
+        else:
+            create_db = True
+    if move_db:
+        new_path = await get_new_path(db_path)
+        await db.close()
+        await anyio.Path(db_path).rename(new_path)
+        db = await connect(db_path)
+    if create_db:
+        cursor = await db.cursor()
+        await cursor.execute(
+            "CREATE TABLE yupdates "
+            "(path TEXT NOT NULL, yupdate BLOB, metadata BLOB, timestamp REAL NOT NULL, "
+            "snapshot INTEGER NOT NULL DEFAULT 0, compression TEXT NOT NULL DEFAULT '')"
+        )
+        await cursor.execute(
+            "CREATE INDEX idx_yupdates_path_timestamp ON yupdates (path, timestamp)"
+        )
+        await cursor.execute(CREATE_SNAPSHOT_INDEX)
+        await cursor.execute(CREATE_CHECKPOINTS_TABLE)
+        await cursor.execute(CREATE_CHECKPOINTS_INDEX)
+        await cursor.execute(f"PRAGMA user_version = {version}")
+        await db.commit()
+    return db
+
+
+CREATE_SNAPSHOT_INDEX = (
+    "CREATE INDEX idx_yupdates_snapshots ON yupdates (path, timestamp) WHERE snapshot"
+)
+# the version index: checkpoints of the state of the documents, which are kept when
+# the updates are compacted
+CREATE_CHECKPOINTS_TABLE = (
+    "CREATE TABLE ycheckpoints "
+    "(path TEXT NOT NULL, yupdate BLOB, timestamp REAL NOT NULL, "
+    "compression TEXT NOT NULL DEFAULT '')"
+)
+CREATE_CHECKPOINTS_INDEX = (
+    "CREATE INDEX idx_ycheckpoints_path_timestamp ON ycheckpoints (path, timestamp)"
+)
+
+# the statements to migrate the database from a version to the next one
+MIGRATIONS: dict[int, list[str]] = {
+    2: [
+        "ALTER TABLE yupdates ADD COLUMN snapshot INTEGER NOT NULL DEFAULT 0",
+        CREATE_SNAPSHOT_INDEX,
+    ],
+    3: [
+        "ALTER TABLE yupdates ADD COLUMN compression TEXT NOT NULL DEFAULT ''",
+    ],
+    4: [
+        CREATE_CHECKPOINTS_TABLE,
+        CREATE_CHECKPOINTS_INDEX,
+    ],
+}
+
+
+def can_migrate(from_version: int, to_version: int) -> bool:
+    return from_version < to_version and all(
+        version in MIGRATIONS for version in range(from_version, to_version)
+    )
+
+
+def migration_statements(from_version: int, to_version: int) -> list[str]:
+    return [
+        statement
+        for version in range(from_version, to_version)
+        for statement in MIGRATIONS[version]
+    ]
+
+
+async def compact_db(
+    connection: Connection,
+    max_age: float | None,
+    max_updates: int | None,
+    compression: str | None,
+    write_queue: WriteQueue | None = None,
+) -> None:
+    cursor = await connection.execute(
+        "SELECT path FROM yupdates GROUP BY path HAVING count(*) > 1",
+    )
+    paths = [path for (path,) in await cursor.fetchall()]
+    await cursor.close()
+    for path in paths:
+        ystore = SQLiteYStore(path, connection, write_queue=write_queue, compression=compression)
+        await ystore.compact(max_age, max_updates)
+
+
+async def checkpoint_db(
+    connection: Connection,
+    interval: int,
+    compression: str | None,
+    write_queue: WriteQueue | None = None,
+    max_checkpoints: int = 0,
+) -> None:
+    # the documents with enough updates since their last checkpoint
+    cursor = await connection.execute(
+        "SELECT yupdates.path FROM yupdates LEFT JOIN "
+        "(SELECT path, max(timestamp) AS timestamp FROM ycheckpoints GROUP BY path) "
+        "AS checkpoints ON yupdates.path = checkpoints.path "
+        "WHERE checkpoints.timestamp IS NULL OR yupdates.timestamp > checkpoints.timestamp "
+        "GROUP BY yupdates.path HAVING count(*) >= ?",
+        (interval,),
+    )
+    paths = [path for (path,) in await cursor.fetchall()]
+    await cursor.close()
+    for path in paths:
+        ystore = SQLiteYStore(path, connection, write_queue=write_queue, compression=compression)
+        await ystore.checkpoint(interval, max_checkpoints)
+
+
+async def get_new_path(path: str) -> str:
+    _path = anyio.Path(path)
+    ext = _path.suffix
+    path_noext = _path.with_suffix("")
+    i = 1
+    dir_list = [str(p) async for p in _path.parent.iterdir()]
+    while True:
+        new_path = f"{path_noext}({i}){ext}"
+        if new_path not in dir_list:
+            break
+        i += 1
+    return str(new_path)
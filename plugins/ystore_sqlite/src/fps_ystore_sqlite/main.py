@@ -1,13 +1,16 @@
 from functools import partial
+from typing import Literal
 
 import anyio
 from fps import Module
 from jupyverse_api import Config
 from jupyverse_ystore import YStoreFactory
 from pydantic import Field
-from sqlite_anyio import Connection, connect
 
-from .ystore import SQLiteYStore
+from .compression import check_compression
+from .db import checkpoint_db, compact_db, init_db
+from .shards import Shards
+from .ystore import SQLiteYStore, WriteQueue
 
 
 class YStoreSQLiteModule(Module):
@@ -16,16 +19,89 @@ class YStoreSQLiteModule(Module):
         self.config = YStoreSQLiteConfig(**kwargs)
 
     async def prepare(self) -> None:
-        connection = await init_db(self.config)
+        check_compression(self.config.compression)
+        if self.config.shards:
+            await self._prepare_shards()
+            return
+
+        connection = await init_db(self.config.db_path, self.config.version)
         try:
-            async with connection:
-                sqlite_ystore_factory = YStoreFactory(partial(SQLiteYStore, connection=connection))  # type: ignore[arg-type]
+            async with connection, anyio.create_task_group() as tg:
+                write_queue = None
+                if self.config.commit_interval:
+                    write_queue = WriteQueue(
+                        connection, self.config.commit_interval, self.config.commit_max_updates
+                    )
+                    await tg.start(write_queue.run)
+                sqlite_ystore_factory = YStoreFactory(
+                    partial(
+                        SQLiteYStore,  # type: ignore[arg-type]
+                        connection=connection,
+                        write_queue=write_queue,
+                        compression=self.config.compression,
+                    )
+                )
                 self.put(sqlite_ystore_factory)
                 self.done()
-                await anyio.sleep_forever()
+                compact = (
+                    self.config.history_max_age is not None
+                    or self.config.history_max_updates is not None
+                )
+                if not self.config.compaction_interval or not (
+                    compact or self.config.checkpoint_interval
+                ):
+                    await anyio.sleep_forever()
+                while True:
+                    await anyio.sleep(self.config.compaction_interval)
+                    if self.config.checkpoint_interval:
+                        # checkpoint before the updates are merged into snapshots
+                        await checkpoint_db(
+                            connection,
+                            self.config.checkpoint_interval,
+                            self.config.compression,
+                            write_queue,
+                            self.config.max_checkpoints,
+                        )
+                    if compact:
+                        await compact_db(
+                            connection,
+                            self.config.history_max_age,
+                            self.config.history_max_updates,
+                            self.config.compression,
+                            write_queue,
+                        )
         finally:
             await connection.close()
 
+    async def _prepare_shards(self) -> None:
+        async with Shards(
+            self.config.db_path,
+            self.config.shards,
+            self.config.version,
+            self.config.shard_idle_timeout,
+            commit_interval=self.config.commit_interval,
+            commit_max_updates=self.config.commit_max_updates,
+            history_max_age=self.config.history_max_age,
+            history_max_updates=self.config.history_max_updates,
+            checkpoint_interval=self.config.checkpoint_interval,
+            max_checkpoints=self.config.max_checkpoints,
+            compression=self.config.compression,
+        ) as shards:
+            sqlite_ystore_factory = YStoreFactory(
+                partial(
+                    SQLiteYStore,  # type: ignore[arg-type]
+                    shards=shards,
+                    compression=self.config.compression,
+                )
+            )
+            self.put(sqlite_ystore_factory)
+            self.done()
+            if not self.config.compaction_interval:
+                await anyio.sleep_forever()
+            while True:
+                await anyio.sleep(self.config.compaction_interval)
+                await shards.compact()
+
 
 class YStoreSQLiteConfig(Config):
     db_path: str = Field(
@@ -36,61 +112,79 @@ class YStoreSQLiteConfig(Config):
         description="The version of the SQLite database.",
         default=SQLiteYStore.version,
     )
-
-
-async def init_db(config: YStoreSQLiteConfig) -> Connection:
-    db = await connect(config.db_path)
-
-    create_db = False
-    move_db = False
-    if not await anyio.Path(config.db_path).exists():
-        create_db = True
-    else:
-        cursor = await db.cursor()
-        await cursor.execute(
-            "SELECT count(name) FROM sqlite_master WHERE type='table' and name='yupdates'"
-        )
-        res = await cursor.fetchone()
-        assert res is not None
-        table_exists = res[0]
-        if table_exists:
-            await cursor.execute("pragma user_version")
-            res = await cursor.fetchone()
-            assert res is not None
-            version = res[0]
-            if version != config.version:
-                move_db = True
-                create_db = True
-        else:
-            create_db = True
-    if move_db:
-        new_path = await get_new_path(config.db_path)
-        await db.close()
-        await anyio.Path(config.db_path).rename(new_path)
-        db = await connect(config.db_path)
-    if create_db:
-        cursor = await db.cursor()
-        await cursor.execute(
-            "CREATE TABLE yupdates "
-            "(path TEXT NOT NULL, yupdate BLOB, metadata BLOB, timestamp REAL NOT NULL)"
-        )
-        await cursor.execute(
-            "CREATE INDEX idx_yupdates_path_timestamp ON yupdates (path, timestamp)"
-        )
-        await cursor.execute(f"PRAGMA user_version = {config.version}")
-        await db.commit()
-    return db
-
-
-async def get_new_path(path: str) -> str:
-    _path = anyio.Path(path)
-    ext = _path.suffix
-    path_noext = _path.with_suffix("")
-    i = 1
-    dir_list = [str(p) async for p in _path.parent.iterdir()]
-    while True:
-        new_path = f"{path_noext}({i}){ext}"
-        if new_path not in dir_list:
-            break
-        i += 1
-    return str(new_path)
+    shards: int = Field(
+        description=(
+            "The number of databases the documents are distributed in, according to the "
+            "hash of their path, or 0 for a single database. "
+            'The path of a database is the database path suffixed with its index, e.g. "-0".'
+        ),
+        default=0,
+    )
+    shard_idle_timeout: float = Field(
+        description=(
+            "The time (in seconds) after which the database of a shard is closed, "
+            "when none of its documents is used."
+        ),
+        default=60,
+    )
+    compression: Literal["zlib", "zstd"] | None = Field(
+        description=(
+            "The compression of the updates, or None for no compression. "
+            'The "zstd" compression requires Python >= 3.14 or the zstandard package. '
+            "The compression of every update is stored, so it can be changed at any time."
+        ),
+        default=None,
+    )
+    commit_interval: float = Field(
+        description=(
+            "The maximum time (in seconds) an update waits before being committed, "
+            "together with the updates of all the documents written in the meantime, "
+            "or 0 to commit every update right away."
+        ),
+        default=0.01,
+    )
+    commit_max_updates: int = Field(
+        description="The maximum number of updates committed together.",
+        default=100,
+    )
+    compaction_interval: float = Field(
+        description=(
+            "The time (in seconds) between compactions of the database, "
+            "or 0 to disable compaction. "
+            "A compaction adds checkpoints to the version index, and merges the old updates "
+            "of every document into a snapshot if a history limit is set."
+        ),
+        default=60,
+    )
+    history_max_age: float | None = Field(
+        description=(
+            "The maximum age (in seconds) of the updates that are not merged by a compaction, "
+            "or None for no age limit."
+        ),
+        default=None,
+    )
+    history_max_updates: int | None = Field(
+        description=(
+            "The maximum number of recent updates of a document that are not merged by a "
+            "compaction, or None for no count limit. "
+            "The history of the documents is kept if both history limits are None."
+        ),
+        default=None,
+    )
+    checkpoint_interval: int = Field(
+        description=(
+            "The number of updates of a document between two checkpoints of the version "
+            "index, or 0 to disable the version index. "
+            "A version of a document is restored from the nearest checkpoint, "
+            "and checkpoints are kept when the updates are merged into a snapshot. "
+            "Every checkpoint stores the whole document."
+        ),
+        default=0,
+    )
+    max_checkpoints: int = Field(
+        description=(
+            "The maximum number of checkpoints kept in the version index for a document, "
+            "the oldest ones being deleted, or 0 for no limit."
+        ),
+        default=10,
+    )
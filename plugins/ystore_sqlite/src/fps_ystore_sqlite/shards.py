@@ -0,0 +1,191 @@
+import sys
+import zlib
+from collections import defaultdict
+from collections.abc import AsyncGenerator
+from contextlib import asynccontextmanager
+
+from anyio import (
+    AsyncContextManagerMixin,
+    CancelScope,
+    Event,
+    Lock,
+    create_task_group,
+    sleep,
+)
+from anyio.abc import TaskStatus
+from sqlite_anyio import Connection
+
+from .db import checkpoint_db, compact_db, init_db
+from .ystore import WriteQueue
+
+if sys.version_info >= (3, 11):
+    from typing import Self
+else:
+    from typing_extensions import Self
+
+
+class Shard:
+    def __init__(self, index: int, connection: Connection, write_queue: WriteQueue | None):
+        self.index = index
+        self.connection = connection
+        self.write_queue = write_queue
+        self.users = 0
+        self.idle_cancel_scope: CancelScope | None = None
+        self.close_event = Event()
+
+
+class Shards(AsyncContextManagerMixin):
+    """A set of SQLite databases, where documents are distributed according to the hash
+    of their path.
+
+    The database of a shard is opened when one of its documents is used, and closed
+    after it has not been used for `idle_timeout` seconds, once it is compacted.
+    """
+
+    def __init__(
+        self,
+        db_path: str,
+        number: int,
+        version: int,
+        idle_timeout: float,
+        commit_interval: float = 0,
+        commit_max_updates: int = 100,
+        history_max_age: float | None = None,
+        history_max_updates: int | None = None,
+        checkpoint_interval: int = 0,
+        max_checkpoints: int = 0,
+        compression: str | None = None,
+    ) -> None:
+        """
+        Args:
+            db_path: The path of the databases, suffixed with the shard index.
+            number: The number of shards.
+            version: The version of the databases.
+            idle_timeout: The time (in seconds) after which an unused database is closed.
+            commit_interval: The commit interval of the write queues, or 0 for no queue.
+            commit_max_updates: The maximum number of updates committed together.
+            history_max_age: The maximum age of the updates not merged by a compaction.
+            history_max_updates: The maximum number of updates not merged by a compaction.
+            checkpoint_interval: The number of updates between two checkpoints of the
+                version index, or 0 for no version index.
+            max_checkpoints: The maximum number of checkpoints kept for a document,
+                or 0 for no limit.
+            compression: The compression of the updates, if any.
+        """
+        self._db_path = db_path
+        self._number = number
+        self._version = version
+        self._idle_timeout = idle_timeout
+        self._commit_interval = commit_interval
+        self._commit_max_updates = commit_max_updates
+        self._history_max_age = history_max_age
+        self._history_max_updates = history_max_updates
+        self._checkpoint_interval = checkpoint_interval
+        self._max_checkpoints = max_checkpoints
+        self._compression = compression
+        self._shards: dict[int, Shard] = {}
+        self._locks: defaultdict[int, Lock] = defaultdict(Lock)
+
+    @property
+    def open_shards(self) -> list[Shard]:
+        """
+        Returns:
+            The shards whose database is open.
+        """
+        return list(self._shards.values())
+
+    @asynccontextmanager
+    async def __asynccontextmanager__(self) -> AsyncGenerator[Self]:
+        async with create_task_group() as self._task_group:
+            yield self
+            self._task_group.cancel_scope.cancel()
+
+    def get_path(self, index: int) -> str:
+        return f"{self._db_path}-{index}"
+
+    def get_index(self, path: str) -> int:
+        return zlib.crc32(path.encode()) % self._number
+
+    @asynccontextmanager
+    async def use(self, path: str) -> AsyncGenerator[Shard]:
+        """Uses the shard of a document, opening its database if needed.
+
+        Args:
+            path: The document path.
+        """
+        shard = await self._acquire(self.get_index(path))
+        try:
+            yield shard
+        finally:
+            self._release(shard)
+
+    async def compact(self) -> None:
+        """Adds checkpoints to the version index of the open databases, and compacts
+        them."""
+        for shard in self.open_shards:
+            await self._compact(shard)
+
+    async def _compact(self, shard: Shard) -> None:
+        if self._checkpoint_interval:
+            await checkpoint_db(
+                shard.connection,
+                self._checkpoint_interval,
+                self._compression,
+                shard.write_queue,
+                self._max_checkpoints,
+            )
+        if self._history_max_age is None and self._history_max_updates is None:
+            return
+        await compact_db(
+            shard.connection,
+            self._history_max_age,
+            self._history_max_updates,
+            self._compression,
+            shard.write_queue,
+        )
+
+    async def _acquire(self, index: int) -> Shard:
+        async with self._locks[index]:
+            shard = self._shards.get(index)
+            if shard is None:
+                shard = await self._task_group.start(self._open, index)
+                self._shards[index] = shard
+            shard.users += 1
+            if shard.idle_cancel_scope is not None:
+                shard.idle_cancel_scope.cancel()
+                shard.idle_cancel_scope = None
+        return shard
+
+    def _release(self, shard: Shard) -> None:
+        shard.users -= 1
+        if not shard.users:
+            self._task_group.start_soon(self._close_later, shard)
+
+    async def _close_later(self, shard: Shard) -> None:
+        with CancelScope() as shard.idle_cancel_scope:
+            await sleep(self._idle_timeout)
+            async with self._locks[shard.index]:
+                if not shard.users and self._shards.get(shard.index) is shard:
+                    del self._shards[shard.index]
+                    shard.close_event.set()
+
+    async def _open(self, index: int, *, task_status: TaskStatus[Shard]) -> None:
+        connection = await init_db(self.get_path(index), self._version)
+        try:
+            async with connection, create_task_group() as tg:
+                write_queue = None
+                if self._commit_interval:
+                    write_queue = WriteQueue(
+                        connection, self._commit_interval, self._commit_max_updates
+                    )
+                    await tg.start(write_queue.run)
+                shard = Shard(index, connection, write_queue)
+                task_status.started(shard)
+                await shard.close_event.wait()
+                if write_queue is not None:
+                    await write_queue.flush()
+                await self._compact(shard)
+                tg.cancel_scope.cancel()
+        finally:
+            with CancelScope(shield=True):
+                await connection.close()
@@ -1,49 +1,372 @@
 import sys
-from collections.abc import AsyncIterator
+from collections.abc import AsyncGenerator, AsyncIterator
+from contextlib import AsyncExitStack, asynccontextmanager, nullcontext
 from time import time
+from typing import TYPE_CHECKING
 
+from anyio import CancelScope, Event, Lock, move_on_after, to_thread
+from anyio.abc import TaskStatus
 from jupyverse_ystore import YDocNotFound, YStore
+from pycrdt import Doc, merge_updates
 from sqlite_anyio import Connection
 
+from .compression import compress, decompress
+
+if TYPE_CHECKING:
+    from .shards import Shards
+
 if sys.version_info >= (3, 11):
     from typing import Self
 else:
     from typing_extensions import Self
 
+# the number of updates fetched at once when reading a document
+READ_BATCH_SIZE = 64
+
+INSERT_UPDATE = (
+    "INSERT INTO yupdates (path, yupdate, metadata, timestamp, compression) VALUES (?, ?, ?, ?, ?)"
+)
+
+
+class _Batch:
+    def __init__(self) -> None:
+        self.rows: list[tuple[str, bytes, bytes, float, str]] = []
+        self.committed = Event()
+        self.exception: Exception | None = None
+
+
+class WriteQueue:
+    """A write-behind queue that commits the updates of all the documents in batches.
+
+    A batch is committed in a single transaction when it is `interval` seconds old or
+    has `max_updates` updates, whichever comes first. A write returns once its batch is
+    committed, so a writer with several updates should write them at once. The pending
+    updates are committed when the queue stops.
+
+    A batch is committed while holding the queue's lock, which the other transactions on
+    the connection (e.g. compactions) must also hold.
+    """
+
+    def __init__(self, connection: Connection, interval: float, max_updates: int) -> None:
+        """
+        Args:
+            connection: The connection to the database.
+            interval: The maximum time (in seconds) an update waits before being committed.
+            max_updates: The maximum number of updates in a batch.
+        """
+        self._connection = connection
+        self._interval = interval
+        self._max_updates = max_updates
+        self.lock = Lock()
+        self._batch = _Batch()
+        self._new_batch = Event()
+        self._full_batch = Event()
+
+    async def write(self, rows: list[tuple[str, bytes, bytes, float, str]]) -> None:
+        """
+        Args:
+            rows: The updates to commit, as (path, update, metadata, timestamp, compression).
+        """
+        batch = self._batch
+        batch.rows.extend(rows)
+        self._new_batch.set()
+        if len(batch.rows) >= self._max_updates:
+            self._full_batch.set()
+        await batch.committed.wait()
+        if batch.exception is not None:
+            raise batch.exception
+
+    async def flush(self) -> None:
+        """Commits the pending updates."""
+        async with self.lock:
+            batch = self._batch
+            if not batch.rows:
+                return
+            self._batch = _Batch()
+            self._new_batch = Event()
+            self._full_batch = Event()
+            try:
+                cursor = await self._connection.cursor()
+                await cursor.executemany(INSERT_UPDATE, batch.rows)
+                await self._connection.commit()
+                await cursor.close()
+            except Exception as exception:
+                batch.exception = exception
+            finally:
+                batch.committed.set()
+
+    async def run(self, *, task_status: TaskStatus[None]) -> None:
+        task_status.started()
+        try:
+            while True:
+                await self._new_batch.wait()
+                with move_on_after(self._interval):
+                    await self._full_batch.wait()
+                await self.flush()
+        finally:
+            with CancelScope(shield=True):
+                await self.flush()
+
 
 class SQLiteYStore(YStore):
     def __init__(
         self,
         path: str,
-        connection: Connection,
+        connection: Connection | None = None,
+        write_queue: WriteQueue | None = None,
+        compression: str | None = None,
+        shards: "Shards | None" = None,
     ) -> None:
+        """
+        Args:
+            path: The document path.
+            connection: The connection to the database, if not sharded.
+            write_queue: The write queue of the database, if not sharded.
+            compression: The compression of the updates, if any.
+            shards: The sharded databases, where the database of the document is opened
+                while the store is used.
+        """
         self._path = path
         self._connection = connection
+        self._write_queue = write_queue
+        self._compression = compression
+        self._shards = shards
 
     async def __aenter__(self) -> Self:
+        if self._shards is not None:
+            # keep the database of the document open
+            async with AsyncExitStack() as exit_stack:
+                await exit_stack.enter_async_context(self._shards.use(self._path))
+                self._exit_stack = exit_stack.pop_all()
         return self
 
     async def __aexit__(self, exc_type, exc_value, exc_tb) -> bool | None:
+        if self._shards is not None:
+            await self._exit_stack.aclose()
         return None
 
+    @asynccontextmanager
+    async def _database(self) -> AsyncGenerator[tuple[Connection, WriteQueue | None]]:
+        if self._shards is None:
+            assert self._connection is not None
+            yield self._connection, self._write_queue
+        else:
+            async with self._shards.use(self._path) as shard:
+                yield shard.connection, shard.write_queue
+
     async def read(self) -> AsyncIterator[tuple[bytes, bytes, float]]:  # type: ignore
-        cursor = await self._connection.execute(
-            "SELECT yupdate, metadata, timestamp FROM yupdates WHERE path = ?",
+        async with self._database() as (connection, write_queue):
+            if write_queue is not None:
+                # read the pending updates too
+                await write_queue.flush()
+            # the updates merged into a snapshot are deleted with its insertion, so the
+            # document is the newest snapshot and the updates that are not in a snapshot,
+            # whatever their timestamp (the clock may have been set back)
+            cursor = await connection.execute(
+                "SELECT yupdate, metadata, timestamp, compression FROM yupdates "
+                "WHERE path = ? AND (NOT snapshot OR rowid = "
+                "(SELECT max(rowid) FROM yupdates WHERE path = ? AND snapshot)) "
+                "ORDER BY timestamp, rowid",
+                (self._path, self._path),
+            )
+            found = False
+            try:
+                while True:
+                    rows = await cursor.fetchmany(READ_BATCH_SIZE)
+                    if not rows:
+                        break
+                    found = True
+                    for update, metadata, timestamp, compression in rows:
+                        yield await decompress(update, compression), metadata, timestamp
+            finally:
+                await cursor.close()
+        if not found:
+            raise YDocNotFound
+
+    async def apply_version(self, ydoc: Doc, timestamp: float) -> None:
+        """Apply the updates stored up to a timestamp to the YDoc, replaying them from the
+        nearest checkpoint of the version index or snapshot.
+
+        The updates merged into a snapshot by a compaction are only available at the
+        resolution of the checkpoints.
+
+        Arguments:
+            ydoc: The YDoc on which to apply the updates.
+            timestamp: The time of the version.
+        """
+        async with self._database() as (connection, write_queue):
+            if write_queue is not None:
+                await write_queue.flush()
+            cursor = await connection.execute(
+                "SELECT yupdate, timestamp, compression FROM ycheckpoints "
+                "WHERE path = ? AND timestamp <= ? ORDER BY timestamp DESC, rowid DESC LIMIT 1",
+                (self._path, timestamp),
+            )
+            checkpoint = await cursor.fetchone()
+            await cursor.execute(
+                "SELECT max(timestamp) FROM yupdates "
+                "WHERE path = ? AND snapshot AND timestamp <= ?",
+                (self._path, timestamp),
+            )
+            row = await cursor.fetchone()
+            assert row is not None
+            start = row[0]
+            updates = []
+            if checkpoint is not None and (start is None or checkpoint[1] > start):
+                update, start, compression = checkpoint
+                updates.append(await decompress(update, compression))
+            # the snapshot has the timestamp of its last update, and is applied with the
+            # following updates (applying an update already in a checkpoint is a no-op)
+            await cursor.execute(
+                "SELECT yupdate, compression FROM yupdates "
+                "WHERE path = ? AND timestamp >= ? AND timestamp <= ? ORDER BY timestamp, rowid",
+                (self._path, start or 0, timestamp),
+            )
+            for update, compression in await cursor.fetchall():
+                updates.append(await decompress(update, compression))
+            await cursor.close()
+        if not updates:
+            raise YDocNotFound
+        ydoc.apply_update(await to_thread.run_sync(merge_updates, *updates))
+
+    async def write(self, data: bytes, metadata: bytes = b"") -> None:
+        await self.write_updates([data], metadata)
+
+    async def write_updates(self, updates: list[bytes], metadata: bytes = b"") -> None:
+        timestamp = time()
+        rows = []
+        for update in updates:
+            data, compression = await compress(update, self._compression)
+            rows.append((self._path, data, metadata, timestamp, compression))
+        async with self._database() as (connection, write_queue):
+            if write_queue is not None:
+                await write_queue.write(rows)
+                return
+
+            cursor = await connection.cursor()
+            await cursor.executemany(INSERT_UPDATE, rows)
+            await connection.commit()
+            await cursor.close()
+
+    async def compact(self, max_age: float | None = None, max_updates: int | None = None) -> None:
+        """Merges the old updates of the document into a single snapshot.
+
+        Args:
+            max_age: The maximum age (in seconds) of the updates that are not merged.
+            max_updates: The maximum number of recent updates that are not merged.
+        """
+        async with self._database() as (connection, write_queue):
+            async with nullcontext() if write_queue is None else write_queue.lock:
+                await self._compact(connection, max_age, max_updates)
+
+    async def checkpoint(self, interval: int, max_checkpoints: int = 0) -> None:
+        """Adds checkpoints of the document to the version index, one every `interval`
+        updates since the last checkpoint.
+
+        Args:
+            interval: The number of updates between two checkpoints.
+            max_checkpoints: The maximum number of checkpoints kept for the document,
+                the oldest ones being deleted, or 0 for no limit.
+        """
+        async with self._database() as (connection, write_queue):
+            async with nullcontext() if write_queue is None else write_queue.lock:
+                await self._checkpoint(connection, interval, max_checkpoints)
+
+    async def _checkpoint(
+        self, connection: Connection, interval: int, max_checkpoints: int
+    ) -> None:
+        cursor = await connection.execute(
+            "SELECT yupdate, timestamp, compression FROM ycheckpoints "
+            "WHERE path = ? ORDER BY timestamp DESC, rowid DESC LIMIT 1",
             (self._path,),
         )
-        found = False
-        for update, metadata, timestamp in await cursor.fetchall():
-            found = True
-            yield update, metadata, timestamp
+        row = await cursor.fetchone()
+        state: bytes | None = None
+        timestamp = float("-inf")
+        if row is not None:
+            state = await decompress(row[0], row[2])
+            timestamp = row[1]
+        while True:
+            # the next `interval` updates, and the following ones with the same timestamp
+            # as the last one, so that a checkpoint contains all the updates up to its time
+            await cursor.execute(
+                "SELECT yupdate, timestamp, compression FROM yupdates "
+                "WHERE path = ? AND timestamp > ? AND timestamp <= ("
+                "SELECT timestamp FROM yupdates WHERE path = ? AND timestamp > ? "
+                "ORDER BY timestamp, rowid LIMIT 1 OFFSET ?"
+                ") ORDER BY timestamp, rowid",
+                (self._path, timestamp, self._path, timestamp, interval - 1),
+            )
+            rows = await cursor.fetchall()
+            if not rows:
+                break
+            updates = [await decompress(update, compression) for update, _, compression in rows]
+            if state is not None:
+                updates.insert(0, state)
+            state = await to_thread.run_sync(merge_updates, *updates)
+            timestamp = rows[-1][1]
+            data, compression = await compress(state, self._compression)
+            await cursor.execute(
+                "INSERT INTO ycheckpoints (path, yupdate, timestamp, compression) "
+                "VALUES (?, ?, ?, ?)",
+                (self._path, data, timestamp, compression),
+            )
+        if max_checkpoints:
+            await cursor.execute(
+                "DELETE FROM ycheckpoints WHERE path = ? AND rowid NOT IN ("
+                "SELECT rowid FROM ycheckpoints WHERE path = ? "
+                "ORDER BY timestamp DESC, rowid DESC LIMIT ?"
+                ")",
+                (self._path, self._path, max_checkpoints),
+            )
+        await connection.commit()
         await cursor.close()
-        if not found:
-            raise YDocNotFound
 
-    async def write(self, data: bytes) -> None:
-        metadata = b""
-        cursor = await self._connection.execute(
-            "INSERT INTO yupdates VALUES (?, ?, ?, ?)",
-            (self._path, data, metadata, time()),
+    async def _compact(
+        self, connection: Connection, max_age: float | None, max_updates: int | None
+    ) -> None:
+        cursor = await connection.execute(
+            "SELECT timestamp FROM yupdates WHERE path = ? ORDER BY timestamp, rowid",
+            (self._path,),
+        )
+        rows = await cursor.fetchall()
+        compact_nb = 0
+        if max_updates is not None:
+            compact_nb = len(rows) - max_updates
+        if max_age is not None:
+            cutoff = time() - max_age
+            old_nb = next(
+                (i for i, (timestamp,) in enumerate(rows) if timestamp >= cutoff), len(rows)
+            )
+            compact_nb = max(compact_nb, old_nb)
+        if compact_nb < 2:
+            # nothing to merge
+            await cursor.close()
+            return
+
+        # the rows that are merged are the rows that are deleted
+        await cursor.execute(
+            "SELECT rowid, yupdate, metadata, timestamp, compression FROM yupdates "
+            "WHERE path = ? ORDER BY timestamp, rowid LIMIT ?",
+            (self._path, compact_nb),
+        )
+        rows_to_merge = await cursor.fetchall()
+        updates = [
+            await decompress(update, compression) for _, update, _, _, compression in rows_to_merge
+        ]
+        snapshot = await to_thread.run_sync(lambda: merge_updates(*updates))
+        snapshot, compression = await compress(snapshot, self._compression)
+        _, _, metadata, timestamp, _ = rows_to_merge[-1]
+        # insert the snapshot before deleting the updates it contains, so that the
+        # document is never incomplete
+        await cursor.execute(
+            "INSERT INTO yupdates (path, yupdate, metadata, timestamp, compression, snapshot) "
+            "VALUES (?, ?, ?, ?, ?, 1)",
+            (self._path, snapshot, metadata, timestamp, compression),
+        )
+        await cursor.executemany(
+            "DELETE FROM yupdates WHERE rowid = ?",
+            [(rowid,) for rowid, *_ in rows_to_merge],
         )
-        await self._connection.commit()
+        await connection.commit()
         await cursor.close()
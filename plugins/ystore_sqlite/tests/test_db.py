@@ -1,7 +1,10 @@
+import gc
+import sqlite3
 from time import time
 
 import pytest
-from anyio import create_task_group, wait_all_tasks_blocked
+from anyio import create_task_group, fail_after, sleep, wait_all_tasks_blocked
+from fps_ystore_sqlite.db import checkpoint_db
 from fps_ystore_sqlite.main import YStoreSQLiteModule
 from jupyverse_ystore import YDocNotFound, YStoreFactory
 from pycrdt import Doc, Text
@@ -124,3 +127,323 @@ async def test_concurrent_accesses(tmp_path):
         assert str(_text0) == ref0
         assert str(_text1) == ref1
         tg.cancel_scope.cancel()
+    # document events must be dropped in the thread that created them
+    gc.collect()
+
+
+@pytest.mark.anyio
+async def test_compaction(tmp_path):
+    db_path = tmp_path / "test.db"
+    doc = Doc()
+    text = doc.get("text", type=Text)
+
+    async with YStoreSQLiteModule("ystore_sqlite", db_path=str(db_path)) as ystore_sqlite:
+        ystore_factory = await ystore_sqlite.get(YStoreFactory)
+        ystore = ystore_factory("doc")
+        for i in range(10):
+            state = doc.get_state()
+            text += str(i)
+            await ystore.write(doc.get_update(state))
+
+        # the 7 oldest updates are merged into a snapshot
+        await ystore.compact(max_updates=3)
+        updates = [data async for data in ystore.read()]
+        assert len(updates) == 4
+        timestamps = sorted(timestamp for _, _, timestamp in updates)
+        _doc = Doc()
+        await ystore.apply_updates(_doc)
+        assert str(_doc.get("text", type=Text)) == "0123456789"
+
+        # all the updates are merged into a snapshot
+        await ystore.compact(max_age=0)
+        updates = [data async for data in ystore.read()]
+        assert len(updates) == 1
+        assert updates[0][2] == timestamps[-1]
+        _doc = Doc()
+        await ystore.apply_updates(_doc)
+        assert str(_doc.get("text", type=Text)) == "0123456789"
+
+
+@pytest.mark.anyio
+async def test_compaction_same_timestamps(tmp_path):
+    db_path = tmp_path / "test.db"
+    doc = Doc()
+    text = doc.get("text", type=Text)
+
+    async with YStoreSQLiteModule("ystore_sqlite", db_path=str(db_path)) as ystore_sqlite:
+        ystore_factory = await ystore_sqlite.get(YStoreFactory)
+        ystore = ystore_factory("doc")
+        written = []
+        for i in range(10):
+            state = doc.get_state()
+            text += str(i)
+            written.append(doc.get_update(state))
+            await ystore.write(written[-1])
+
+    db = sqlite3.connect(db_path)
+    db.execute("UPDATE yupdates SET timestamp = 1")
+    db.commit()
+    db.close()
+
+    async with YStoreSQLiteModule("ystore_sqlite", db_path=str(db_path)) as ystore_sqlite:
+        ystore_factory = await ystore_sqlite.get(YStoreFactory)
+        ystore = ystore_factory("doc")
+        # the updates with the same timestamp are read in the order they were written
+        assert [update async for update, _, _ in ystore.read()] == written
+        # the merged updates are the deleted ones
+        await ystore.compact(max_updates=3)
+        updates = [data async for data in ystore.read()]
+        assert len(updates) == 4
+        _doc = Doc()
+        await ystore.apply_updates(_doc)
+        assert str(_doc.get("text", type=Text)) == "0123456789"
+
+
+@pytest.mark.anyio
+async def test_compaction_clock_set_back(tmp_path):
+    db_path = tmp_path / "test.db"
+    doc = Doc()
+    text = doc.get("text", type=Text)
+
+    async with YStoreSQLiteModule("ystore_sqlite", db_path=str(db_path)) as ystore_sqlite:
+        ystore_factory = await ystore_sqlite.get(YStoreFactory)
+        ystore = ystore_factory("doc")
+        for i in range(3):
+            state = doc.get_state()
+            text += str(i)
+            await ystore.write(doc.get_update(state))
+        await ystore.compact(max_age=0)
+        state = doc.get_state()
+        text += "3"
+        await ystore.write(doc.get_update(state))
+
+    # the last update was written with an earlier time than the snapshot
+    db = sqlite3.connect(db_path)
+    db.execute("UPDATE yupdates SET timestamp = 1 WHERE NOT snapshot")
+    db.commit()
+    db.close()
+
+    async with YStoreSQLiteModule("ystore_sqlite", db_path=str(db_path)) as ystore_sqlite:
+        ystore_factory = await ystore_sqlite.get(YStoreFactory)
+        ystore = ystore_factory("doc")
+        updates = [data async for data in ystore.read()]
+        assert len(updates) == 2
+        _doc = Doc()
+        await ystore.apply_updates(_doc)
+        assert str(_doc.get("text", type=Text)) == "0123"
+
+
+@pytest.mark.anyio
+async def test_group_commit(tmp_path):
+    db_path = tmp_path / "test.db"
+
+    async with YStoreSQLiteModule(
+        "ystore_sqlite", db_path=str(db_path), commit_interval=10, commit_max_updates=3
+    ) as ystore_sqlite:
+        ystore_factory = await ystore_sqlite.get(YStoreFactory)
+        ystore0 = ystore_factory("doc0")
+        ystore1 = ystore_factory("doc1")
+        # a full batch is committed without waiting for the commit interval
+        with fail_after(1):
+            async with create_task_group() as tg:
+                tg.start_soon(ystore0.write, b"0")
+                tg.start_soon(ystore1.write, b"1")
+                tg.start_soon(ystore0.write, b"2")
+        # updates written together are committed in the same batch
+        with fail_after(1):
+            await ystore0.write_updates([b"4", b"5", b"6"])
+        # a pending update is committed at shutdown
+        async with create_task_group() as tg:
+            tg.start_soon(ystore1.write, b"3")
+            await wait_all_tasks_blocked()
+            tg.cancel_scope.cancel()
+
+    async with YStoreSQLiteModule("ystore_sqlite", db_path=str(db_path)) as ystore_sqlite:
+        ystore_factory = await ystore_sqlite.get(YStoreFactory)
+        updates0 = [update async for update, _, _ in ystore_factory("doc0").read()]
+        updates1 = [update async for update, _, _ in ystore_factory("doc1").read()]
+        assert sorted(updates0) == [b"0", b"2", b"4", b"5", b"6"]
+        assert sorted(updates1) == [b"1", b"3"]
+
+
+@pytest.mark.anyio
+async def test_migration(tmp_path):
+    db_path = tmp_path / "test.db"
+    db = sqlite3.connect(db_path)
+    db.execute(
+        "CREATE TABLE yupdates "
+        "(path TEXT NOT NULL, yupdate BLOB, metadata BLOB, timestamp REAL NOT NULL)"
+    )
+    db.execute("INSERT INTO yupdates VALUES ('doc', 'foo', '', 1)")
+    db.execute("INSERT INTO yupdates VALUES ('doc', 'bar', '', 0)")
+    db.execute("PRAGMA user_version = 2")
+    db.commit()
+    db.close()
+
+    async with YStoreSQLiteModule("ystore_sqlite", db_path=str(db_path)) as ystore_sqlite:
+        ystore_factory = await ystore_sqlite.get(YStoreFactory)
+        ystore = ystore_factory("doc")
+        # the database was migrated in place, and the updates are read in order
+        assert set(tmp_path.iterdir()) == {db_path}
+        assert [data async for data in ystore.read()] == [("bar", "", 0), ("foo", "", 1)]
+
+        # only the newest snapshot is read, with the updates that are not in a snapshot
+        connection = ystore._connection
+        await connection.execute(
+            "INSERT INTO yupdates (path, yupdate, metadata, timestamp, snapshot) "
+            "VALUES ('doc', 'baz', '', 3, 1), ('doc', 'qux', '', 2, 1)"
+        )
+        await connection.commit()
+        assert [data async for data in ystore.read()] == [
+            ("bar", "", 0),
+            ("foo", "", 1),
+            ("qux", "", 2),
+        ]
+
+
+@pytest.mark.anyio
+async def test_compression(tmp_path):
+    db_path = tmp_path / "test.db"
+    doc = Doc()
+    text = doc.get("text", type=Text)
+
+    async def write(ystore, string):
+        nonlocal text
+        state = doc.get_state()
+        text += string
+        await ystore.write(doc.get_update(state))
+
+    async with YStoreSQLiteModule("ystore_sqlite", db_path=str(db_path)) as ystore_sqlite:
+        ystore_factory = await ystore_sqlite.get(YStoreFactory)
+        await write(ystore_factory("doc"), "a" * 1000)
+
+    async with YStoreSQLiteModule(
+        "ystore_sqlite", db_path=str(db_path), compression="zlib"
+    ) as ystore_sqlite:
+        ystore_factory = await ystore_sqlite.get(YStoreFactory)
+        ystore = ystore_factory("doc")
+        await write(ystore, "b" * 1000)
+        await write(ystore, "c")
+
+        # the compression is stored for every update
+        db = sqlite3.connect(db_path)
+        rows = db.execute("SELECT yupdate, compression FROM yupdates ORDER BY timestamp").fetchall()
+        db.close()
+        assert [compression for _, compression in rows] == ["", "zlib", ""]
+        assert len(rows[1][0]) < 100
+
+        await ystore.write(Doc().get_update(), b"metadata")
+        _doc = Doc()
+        # the metadata of the last update is returned
+        assert await ystore.apply_updates(_doc) == b"metadata"
+        assert str(_doc.get("text", type=Text)) == "a" * 1000 + "b" * 1000 + "c"
+
+        await ystore.compact(max_age=0)
+        _doc = Doc()
+        assert await ystore.apply_updates(_doc) == b"metadata"
+        assert str(_doc.get("text", type=Text)) == "a" * 1000 + "b" * 1000 + "c"
+
+
+@pytest.mark.anyio
+async def test_shards(tmp_path):
+    db_path = tmp_path / "test.db"
+
+    async with YStoreSQLiteModule(
+        "ystore_sqlite", db_path=str(db_path), shards=4, shard_idle_timeout=0.1
+    ) as ystore_sqlite:
+        ystore_factory = await ystore_sqlite.get(YStoreFactory)
+        async with ystore_factory("doc0") as ystore0, ystore_factory("doc1") as ystore1:
+            await ystore0.write(b"foo")
+            await ystore1.write(b"bar")
+            shards = ystore0._shards
+            index0 = shards.get_index("doc0")
+            index1 = shards.get_index("doc1")
+            assert {shard.index for shard in shards.open_shards} == {index0, index1}
+
+        # the databases are closed when they are not used
+        await sleep(0.5)
+        assert shards.open_shards == []
+        assert {path.name for path in tmp_path.iterdir()} == {
+            f"test.db-{index0}",
+            f"test.db-{index1}",
+        }
+
+        # and opened again when needed
+        assert [data async for data, _, _ in ystore_factory("doc0").read()] == [b"foo"]
+        assert [data async for data, _, _ in ystore_factory("doc1").read()] == [b"bar"]
+
+
+@pytest.mark.anyio
+async def test_version_index(tmp_path):
+    db_path = tmp_path / "test.db"
+    doc = Doc()
+    text = doc.get("text", type=Text)
+
+    async with YStoreSQLiteModule(
+        "ystore_sqlite", db_path=str(db_path), commit_interval=0, compaction_interval=0
+    ) as ystore_sqlite:
+        ystore_factory = await ystore_sqlite.get(YStoreFactory)
+        ystore = ystore_factory("doc")
+        for i in range(10):
+            state = doc.get_state()
+            text += str(i)
+            await ystore.write(doc.get_update(state))
+        timestamps = [timestamp async for _, _, timestamp in ystore.read()]
+
+        await ystore.checkpoint(3)
+        db = sqlite3.connect(db_path)
+        checkpoints = db.execute("SELECT timestamp FROM ycheckpoints ORDER BY timestamp").fetchall()
+        db.close()
+        assert [timestamp for (timestamp,) in checkpoints] == timestamps[2:9:3]
+
+        async def get_version(timestamp):
+            _doc = Doc()
+            await ystore.apply_version(_doc, timestamp)
+            return str(_doc.get("text", type=Text))
+
+        with pytest.raises(YDocNotFound):
+            await get_version(timestamps[0] - 1)
+        for i, timestamp in enumerate(timestamps):
+            assert await get_version(timestamp) == "0123456789"[: i + 1]
+
+        # the checkpoints are kept when the updates are merged into a snapshot
+        await ystore.compact(max_age=0)
+        assert await get_version(timestamps[4]) == "012"
+        assert await get_version(timestamps[9]) == "0123456789"
+
+        # only the newest checkpoints are kept
+        await ystore.checkpoint(3, max_checkpoints=2)
+        db = sqlite3.connect(db_path)
+        checkpoints = db.execute("SELECT timestamp FROM ycheckpoints ORDER BY timestamp").fetchall()
+        db.close()
+        assert [timestamp for (timestamp,) in checkpoints] == timestamps[5:9:3]
+
+
+@pytest.mark.anyio
+async def test_checkpoint_db(tmp_path):
+    db_path = tmp_path / "test.db"
+
+    async with YStoreSQLiteModule(
+        "ystore_sqlite", db_path=str(db_path), commit_interval=0, compaction_interval=0
+    ) as ystore_sqlite:
+        ystore_factory = await ystore_sqlite.get(YStoreFactory)
+        ystore0 = ystore_factory("doc0")
+        ystore1 = ystore_factory("doc1")
+        await ystore0.write_updates([Doc().get_update()] * 3)
+        await ystore1.write_updates([Doc().get_update()] * 2)
+        connection = ystore0._connection
+
+        def get_checkpoints():
+            db = sqlite3.connect(db_path)
+            rows = db.execute("SELECT path FROM ycheckpoints ORDER BY path").fetchall()
+            db.close()
+            return [path for (path,) in rows]
+
+        await checkpoint_db(connection, 2, None)
+        assert get_checkpoints() == ["doc0", "doc1"]
+        # a document is only checkpointed again after enough new updates
+        await checkpoint_db(connection, 2, None)
+        assert get_checkpoints() == ["doc0", "doc1"]
+        await ystore1.write_updates([Doc().get_update()] * 2)
+        await checkpoint_db(connection, 2, None)
+        assert get_checkpoints() == ["doc0", "doc1", "doc1"]
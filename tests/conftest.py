@@ -47,6 +47,8 @@ def start_jupyverse(auth_mode, clear_users, tmp_cwd, free_tcp_port):
         "--disable",
         "file_watcher_poll",
         "--disable",
+        "ystore_file",
+        "--disable",
         "jupyter_server",
         "--disable",
         "jupyterlab_git",
@@ -107,3 +107,52 @@ async def test_tree(auth_mode, tmp_path, free_tcp_port):
         sort_content_by_name(expected)
         assert actual == expected
         os.chdir(prev_dir)
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("auth_mode", ("noauth",))
+async def test_tree_children(auth_mode, tmp_path, free_tcp_port):
+    prev_dir = os.getcwd()
+    os.chdir(tmp_path)
+    Path("notebook.ipynb").write_text('{"cells": [], "metadata": {}}')
+    Path("data.json").write_text("{}")
+    Path("file.txt").write_text("hello")
+    Path(".hidden").write_text("")
+    Path("directory").mkdir()
+    Path("directory/file.txt").write_text("")
+    Path("read_only.txt").write_text("")
+    Path("read_only.txt").chmod(0o444)
+
+    config = merge_config(
+        CONFIG,
+        {
+            "jupyverse": {
+                "config": {"port": free_tcp_port},
+                "modules": {
+                    "auth": {
+                        "config": {
+                            "mode": auth_mode,
+                        }
+                    }
+                },
+            }
+        },
+    )
+    root_module = get_root_module(config)
+    root_module._global_start_timeout = 10
+    async with root_module, AsyncClient() as http:
+        for dir_path in ("", "directory"):
+            response = await http.get(
+                f"http://127.0.0.1:{free_tcp_port}/api/contents/{dir_path}",
+                params={"content": 1},
+            )
+            children = response.json()["content"]
+            assert ".hidden" not in [child["name"] for child in children]
+            # the directory listing must be the same as the models of its children
+            for child in children:
+                response = await http.get(
+                    f"http://127.0.0.1:{free_tcp_port}/api/contents/{child['path']}",
+                    params={"content": 0},
+                )
+                assert response.json() == child
+        os.chdir(prev_dir)